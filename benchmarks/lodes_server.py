@@ -0,0 +1,174 @@
+'''
+A local stand-in for the Census LODES server, for benchmarks. Serves a folder laid out like LODES8 (hint: output of
+synthetic_lodes.generate()) with the directory pages the crawler reads, ETag/Last-Modified validators, conditional
+requests (304) and byte ranges (206, If-Range), so download_and_unzip runs against it exactly as against the real thing.
+An optional per-connection bandwidth and latency make it behave more like the internet than like a loopback.
+'''
+
+import os
+import threading
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+BASE_PATH = "/data/lodes/LODES8/"
+
+class _LodesHandler(BaseHTTPRequestHandler):
+    '''
+    GET/HEAD for files and directory pages under the server's root.
+    '''
+    protocol_version = "HTTP/1.1"
+    chunk_size = 1 << 16
+
+    def log_message(self, format, *args):
+        pass
+
+    def _local_path(self) -> str:
+        path = unquote(self.path.split("?")[0])
+        if not path.startswith(BASE_PATH):
+            return None
+        local = os.path.normpath(os.path.join(self.server.root, path[len(BASE_PATH):]))
+        if not local.startswith(os.path.normpath(self.server.root)):
+            return None
+        return local
+
+    def _send_empty(self, status: int, headers: dict = None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _listing(self, local: str, head: bool):
+        names = sorted(os.listdir(local))
+        links = [n + "/" if os.path.isdir(os.path.join(local, n)) else n for n in names]
+        body = ("<html><body><h1>Index</h1>\n"
+                + "".join(f'<a href="{q}">{q}</a><br>\n' for q in links)
+                + "</body></html>\n").encode()
+        stat = os.stat(local)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Last-Modified", formatdate(stat.st_mtime, usegmt=True))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def _file(self, local: str, head: bool):
+        stat = os.stat(local)
+        size = stat.st_size
+        etag = f'"{size:x}-{stat.st_mtime_ns:x}"'
+        last_modified = formatdate(stat.st_mtime, usegmt=True)
+        validators = {"ETag": etag, "Last-Modified": last_modified}
+
+        #conditional requests
+        inm = self.headers.get("If-None-Match")
+        ims = self.headers.get("If-Modified-Since")
+        if inm is not None:
+            if etag in [t.strip() for t in inm.split(",")]:
+                return self._send_empty(304, validators)
+        elif ims is not None:
+            try:
+                if int(stat.st_mtime) <= parsedate_to_datetime(ims).timestamp():
+                    return self._send_empty(304, validators)
+            except (TypeError, ValueError):
+                pass
+
+        #byte ranges, only honoured if If-Range still matches
+        start, end = 0, size - 1
+        status = 200
+        rng = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if (rng is not None) and rng.startswith("bytes=") and (if_range in [None, etag, last_modified]):
+            first, _, last = rng[len("bytes="):].split(",")[0].partition("-")
+            try:
+                if first:
+                    start = int(first)
+                    end = min(int(last), size - 1) if last else size - 1
+                else:
+                    start = max(0, size - int(last))
+            except ValueError:
+                return self._send_empty(416, {"Content-Range": f"bytes */{size}"})
+            if start >= size:
+                return self._send_empty(416, {"Content-Range": f"bytes */{size}"})
+            status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/gzip")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        for k, v in validators.items():
+            self.send_header(k, v)
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if head:
+            return
+
+        rate = self.server.bytes_per_sec
+        remaining = end - start + 1
+        with open(local, 'rb') as fp:
+            fp.seek(start)
+            while remaining > 0:
+                block = fp.read(min(self.chunk_size, remaining))
+                if not block:
+                    break
+                self.wfile.write(block)
+                remaining -= len(block)
+                if rate:
+                    time.sleep(len(block) / rate)
+
+    def _serve(self, head: bool):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        local = self._local_path()
+        if (local is None) or not os.path.exists(local):
+            return self._send_empty(404)
+        if os.path.isdir(local):
+            if not self.path.endswith("/"):
+                return self._send_empty(301, {"Location": self.path + "/"})
+            return self._listing(local, head)
+        return self._file(local, head)
+
+    def do_GET(self):
+        self._serve(head=False)
+
+    def do_HEAD(self):
+        self._serve(head=True)
+
+def serve(root: str, host: str = "127.0.0.1", port: int = 0, bytes_per_sec: float = None,
+          latency: float = 0.0) -> tuple:
+    '''
+    start serving root in a background thread. returns (server, base_url); pass base_url to
+    get_all_possible_files(base_url=...) and call server.shutdown() when done.
+    :param str root: folder laid out like LODES8, i.e. root/{st}/od/... (hint: synthetic_lodes.generate())
+    :param str host: interface to listen on
+    :param int port: port to listen on; 0 picks a free one
+    :param float bytes_per_sec: optional bandwidth ceiling per connection
+    :param float latency: optional seconds to wait before answering each request
+    '''
+    server = ThreadingHTTPServer((host, port), _LodesHandler)
+    server.daemon_threads = True
+    server.root = root
+    server.bytes_per_sec = bytes_per_sec
+    server.latency = latency
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}{BASE_PATH}"
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="serve a LODES8-style folder over http")
+    parser.add_argument("root")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--bytes-per-sec", type=float, default=None)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+    server, url = serve(args.root, port=args.port, bytes_per_sec=args.bytes_per_sec, latency=args.latency)
+    print(f"serving {args.root} at {url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,239 @@
+'''
+Benchmark the LODES pipeline end to end on synthetic data served from a local stand-in for the Census server:
+crawl the catalog, download, revalidate, unzip, load, index, optimize and run representative queries. Each stage's wall time,
+bytes, rows and rows/s go into a JSON results file tagged with the git commit, so runs can be compared across commits.
+
+    python benchmarks/run_benchmarks.py --blocks 20000 --out results/base.json
+    python benchmarks/run_benchmarks.py --blocks 20000 --out results/new.json --compare results/base.json
+
+Everything is written to a temporary folder (or --work-dir) and the network stand-in runs on localhost, so the numbers
+measure this code rather than the Census server; use --bytes-per-sec/--latency to make the server slower.
+'''
+
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "main"))
+
+import synthetic_lodes
+import lodes_server
+from download_and_unzip import get_all_possible_files, download_states, unzip_state_lodes_file
+from build_database import load_lodes_into_db, build_indexes, get_load_ledger, optimize_db
+from analysis import generate_query, pull_data
+from database import LodesDatabase
+
+def _git_commit() -> str:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True, text=True)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+def _folder_bytes(folder: str, suffix: str) -> tuple:
+    files = [os.path.join(d, f) for d, _, fs in os.walk(folder) for f in fs if f.endswith(suffix)]
+    return len(files), sum(os.path.getsize(f) for f in files)
+
+class Bench:
+    '''
+    collects stage and query timings; stages run quietly unless verbose.
+    '''
+    def __init__(self, verbose: bool = False):
+        self.verbose = verbose
+        self.stages = {}
+        self.queries = {}
+
+    def stage(self, name: str, fn, *args, **kwargs):
+        '''
+        run fn once as the named stage; returns its result. its printed progress is swallowed unless verbose.
+        '''
+        sink = contextlib.nullcontext() if self.verbose else contextlib.redirect_stdout(io.StringIO())
+        t0 = time.perf_counter()
+        with sink:
+            result = fn(*args, **kwargs)
+        secs = time.perf_counter() - t0
+        self.stages[name] = {'seconds': round(secs, 4)}
+        print(f"{name}: {secs:.2f}s")
+        return result
+
+    def note(self, name: str, files: int = None, bytes: int = None, rows: int = None):
+        '''
+        add sizes to a stage that has run, with the throughput they give.
+        '''
+        s = self.stages[name]
+        secs = max(s['seconds'], 1e-9)
+        if files is not None:
+            s['files'] = files
+        if bytes is not None:
+            s['bytes'] = bytes
+            s['mb_per_s'] = round(bytes / 1e6 / secs, 2)
+        if rows is not None:
+            s['rows'] = rows
+            s['rows_per_s'] = round(rows / secs)
+
+    def query(self, name: str, query: str, db: LodesDatabase, repeat: int = 5):
+        '''
+        time pull_data() on a query repeat times, after one warm-up run.
+        '''
+        with contextlib.redirect_stdout(io.StringIO()):
+            df = pull_data(query, db=db)
+            runs = []
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                df = pull_data(query, db=db)
+                runs.append(time.perf_counter() - t0)
+        rows = 0 if df is None else df.shape[0]
+        self.queries[name] = {'rows': rows, 'runs': repeat, 'min': round(min(runs), 5),
+                              'median': round(statistics.median(runs), 5), 'sql_bytes': len(query)}
+        print(f"query {name}: {rows} rows, median {statistics.median(runs) * 1000:.1f} ms")
+
+def run(work_dir: str, states: list, blocks: int, years: list, job_types: list, segments: list, od_links: int,
+        workers: int, load_workers: int, layout: str, clustered: bool, covering: bool, optimize: bool, query_blocks: int,
+        repeat: int, bytes_per_sec: float, latency: float, verbose: bool) -> dict:
+    '''
+    run every stage in work_dir and return the results dictionary.
+    '''
+    bench = Bench(verbose=verbose)
+    mirror = os.path.join(work_dir, "mirror")
+    save_loc = os.path.join(work_dir, "download")
+    spath = os.path.join(work_dir, "bench.db")
+
+    gen = bench.stage('generate', synthetic_lodes.generate, mirror, states=states, blocks=blocks, years=years,
+                      job_types=job_types, segments=segments, od_links=od_links)
+    bench.note('generate', files=gen['files'], bytes=gen['bytes'], rows=gen['rows'])
+
+    server, base_url = lodes_server.serve(mirror, bytes_per_sec=bytes_per_sec, latency=latency)
+    try:
+        links = bench.stage('catalog', get_all_possible_files, workers=workers, base_url=base_url)
+        folds = bench.stage('download', download_states, save_loc=save_loc, states=states, links_dict=links,
+                            workers=workers)
+        files, size = _folder_bytes(save_loc, ".gz")
+        bench.note('download', files=files, bytes=size)
+        bench.stage('revalidate', download_states, save_loc=save_loc, states=states, links_dict=links,
+                    workers=workers)
+        bench.note('revalidate', files=files)
+    finally:
+        server.shutdown()
+
+    def unzip_all():
+        for st in states:
+            unzip_state_lodes_file(state_fold=folds[st], workers=workers, force=True)
+    bench.stage('unzip', unzip_all)
+    files, size = _folder_bytes(save_loc, ".csv")
+    bench.note('unzip', files=files, bytes=size)
+
+    def load_all():
+        for st in states:
+            load_lodes_into_db(folder_path=folds[st], spath=spath, layout=layout, workers=load_workers,
+                               indexes='none', clustered=clustered, resume=False)
+    bench.stage('load', load_all)
+    with LodesDatabase(spath, pool_size=1, spatialite=False) as db:
+        ledger = get_load_ledger(db=db)
+    bench.note('load', files=len(ledger), rows=sum(r['row_count'] or 0 for r in ledger.values()))
+    bench.stage('index', build_indexes, spath, covering=covering)
+    bench.note('index', bytes=os.path.getsize(spath))
+    if optimize:
+        bench.stage('optimize', optimize_db, spath)
+        bench.note('optimize', bytes=os.path.getsize(spath))
+
+    #representative pulls: a handful of blocks, and a metro-sized set
+    st = states[0]
+    geocodes = list(synthetic_lodes.make_blocks(st, blocks))
+    few, many = geocodes[:10], geocodes[:query_blocks]
+    year, jt = str(years[0]), 'all'
+    with LodesDatabase(spath, read_only=True, immutable=optimize, spatialite=False) as db:
+        for name, kwargs in [('wac_few', dict(data_type='wac', geocodes=few)),
+                             ('wac_many', dict(data_type='wac', geocodes=many)),
+                             ('rac_many', dict(data_type='rac', geocodes=many)),
+                             ('od_work_many', dict(data_type='od', perspective='work', geocodes=many)),
+                             ('od_home_few', dict(data_type='od', perspective='home', geocodes=few))]:
+            with contextlib.redirect_stdout(io.StringIO()):
+                query = generate_query(state_code=st, year=year, job_type=jt, layout=layout, clustered=clustered,
+                                       **kwargs)
+            bench.query(name, query, db, repeat=repeat)
+
+    return {'commit': _git_commit(),
+            'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'params': {'states': states, 'blocks': blocks, 'years': years, 'job_types': job_types,
+                       'segments': segments, 'od_links': od_links, 'workers': workers, 'load_workers': load_workers,
+                       'layout': layout, 'clustered': clustered, 'covering': covering, 'optimize': optimize,
+                       'query_blocks': query_blocks,
+                       'repeat': repeat, 'bytes_per_sec': bytes_per_sec, 'latency': latency},
+            'stages': bench.stages,
+            'queries': bench.queries}
+
+def compare(new: dict, old: dict):
+    '''
+    print each stage and query's time against an earlier results file; ratios below 1 are faster.
+    '''
+    print(f"\n{'':<16}{old.get('commit') or 'old':>12}{new.get('commit') or 'new':>12}{'ratio':>8}")
+    for section, key in [('stages', 'seconds'), ('queries', 'median')]:
+        for name, res in new[section].items():
+            before = old.get(section, {}).get(name, {}).get(key)
+            if before is None:
+                continue
+            print(f"{name:<16}{before:>12.4f}{res[key]:>12.4f}{res[key] / max(before, 1e-9):>8.2f}")
+    if old.get('params') != new.get('params'):
+        print("note: the two runs used different parameters")
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="benchmark the LODES pipeline on synthetic data")
+    parser.add_argument("--out", default="benchmark_results.json", help="results file to write")
+    parser.add_argument("--compare", default=None, help="earlier results file to compare against")
+    parser.add_argument("--work-dir", default=None, help="folder to work in; a temporary one by default")
+    parser.add_argument("--states", nargs="+", default=['tx'])
+    parser.add_argument("--blocks", type=int, default=5000)
+    parser.add_argument("--years", nargs="+", type=int, default=[2019, 2020])
+    parser.add_argument("--job-types", nargs="+", default=['JT00', 'JT01'])
+    parser.add_argument("--segments", nargs="+", default=['S000', 'SA01'])
+    parser.add_argument("--od-links", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=4, help="download and unzip workers")
+    parser.add_argument("--load-workers", type=int, default=1, help="parse workers for load_lodes_into_db")
+    parser.add_argument("--layout", default='per_file', choices=['per_file', 'consolidated'])
+    parser.add_argument("--clustered", action="store_true")
+    parser.add_argument("--covering", action="store_true")
+    parser.add_argument("--no-optimize", action="store_true", help="query the database as loaded, without optimize_db()")
+    parser.add_argument("--query-blocks", type=int, default=1000, help="blocks in the large query set")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--bytes-per-sec", type=float, default=None)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--verbose", action="store_true", help="show each stage's own progress output")
+    args = parser.parse_args()
+
+    params = dict(states=args.states, blocks=args.blocks, years=args.years, job_types=args.job_types,
+                  segments=args.segments, od_links=args.od_links, workers=args.workers,
+                  load_workers=args.load_workers, layout=args.layout, clustered=args.clustered,
+                  covering=args.covering, optimize=not args.no_optimize, query_blocks=min(args.query_blocks, args.blocks), repeat=args.repeat,
+                  bytes_per_sec=args.bytes_per_sec, latency=args.latency, verbose=args.verbose)
+    if args.work_dir:
+        os.makedirs(args.work_dir, exist_ok=True)
+        results = run(args.work_dir, **params)
+    else:
+        with tempfile.TemporaryDirectory(prefix="lodes_bench_") as work_dir:
+            results = run(work_dir, **params)
+
+    if os.path.dirname(args.out):
+        os.makedirs(os.path.dirname(args.out), exist_ok=True)
+    with open(args.out, 'w') as fp:
+        json.dump(results, fp, indent=1)
+    print(f"results saved to {args.out}")
+
+    if args.compare:
+        with open(args.compare, 'r') as fp:
+            compare(results, json.load(fp))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+'''
+Write synthetic LODES 8 files for benchmarking: od, rac, wac and crosswalk .csv.gz files with the real column layout,
+in the same folders as the Census server (root/{st}/od, rac, wac and root/{st}/{st}_xwalk.csv.gz).
+Counts are random; geocodes are well formed 15-digit blocks nested in counties, tracts and block groups, so
+crosswalk rollups and geometry-free analysis work on them. The same arguments and seed always give the same bytes.
+'''
+
+import gzip
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "main"))
+from build_database import LODES_COLUMNS
+
+STATE_CODES = {'tx': ('48', 'TX', 'Texas'), 'ok': ('40', 'OK', 'Oklahoma'), 'la': ('22', 'LA', 'Louisiana'),
+               'nm': ('35', 'NM', 'New Mexico'), 'ar': ('05', 'AR', 'Arkansas')}
+CREATEDATE = '20230321'
+
+def make_blocks(st: str, blocks: int = 1000) -> np.ndarray:
+    '''
+    unique 15-digit block geocodes for a state, spread over counties, tracts and block groups.
+    :param str st: two letter state code, one of STATE_CODES
+    :param int blocks: number of blocks
+    '''
+    fips = STATE_CODES[st][0]
+    i = np.arange(blocks)
+    #about 40 blocks a block group, 3 block groups a tract and 50 tracts a county
+    county = 1 + 2 * (i // 6000)
+    tract = 100 + (i // 120) % 50 * 100
+    block = 1000 * (1 + (i // 40) % 3) + i % 40
+    return np.array([f"{fips}{c:03d}{t:06d}{b:04d}" for c, t, b in zip(county, tract, block)])
+
+def _counts(rng: np.random.Generator, rows: int, cols: int, high: int = 50) -> np.ndarray:
+    return rng.integers(0, high, size=(rows, cols))
+
+def _write(frame: pd.DataFrame, path: str, level: int = 6) -> int:
+    '''
+    write a frame as a gzipped csv like the Census files; returns the compressed size.
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.open(path, 'wt', compresslevel=level, newline='') as fp:
+        frame.to_csv(fp, index=False)
+    return os.path.getsize(path)
+
+def xwalk_frame(st: str, geocodes: np.ndarray, rng: np.random.Generator) -> pd.DataFrame:
+    '''
+    crosswalk rows for a state's blocks; the geography codes are cut from the block geocode.
+    '''
+    fips, usps, name = STATE_CODES[st]
+    cols = LODES_COLUMNS['xwalk']
+    frame = pd.DataFrame({c: '' for c in cols}, index=range(len(geocodes)))
+    g = pd.Series(geocodes)
+    frame['tabblk2020'] = g
+    frame['st'] = fips
+    frame['stusps'] = usps
+    frame['stname'] = name
+    frame['cty'] = g.str[:5]
+    frame['ctyname'] = "County " + g.str[2:5]
+    frame['trct'] = g.str[:11]
+    frame['trctname'] = "Tract " + g.str[5:11]
+    frame['bgrp'] = g.str[:12]
+    frame['bgrpname'] = "Block Group " + g.str[11]
+    frame['cbsa'] = (10000 + g.str[2:5].astype(int) * 10).astype(str)
+    frame['cbsaname'] = "CBSA " + frame['cbsa']
+    frame['zcta'] = (70000 + rng.integers(0, 500, size=len(g))).astype(str)
+    frame['zctaname'] = frame['zcta']
+    frame['blklatdd'] = np.round(30 + rng.random(len(g)) * 5, 7)
+    frame['blklondd'] = np.round(-100 + rng.random(len(g)) * 5, 7)
+    frame['createdate'] = CREATEDATE
+    return frame[cols]
+
+def generate(root: str,
+             states: list = None,
+             blocks: int = 1000,
+             years: list = None,
+             job_types: list = None,
+             segments: list = None,
+             od_links: int = 5,
+             aux: bool = True,
+             seed: int = 0) -> dict:
+    '''
+    write a synthetic LODES 8 tree under root and return a summary of it (files, bytes and rows per type).
+    :param str root: folder to write the state folders to (hint: serve it with lodes_server.serve())
+    :param list states: two letter state codes, from STATE_CODES; defaults to ['tx']
+    :param int blocks: blocks per state; rac/wac files have one row per block
+    :param list years: years to write; defaults to [2019, 2020]
+    :param list job_types: JT codes to write; defaults to ['JT00', 'JT01']
+    :param list segments: rac/wac segments to write; defaults to ['S000', 'SA01']
+    :param int od_links: work blocks per home block in od main files; od rows are about blocks * od_links
+    :param bool aux: also write od aux files, a tenth the size of main
+    :param int seed: random seed
+    '''
+    states = states or ['tx']
+    years = years or [2019, 2020]
+    job_types = job_types or ['JT00', 'JT01']
+    segments = segments or ['S000', 'SA01']
+    rng = np.random.default_rng(seed)
+    summary = {'files': 0, 'bytes': 0, 'rows': 0, 'types': {}}
+
+    def add(kind, frame, path):
+        size = _write(frame, path)
+        t = summary['types'].setdefault(kind, {'files': 0, 'bytes': 0, 'rows': 0})
+        for d in [summary, t]:
+            d['files'] += 1
+            d['bytes'] += size
+            d['rows'] += frame.shape[0]
+
+    for st in states:
+        geocodes = make_blocks(st, blocks)
+        add('cw', xwalk_frame(st, geocodes, rng), os.path.join(root, st, f"{st}_xwalk.csv.gz"))
+        for year in years:
+            for jt in job_types:
+                for seg in segments:
+                    for kind in ['rac', 'wac']:
+                        cols = LODES_COLUMNS[kind]
+                        frame = pd.DataFrame(_counts(rng, blocks, len(cols) - 2), columns=cols[1:-1])
+                        frame.insert(0, cols[0], geocodes)
+                        frame['createdate'] = CREATEDATE
+                        add(kind, frame, os.path.join(root, st, kind, f"{st}_{kind}_{seg}_{jt}_{year}.csv.gz"))
+                for part, links in [('main', od_links)] + ([('aux', max(1, od_links // 10))] if aux else []):
+                    cols = LODES_COLUMNS['od']
+                    n = blocks * links
+                    frame = pd.DataFrame(_counts(rng, n, len(cols) - 3, high=5), columns=cols[2:-1])
+                    frame.insert(0, 'w_geocode', geocodes[rng.integers(0, blocks, size=n)])
+                    frame.insert(1, 'h_geocode', np.repeat(geocodes, links))
+                    frame = frame.drop_duplicates(['w_geocode', 'h_geocode']).sort_values(['w_geocode', 'h_geocode'])
+                    frame['createdate'] = CREATEDATE
+                    add('od', frame, os.path.join(root, st, 'od', f"{st}_od_{part}_{jt}_{year}.csv.gz"))
+    return summary
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="write synthetic LODES 8 files")
+    parser.add_argument("root", help="folder to write to")
+    parser.add_argument("--states", nargs="+", default=['tx'])
+    parser.add_argument("--blocks", type=int, default=1000)
+    parser.add_argument("--years", nargs="+", type=int, default=[2019, 2020])
+    parser.add_argument("--job-types", nargs="+", default=['JT00', 'JT01'])
+    parser.add_argument("--segments", nargs="+", default=['S000', 'SA01'])
+    parser.add_argument("--od-links", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    out = generate(args.root, states=args.states, blocks=args.blocks, years=args.years, job_types=args.job_types,
+                   segments=args.segments, od_links=args.od_links, seed=args.seed)
+    print(f"wrote {out['files']} files, {out['rows']} rows, {out['bytes'] / 1e6:.1f} MB to {args.root}")
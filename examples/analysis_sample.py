@@ -74,3 +74,8 @@ m.plot(column='total',legend=True,figsize=(10,10))
 m['tract_id'] = m['geocode'].str[:11]
 m2 = m[['tract_id','geometry','total']].dissolve(by='tract_id',aggfunc='sum')
 m2.plot(column='total',legend=True,figsize=(10,10))
+
+## 5 tract-level data straight from the rollup tables, no block rows read
+#needs a database built with load_lodes_into_db(..., rollups=['trct','cty']) or build_rollups(spath)
+qt = generate_query(data_type='wac',job_type='all',year='2019',geography='tract',geocodes=['48201311500','48201311600'])
+tract_df = pull_data(qt,spath=spath,rename=True)
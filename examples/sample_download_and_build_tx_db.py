@@ -2,7 +2,7 @@
 """
 this script demonstrates how you can build a lodes spatialdb from your scratch
 the example is for texas but it would work for any state
-note: the load_up_geometries function at the end would likely require the most work for a state other than texas
+geometries come from Census TIGER/Line 2020 files (tabblock20 and tract per state, plus the national zcta520)
 """
 
 from download_and_unzip import *
@@ -20,10 +20,13 @@ fps = get_all_possible_files(save=True,
                              savename="state_dict")
 
 
-#this downloads everything in that state's lodes
+#this downloads the files the slim database needs from that state's lodes
+#drop job_types/segments to download everything
 state_fold = download_state_lodes_file(save_loc=wkd,
                           st='tx',
-                          links_dict=fps)
+                          links_dict=fps,
+                          job_types=['JT00','JT01'],
+                          segments=['S000'])
 
 #this unzips everything 
 unzip_state_lodes_file(state_fold= state_fold)
@@ -33,4 +36,6 @@ unzip_state_lodes_file(state_fold= state_fold)
 build_db(spath=spath) #be careful - this build function overwrites existing data
 #state_fold = r"C:\Users\cmg0003\Desktop\TX_Lodes_Download\tx"
 load_lodes_into_db(folder_path = state_fold,spath = spath, base_only = True)
-load_geometries_into_db(spath=spath) #note - this is basically a custom function for texas geometries - will need work for other states
+#load blocks, tracts and zctas from the TIGER/Line files saved in geom_fold; add states to the list for a multi-state db
+geom_fold = os.path.join(wkd,"tiger")
+load_geometries_into_db(spath=spath, layers=tiger_layer_specs(folder=geom_fold, states=['tx']))
@@ -3,20 +3,33 @@ import geopandas as gpd
 import numpy as np
 import sqlite3
 import os
+import re
+import json
 import warnings
 import shapely
+import time
+import metrics
+from database import LodesDatabase, read_only_uri
 
-def connect_to_od(spath:str) -> tuple[sqlite3.Connection,sqlite3.Cursor]:
+def connect_to_od(spath:str, read_only:bool = False, mmap_mb:int = 4096) -> tuple[sqlite3.Connection,sqlite3.Cursor]:
     '''
     Creates connection to LODES sqlite db
 
     :param str spath: Path to database.
+    :param bool read_only: Open the database as read-only and immutable (mode=ro&immutable=1) with memory-mapped reads,
+        so queries skip locking and read through the OS page cache. Only for a finished database that nothing writes to
+        while it is open (hint: build_database.optimize_db()).
+    :param int mmap_mb: Memory-mapped I/O size in MB for read_only connections (PRAGMA mmap_size).
     '''
     import sqlite3
     import os
     try:
         if os.path.exists(spath):
-            conn = sqlite3.connect(spath)
+            if read_only:
+                conn = sqlite3.connect(read_only_uri(spath, immutable=True), uri=True)
+                conn.execute(f"PRAGMA mmap_size = {int(mmap_mb) * 1024 * 1024};")
+            else:
+                conn = sqlite3.connect(spath)
             conn.enable_load_extension(True)
             conn.execute('SELECT load_extension("mod_spatialite")')
             crsr = conn.cursor()
@@ -25,50 +38,115 @@ def connect_to_od(spath:str) -> tuple[sqlite3.Connection,sqlite3.Cursor]:
         print("No SQLite db at given path")
         return
     
-def generate_query(data_type:str = 'wac',perspective:str = 'home',job_type:str='all',subset_type:str = '',state_code:str='tx',year:[str,int,float]='2021',geocodes:[str,list,pd.core.frame.DataFrame]=False) -> str:
+def connect_to_duckdb(threads:int = None):
+    '''
+    Creates an in-memory DuckDB connection for querying a Parquet LODES dataset
+    (hint: build_database.load_lodes_into_db(backend='parquet')). Needs duckdb.
+
+    :param int threads: Optional number of threads DuckDB may use; defaults to all cores.
+    '''
+    import duckdb
+    con = duckdb.connect()
+    if threads:
+        con.execute(f"SET threads = {int(threads)};")
+    return con
+
+class LodesQuery(str):
+    '''
+    SQL from generate_query(), carrying the values bound to its ? placeholders in .params. It prints and passes around
+    like the plain SQL string; pull_data() runs it with its parameters.
+    '''
+    def __new__(cls, sql:str, params:tuple = ()):
+        query = super().__new__(cls, sql)
+        query.params = tuple(params)
+        return query
+
+#geocode sets up to this size are bound one ? apiece; larger ones as a single JSON array that SQLite reads with json_each
+GEOCODE_BIND_LIMIT = 250
+
+def _geocode_list(geocodes:[str,list,pd.core.frame.DataFrame]) -> list:
+    '''
+    geocodes passed to generate_query() or pull_geometries() as a list of unique strings. A string that starts with '('
+    is a literal SQL list and comes back as None. Prints an error and raises ValueError for anything else.
+    '''
+    if type(geocodes) == pd.core.frame.DataFrame:
+        try:
+            codes = geocodes["geocode"].unique()
+        except:
+            print("Error - must name the geocode column 'geocode'")
+            raise ValueError("no geocode column")
+    elif isinstance(geocodes, list):
+        codes = geocodes
+    elif isinstance(geocodes, str):
+        if geocodes[0] == '(':
+            return None
+        codes = [geocodes]
+    else:
+        print("Error: Geocodes must be a string, list, or pandas DataFrame.")
+        raise ValueError("bad geocodes")
+    #an empty set matches nothing, as the old ('') list did
+    return list(dict.fromkeys(str(g) for g in codes)) or ['']
+
+def _in_geocodes(column:str, codes:list, duckdb:bool = False) -> tuple:
+    '''
+    "column IN (...)" for a set of geocodes and the parameters it binds, so large sets don't become megabytes of SQL
+    to parse. Up to GEOCODE_BIND_LIMIT codes get a placeholder each; more are bound as one JSON array and looked up
+    with IN (SELECT value FROM json_each(?)), which SQLite still answers with the column's index. DuckDB always gets
+    placeholders, which it types to match the column.
+    '''
+    if duckdb or (len(codes) <= GEOCODE_BIND_LIMIT):
+        return f"{column} IN ({', '.join(['?'] * len(codes))})", tuple(codes)
+    return f"{column} IN (SELECT value FROM json_each(?))", (json.dumps(codes),)
+
+def generate_query(data_type:str = 'wac',perspective:str = 'home',job_type:[str,list]='all',subset_type:[str,list] = '',state_code:str='tx',year:[str,int,float,list]='2021',geocodes:[str,list,pd.core.frame.DataFrame]=False,
+    layout:str='per_file',od_part:str='main',clustered:bool=False,geography:str='block',parquet_root:str=None) -> str:
     '''
     Generates query to pull data from LODES database. 
 
     :param str data_type: Select 'wac','rac', or 'od'.
     :param str perspective: Select 'home' or 'work'. This is only relevant for o-d, ignored in wac or rac
-    :param str job_type: Select 'all' or 'primary'. This is difference between JT00 and JT01
-    :param str subset_type: Option to select for a specific OD-pattern for a subset of jobs, i.e. SA01 for workers under age 29
+    :param str,list job_type: Select 'all' or 'primary'. This is difference between JT00 and JT01. A list is allowed with layout='consolidated'.
+    :param str,list subset_type: Option to select for a specific OD-pattern for a subset of jobs, i.e. SA01 for workers under age 29. A list is allowed with layout='consolidated'.
     :param str state_code: Two digit state code name, defaults to 'tx'. Useful if you have multiple states in one db. 
-    :param str,int,float year: Year of data to use.
-    :param str,list,pd.DataFrame geocodes: Pass geocodes to use in query.
+    :param str,int,float,list year: Year of data to use. A list of years is allowed with layout='consolidated'.
+    :param str,list,pd.DataFrame geocodes: Pass geocodes to use in query. They are bound as parameters (see _in_geocodes());
+        a string starting with '(' is taken as a literal SQL list instead.
+    :param str layout: Layout the database was built with (see build_database.load_lodes_into_db()). 'per_file' queries one table
+        per year/job type/segment; 'consolidated' queries the state's od/rac/wac table, so several years, job types or segments are one indexed scan.
+    :param str od_part: 'main' or 'aux' od file; only used with layout='consolidated'.
+    :param bool clustered: True if the database was built with clustered=True. The per-file query then leaves the
+        lookup to the planner instead of forcing an index the table's primary key replaced.
+    :param str geography: 'block', or an area level to read the pre-aggregated rollup tables (see build_database.build_rollups()):
+        'bgrp'/'block_group', 'trct'/'tract', 'cty'/'county', 'zcta' or 'cbsa'. Geocodes are then that level's codes,
+        e.g. 11 digit tract GEOIDs, and come back in the geocode columns.
+    :param str parquet_root: Folder of a Parquet dataset (see build_database.load_lodes_into_db(backend='parquet')). When passed,
+        the query reads it with DuckDB instead of the SQLite tables, filtering on the hive partitions so only the matching
+        year/job type/segment files are scanned; lists of years, job types and segments are allowed. Run it with pull_data().
+
+    Returns a LodesQuery: the SQL, with the geocodes to bind in its .params. Run it with pull_data().
     '''
 
     #part 1 - process inputs 
     #process year
     try:
-        year = str(year)[:4]
+        years = [str(y)[:4] for y in (year if isinstance(year, (list, tuple)) else [year])]
+        year = years[0]
     except:
         print(f"Error with year '{year}'")
         return 
     
-    #process geocodes (blocks) 
-
-     #1 - check if its dataframe
-    if type(geocodes) == pd.core.frame.DataFrame:
-        try: 
-            gcs = "('" + "', '".join(geocodes["geocode"].unique()) + "')"
-        except:
-            print("Error - must name the geocode column 'geocode'")
-            return
+    #process geography - rollup tables are suffixed with the crosswalk level
+    levels = {'block': '', 'bgrp': 'bgrp', 'block_group': 'bgrp', 'trct': 'trct', 'tract': 'trct',
+              'cty': 'cty', 'county': 'cty', 'zcta': 'zcta', 'cbsa': 'cbsa'}
+    if geography not in levels:
+        print(f"Error: '{geography}' passed as geography.\nMust pass one of {list(levels)}")
+        return
+    suffix = f"_{levels[geography]}" if levels[geography] else ''
 
-     #2 - check if its list
-    elif isinstance(geocodes, list):
-        gcs = "('" + "', '".join(geocodes) + "')"
-    
-     #3 - check if its string
-    elif isinstance(geocodes, str):
-        if geocodes[0] == '(':
-            gcs = geocodes
-        else:
-            gcs = f"('{geocodes}')"
-     #4 - spit it out if its nothing    
-    else:
-        print("Error: Geocodes must be a string, list, or pandas DataFrame.")
+    #process geocodes (blocks) - a dataframe, list or string
+    try:
+        codes = _geocode_list(geocodes)
+    except ValueError:
         return
 
     #reject perspective if not 'home' or 'work'
@@ -78,21 +156,27 @@ def generate_query(data_type:str = 'wac',perspective:str = 'home',job_type:str='
             return
 
     #process job_type - corresponds to JT in LODES documentation 
-    if job_type == 'all':
-        jt = 'JT00'
-    elif job_type == 'primary':
-        jt = 'JT01'
-    else:
-        print(f'Warning: Building function with {job_type} as job_type')
-        jt = job_type
+    jts = []
+    for j in (job_type if isinstance(job_type, (list, tuple)) else [job_type]):
+        if j == 'all':
+            jts.append('JT00')
+        elif j == 'primary':
+            jts.append('JT01')
+        else:
+            print(f'Warning: Building function with {j} as job_type')
+            jts.append(j)
+    jt = jts[0]
 
     #process S-subset - segment of workforce in LODES documentation
         #defaults to all
-    if subset_type == '':
-        st = 'S000_'
-    else:
-        print(f'Warning: Building function with {subset_type} as subset_type')
-        st = f"{subset_type}_"
+    segs = []
+    for x in (subset_type if isinstance(subset_type, (list, tuple)) else [subset_type]):
+        if x == '':
+            segs.append('S000')
+        else:
+            print(f'Warning: Building function with {x} as subset_type')
+            segs.append(x)
+    st = f"{segs[0]}_"
     
     #based on data type get the column that will match in the table
     if data_type == 'wac':
@@ -105,6 +189,38 @@ def generate_query(data_type:str = 'wac',perspective:str = 'home',job_type:str='
         geo_name = 'w_geocode'
     else:
         print("Error: Invalid data_type")
+        return
+
+    if codes is None:
+        geo_cond, params = f"{geo_name} IN {geocodes}", ()
+    else:
+        geo_cond, params = _in_geocodes(geo_name, codes, duckdb=parquet_root is not None)
+
+    #consolidated tables and the parquet dataset hold every year/job type/segment, so filter on their columns
+    if (layout == 'consolidated') or (parquet_root is not None):
+        if data_type not in ['od','wac','rac']:
+            print("Error: Could not create a coherent table name")
+            return
+        conds = [f"year IN ({', '.join(years)})",
+                 "jt IN ('" + "', '".join(jts) + "')"]
+        if data_type == 'od':
+            conds.append(f"part = '{od_part}'")
+        else:
+            conds.append("segment IN ('" + "', '".join(segs) + "')")
+        conds.append(geo_cond)
+        if parquet_root is not None:
+            if suffix:
+                print("Error: The parquet dataset has block-level data only")
+                return
+            files = os.path.join(parquet_root, f"state={state_code}", f"type={data_type}", "**", "*.parquet").replace("'", "''")
+            return LodesQuery(f"""SELECT * EXCLUDE (state, type) FROM read_parquet('{files}', hive_partitioning = true) """
+                              f"""WHERE {' AND '.join(conds)};""", params)
+        query = f"""SELECT * from {state_code}_{data_type}{suffix} WHERE {' AND '.join(conds)};"""
+        return LodesQuery(query, params)
+
+    if (len(years) > 1) or (len(jts) > 1) or (len(segs) > 1):
+        print("Error: Multiple years, job types or subsets need a database built with layout='consolidated'")
+        return
 
     #build a table name
     if data_type == 'od':
@@ -116,7 +232,7 @@ def generate_query(data_type:str = 'wac',perspective:str = 'home',job_type:str='
         print("Error: Could not create a coherent table name")
         return
     
-    table_name = f"{state_code}_{data_type}_{table_spec}_{year}"
+    table_name = f"{state_code}_{data_type}_{table_spec}_{year}{suffix}"
     
     #build an index name
     if data_type == 'od':
@@ -125,12 +241,16 @@ def generate_query(data_type:str = 'wac',perspective:str = 'home',job_type:str='
         index_col = f"{table_name}_main_index"
 
     #build a query
-    query = f"""SELECT * from {table_name} indexed by {index_col} WHERE {geo_name} IN {gcs};"""
-    return query
+    if clustered:
+        query = f"""SELECT * from {table_name} WHERE {geo_cond};"""
+    else:
+        query = f"""SELECT * from {table_name} indexed by {index_col} WHERE {geo_cond};"""
+    return LodesQuery(query, params)
 
 def retype(df:pd.core.frame.DataFrame = None) -> pd.core.frame.DataFrame:
     '''
     Renames columns and casts the type as float for the output of LODES pull function. 
+    Columns that are already numeric (databases built with typed columns) are left as they are.
     :param pd.DataFrame df: dataframe output of pull_data function
     '''
 
@@ -204,26 +324,64 @@ def retype(df:pd.core.frame.DataFrame = None) -> pd.core.frame.DataFrame:
 
     #2 make them all numeric
     for x in df_new.columns:
-        if 'geocode' not in x:
+        if ('geocode' not in x) and (not pd.api.types.is_numeric_dtype(df_new[x])):
             df_new[x] = pd.to_numeric(df_new.loc[:, x], errors="coerce")
     
     df_new.fillna(0,inplace=True)
 
     return df_new 
 
-def pull_data(query:str='',crsr:sqlite3.Cursor=False,spath:str=False,rename:bool=False):
+def pad_geocodes(df:pd.core.frame.DataFrame = None, width:int = 15) -> pd.core.frame.DataFrame:
+    '''
+    Turns geocode columns stored as integers (databases built with geocode_type='integer') back into fixed-width strings,
+    restoring leading zeros. Text geocodes are left as they are.
+    :param pd.DataFrame df: dataframe with geocode columns
+    :param int width: Number of digits in the geocode; 15 for blocks.
+    '''
+    for x in df.columns:
+        if ('geocode' in x) and pd.api.types.is_integer_dtype(df[x]):
+            df[x] = df[x].astype(str).str.zfill(width)
+    return df
+
+def pull_data(query:str='',crsr:sqlite3.Cursor=False,spath:str=False,rename:bool=False,db:LodesDatabase=None):
     '''
     Pulls data from LODES database based on the output of generate query function. 
 
-    :param str query: Output of generate_query function.
+    :param str query: Output of generate_query function. Its bound geocodes (query.params) are passed along with it.
     :param sqlite3.Cursor crsr: If you've already connected and have an active cursor, you can use this. Otherwise, it will use spath.
     :param str spath: Path to the location of the LODES database.
     :param bool retype: If true, the data will get retyped using the retype function. If false, it won't. Default is false.
+    :param LodesDatabase db: Shared connections to borrow one from, so repeated pulls skip connecting and loading spatialite.
+
+    Queries on a Parquet dataset (generate_query(parquet_root=...)) run in DuckDB, on crsr if it is a DuckDB connection
+    (hint: connect_to_duckdb()) or a new in-memory one, and are fetched straight into pandas.
     '''
     import sqlite3
     import pandas as pd
-    
+
+    if 'read_parquet(' in query:
+        con = crsr if crsr is not False else connect_to_duckdb()
+        try:
+            t0 = time.perf_counter()
+            params = getattr(query, 'params', ())
+            df = (con.execute(query, list(params)) if params else con.execute(query)).df()
+            metrics.record_query('pull_data', time.perf_counter() - t0, rows=df.shape[0], sql_bytes=len(query),
+                                 backend='duckdb')
+        except Exception as e:
+            print(f"Could not get data. ({e})")
+            return
+        finally:
+            if crsr is False:
+                con.close()
+        df = pad_geocodes(df)
+        return retype(df) if rename == True else df
+
+    if db is not None:
+        with db.connection() as conn:
+            return pull_data(query=query, crsr=conn.cursor(), rename=rename)
+
     #generate connection
+    owned = None
     try:
         if (spath == False) & (crsr == False):
             print("Must pass a DB path or a cursor to existing DB.")
@@ -231,23 +389,32 @@ def pull_data(query:str='',crsr:sqlite3.Cursor=False,spath:str=False,rename:bool
         elif (spath == False) and (crsr != False):
             crsr = crsr
         elif (type(spath) == str):
-            _,crsr = connect_to_od(spath)
+            owned,crsr = connect_to_od(spath)
         else: 
             crsr = crsr
     except:
         print("Could not generate a cursor.")
         return
+
+    #a connection opened here is closed once the pull is done
+    if owned is not None:
+        try:
+            return pull_data(query=query, crsr=crsr, rename=rename)
+        finally:
+            owned.close()
     
     #pull in the data
     try:  
-        new_cur = crsr.execute(query)
+        t0 = time.perf_counter()
+        new_cur = crsr.execute(query, getattr(query, 'params', ()))
         recs = new_cur.fetchall()
         cols = list(map(lambda x: x[0], new_cur.description))
+        metrics.record_query('pull_data', time.perf_counter() - t0, rows=len(recs), sql_bytes=len(query))
 
     except:
         print("Could not get data.")
         try: 
-            tn = query.split("from ")[-1].split(" indexed")[0]
+            tn = re.search(r"from\s+(\w+)", query, re.IGNORECASE).group(1)
             ct = crsr.execute(f"SELECT count(*) FROM sqlite_master WHERE type='table' AND name='{tn}';").fetchall()[0][0]
             if ct < 1:
                 print("Table does not exist in database. Check query parameters")
@@ -258,6 +425,7 @@ def pull_data(query:str='',crsr:sqlite3.Cursor=False,spath:str=False,rename:bool
     #build the dataframe 
     try:
         df = pd.DataFrame.from_records(recs, columns=cols)
+        df = pad_geocodes(df)
         if rename == True:
             df_out = retype(df)
         elif rename == False: 
@@ -279,7 +447,8 @@ def transform_to_wkt(gdf:gpd.geodataframe.GeoDataFrame = None, out_crs: int = 43
     wkt = gdf.apply(lambda x: shapely.wkt.dumps(x.geometry), axis=1)
     return wkt
 
-def id_intersections(wkt:str,crsr:sqlite3.Cursor=False, spath:str=False,centroid:bool=False,return_geom:bool=False,geom_type:bool = 'blocks',year:[int,str,float]="2020"):
+def id_intersections(wkt:str,crsr:sqlite3.Cursor=False, spath:str=False,centroid:bool=False,return_geom:bool=False,geom_type:bool = 'blocks',year:[int,str,float]="2020",
+    db:LodesDatabase=None):
     """
     Return geometries that intersect for a given polygon.
     :param str wkt: Polygon to query against geometries in Spatialite db in CRS EPSG 4326.
@@ -289,10 +458,17 @@ def id_intersections(wkt:str,crsr:sqlite3.Cursor=False, spath:str=False,centroid
     :param bool return_geom: If true, returns geom of specified table. 
     :param str geom_type: Defaults to blocks. Can pass other things though to get zctas, etc.
     :param str year: Year to query. Defaults to 2020.
+    :param LodesDatabase db: Shared connections to borrow one from instead of connecting to spath.
     """
     import pandas as pd
     import geopandas as gpd
 
+    if db is not None:
+        with db.connection() as conn:
+            return id_intersections(wkt, crsr=conn.cursor(), centroid=centroid, return_geom=return_geom,
+                                    geom_type=geom_type, year=year)
+
+    owned = None
     try:
         if (spath == False) & (crsr == False):
             print("Must pass a DB path or a cursor to existing DB.")
@@ -300,12 +476,19 @@ def id_intersections(wkt:str,crsr:sqlite3.Cursor=False, spath:str=False,centroid
         elif (spath == False) and (crsr != False):
             crsr = crsr
         elif (type(spath) == str):
-            _,crsr = connect_to_od(spath)
+            owned,crsr = connect_to_od(spath)
         else: 
             crsr = crsr
     except:
         print("Could not generate a cursor.")
         return
+
+    #a connection opened here is closed once the pull is done
+    if owned is not None:
+        try:
+            return id_intersections(wkt, crsr=crsr, centroid=centroid, return_geom=return_geom, geom_type=geom_type, year=year)
+        finally:
+            owned.close()
     
     ##build up the query
     #handle if you want geom returned
@@ -337,17 +520,19 @@ def id_intersections(wkt:str,crsr:sqlite3.Cursor=False, spath:str=False,centroid
     #design query
     sq = f"""SELECT {geocode_q} as geocode{wkt_q}
             FROM {geom_type_q}_{year}_geom
-            WHERE ST_Intersects({geom_q},ST_GeomFromText('{wkt}')) = 1
+            WHERE ST_Intersects({geom_q},ST_GeomFromText(?)) = 1
             AND ROWID IN (
                 SELECT ROWID
                 FROM SpatialIndex
                 WHERE f_table_name = '{geom_type_q}_{str(year)[:4]}_geom'
                 and f_geometry_column = 'geom'
-                AND search_frame = ST_GeomFromText('{wkt}'))"""
+                AND search_frame = ST_GeomFromText(?))"""
     #run spatial query
-    new_cur = crsr.execute(sq)
+    t0 = time.perf_counter()
+    new_cur = crsr.execute(sq, (wkt, wkt))
     recs = new_cur.fetchall()
     cols = list(map(lambda x: x[0], new_cur.description))
+    metrics.record_query('id_intersections', time.perf_counter() - t0, rows=len(recs), sql_bytes=len(sq))
 
     #get results into dataframe
     try:
@@ -360,7 +545,8 @@ def id_intersections(wkt:str,crsr:sqlite3.Cursor=False, spath:str=False,centroid
         print("Could not build dataframe")
         return
 
-def pull_geometries(geocodes:[str,pd.core.frame.DataFrame,list], spath:str=False, crsr:sqlite3.Connection=False, geom_type:str = 'blocks',year:[int,str,float]="2020"):
+def pull_geometries(geocodes:[str,pd.core.frame.DataFrame,list], spath:str=False, crsr:sqlite3.Connection=False, geom_type:str = 'blocks',year:[int,str,float]="2020",
+    db:LodesDatabase=None):
     """
     Utility to return geometries for a list of geocodes or a dataframe.
     :param str or list or DataFrame geocodes: Pass geocodes to use in query.
@@ -368,7 +554,13 @@ def pull_geometries(geocodes:[str,pd.core.frame.DataFrame,list], spath:str=False
     :param str crsr: If crsr passed, you can bypass new connection. Can also pass a crsr.
     :param str geom_type: Defaults to blocks. Can pass other things though to get zctas, etc.
     :param str year: Year to query. Defaults to 2020.
+    :param LodesDatabase db: Shared connections to borrow one from instead of connecting to spath.
     """
+    if db is not None:
+        with db.connection() as conn:
+            return pull_geometries(geocodes, crsr=conn.cursor(), geom_type=geom_type, year=year)
+
+    owned = None
     try:
         if (spath == False) & (crsr == False):
             print("Must pass a DB path or a cursor to existing DB.")
@@ -376,12 +568,19 @@ def pull_geometries(geocodes:[str,pd.core.frame.DataFrame,list], spath:str=False
         elif (spath == False) and (crsr != False):
             crsr = crsr
         elif (type(spath) == str):
-            _,crsr = connect_to_od(spath)
+            owned,crsr = connect_to_od(spath)
         else: 
             crsr = crsr
     except:
         print("Could not generate a cursor.")
         return
+
+    #a connection opened here is closed once the pull is done
+    if owned is not None:
+        try:
+            return pull_geometries(geocodes, crsr=crsr, geom_type=geom_type, year=year)
+        finally:
+            owned.close()
     
     if geom_type == 'blocks':
         geom_type_q ='blocks'
@@ -396,41 +595,30 @@ def pull_geometries(geocodes:[str,pd.core.frame.DataFrame,list], spath:str=False
         print(f"{geom_type} is not a valid geom_type")
         return
 
-    #process geocodes
-    #we need the geocodes as a string list for the query
-    #check if its dataframe
-    if geocodes == 'all':
+    #process geocodes - bound as parameters, see _in_geocodes()
+    params = ()
+    if isinstance(geocodes, str) and (geocodes == 'all'):
         gcs = ''
-    elif type(geocodes) == pd.core.frame.DataFrame: 
+    else:
         try:
-            gcs = f"WHERE {geocode_q} in" + "('" + "', '".join(geocodes["geocode"].unique()) + "')"
-        except:
-            print("Error - must have geocode as a column name!")
+            codes = _geocode_list(geocodes)
+        except ValueError:
             return
-    #check if its list
-    elif isinstance(geocodes, list):
-        gcs = f"WHERE {geocode_q} in" + "('" + "', '".join(geocodes) + "')"
-    #check if its string
-    elif isinstance(geocodes, str):
-        if geocodes[0] == '(':
-            gcs = geocodes
-            gcs = f"WHERE {geocode_q} in" + gcs
+        if codes is None:
+            gcs = f"WHERE {geocode_q} in" + geocodes
         else:
-            gcs = f"('{geocodes}')"
-            gcs = f"WHERE {geocode_q} in" + gcs
-    else:
-        print("Warning: Geocodes must be a string, list, or pandas DataFrame.")
-        gcs = geocodes
-        return
+            cond, params = _in_geocodes(geocode_q, codes)
+            gcs = f"WHERE {cond}"
 
-    
     #design query
     sq = f"""SELECT {geocode_q} as geocode, AsText(geom) as wkt_geom 
             FROM {geom_type_q}_{year}_geom indexed by {geom_type_q}_index {gcs}"""
     # run spatial query
-    new_cur = crsr.execute(sq)
+    t0 = time.perf_counter()
+    new_cur = crsr.execute(sq, params)
     recs = new_cur.fetchall()
     cols = list(map(lambda x: x[0], new_cur.description))
+    metrics.record_query('pull_geometries', time.perf_counter() - t0, rows=len(recs), sql_bytes=len(sq))
     
     try:
         df = pd.DataFrame.from_records(recs, columns=cols)
@@ -2,12 +2,542 @@
 import glob
 import os 
 import re 
+import queue
 import sqlite3
 import os
 import pandas as pd
 import geopandas as gpd
 import time
-import shapely
+from contextlib import contextmanager, nullcontext
+from database import LodesDatabase, connect
+import metrics
+
+def _file_type(file_path: str) -> str:
+    """
+    Classify a LODES file as 'rac', 'wac', 'xwalk' or 'od' from its name; None if it is none of these.
+    :param str file_path: Path or url of the file.
+    """
+    name = _table_name(file_path)
+    if 'rac' in name:
+        return 'rac'
+    elif 'wac' in name:
+        return 'wac'
+    elif 'xwalk' in name:
+        return 'xwalk'
+    elif 'od' in name:
+        return 'od'
+    return None
+
+def _table_name(file_path: str) -> str:
+    """
+    Name of the table a LODES file is loaded into, i.e. the file name without .csv/.csv.gz.
+    :param str file_path: Path or url of the file.
+    """
+    name = re.split(r"[\\/]", file_path)[-1]
+    for ext in ['.gz', '.csv']:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return name
+
+def _index_specs(file_type: str, table_name: str, layout: str = 'per_file', covering: bool = False) -> list:
+    """
+    Indexes each kind of LODES table gets, as a list of (index name, columns).
+    Consolidated tables get composite indexes that lead with the partition columns.
+    :param str file_type: 'rac', 'wac', 'od' or 'xwalk'.
+    :param str table_name: Name of the table.
+    :param str layout: 'per_file' or 'consolidated'.
+    :param bool covering: If True, od/rac/wac indexes also carry the total (S000 for od, C000 for rac/wac), so queries
+        that only need geocode and total jobs are answered from the index without touching the table.
+    """
+    if (layout == 'consolidated') and (file_type in ['rac','wac','od']):
+        if file_type == 'rac':
+            specs = [(f"{table_name}_year_jt_segment_hgeocode_index", "year, jt, segment, h_geocode")]
+        elif file_type == 'wac':
+            specs = [(f"{table_name}_year_jt_segment_wgeocode_index", "year, jt, segment, w_geocode")]
+        else:
+            specs = [(f"{table_name}_year_jt_part_hgeocode_index", "year, jt, part, h_geocode"),
+                     (f"{table_name}_year_jt_part_wgeocode_index", "year, jt, part, w_geocode")]
+    elif file_type == 'rac':
+        specs = [(f"{table_name}_main_index", "h_geocode")]
+    elif file_type == 'wac':
+        specs = [(f"{table_name}_main_index", "w_geocode")]
+    elif file_type == 'od':
+        specs = [(f"{table_name}_od_hgeocode_index", "h_geocode"),
+                 (f"{table_name}_od_wgeocode_index", "w_geocode")]
+    elif file_type == 'xwalk':
+        return [(f"{table_name}_tabblk2020_index", "tabblk2020")]
+    else:
+        return []
+    if covering:
+        total = "S000" if file_type == 'od' else "C000"
+        specs = [(name, f"{cols}, {total}") for name, cols in specs]
+    return specs
+
+def _primary_key(file_type: str, layout: str = 'per_file') -> list:
+    """
+    Columns a clustered (WITHOUT ROWID) LODES table is keyed on: the geocode, led by the partition columns
+    for consolidated tables. od tables are keyed on home then work geocode.
+    :param str file_type: 'rac', 'wac', 'od' or 'xwalk'.
+    :param str layout: 'per_file' or 'consolidated'.
+    """
+    keys = {'rac': ['h_geocode'], 'wac': ['w_geocode'], 'od': ['h_geocode', 'w_geocode'], 'xwalk': ['tabblk2020']}
+    if file_type not in keys:
+        return None
+    if (layout == 'consolidated') and (file_type != 'xwalk'):
+        return ['year', 'jt', 'part' if file_type == 'od' else 'segment'] + keys[file_type]
+    return keys[file_type]
+
+def _wanted_indexes(file_type: str, table_name: str, layout: str = 'per_file', covering: bool = False,
+    primary_key: list = None) -> list:
+    """
+    _index_specs() less any index a clustered table's primary key already provides.
+    """
+    plain = _index_specs(file_type, table_name, layout)
+    specs = _index_specs(file_type, table_name, layout, covering=covering)
+    if not primary_key:
+        return specs
+    keep = []
+    for (name, cols), spec in zip(plain, specs):
+        cols = [c.strip() for c in cols.split(",")]
+        if cols != primary_key[:len(cols)]:
+            keep.append(spec)
+    return keep
+
+def _create_indexes(cnx: sqlite3.Connection, tname: str, specs: list, rebuild: bool = False):
+    """
+    Create a table's indexes. With rebuild, existing indexes of the same name are dropped first (e.g. to add covering columns).
+    """
+    for index_name, index_cols in specs:
+        if rebuild:
+            cnx.execute(f"DROP INDEX IF EXISTS {index_name}")
+        cnx.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {tname} ({index_cols})")
+
+def _lodes_tables(cnx: sqlite3.Connection, schema: str = 'main') -> list:
+    """
+    LODES tables in a database, as (table name, file type, layout, primary key or None). schema picks an attached database.
+    """
+    out = []
+    rows = cnx.execute(f"SELECT name, sql FROM {schema}.sqlite_master WHERE type='table';").fetchall()
+    for name, sql in rows:
+        m = re.fullmatch(r"[a-z]{2}_(od|rac|wac)", name)
+        if m:
+            file_type, layout = m.group(1), 'consolidated'
+        elif re.fullmatch(r"[a-z]{2}_(od_(main|aux)|rac_\w+|wac_\w+)_JT\d\d_\d{4}|[a-z]{2}_xwalk", name):
+            file_type, layout = _file_type(name), 'per_file'
+        else:
+            continue
+        primary_key = None
+        if 'WITHOUT ROWID' in (sql or '').upper():
+            info = cnx.execute(f"PRAGMA {schema}.table_info({name});").fetchall()
+            primary_key = [r[1] for r in sorted(info, key=lambda r: r[5]) if r[5] > 0]
+        out.append((name, file_type, layout, primary_key))
+    return out
+
+def drop_indexes(spath: str = None, tables: list = None, db: LodesDatabase = None):
+    """
+    Drop the LODES indexes so a large load doesn't maintain them row by row; build_indexes() puts them back.
+    :param str spath: Path to the Sqlite database.
+    :param list tables: Optional table names to limit it to; defaults to every LODES table.
+    :param LodesDatabase db: Optional shared connections to use instead of opening one on spath.
+    """
+    with connect(spath, db) as cnx:
+        for name, file_type, layout, _ in _lodes_tables(cnx):
+            if (tables is None) or (name in tables):
+                for index_name, _ in _index_specs(file_type, name, layout):
+                    cnx.execute(f"DROP INDEX IF EXISTS {index_name}")
+        cnx.commit()
+
+def build_indexes(spath: str = None, tables: list = None, covering: bool = False, cache_mb: int = 512,
+    analysis_limit: int = 1000, db: LodesDatabase = None) -> dict:
+    """
+    Build the indexes of every LODES table in one pass, after the data is loaded (hint: load_lodes_into_db(indexes='deferred')
+    does this for you). Sorting a full table once is much cheaper than keeping its indexes up to date through millions
+    of inserts. Existing indexes are rebuilt, so this also switches a database to or from covering indexes.
+    Clustered (WITHOUT ROWID) tables skip any index their primary key already is. The indexed tables are then
+    analyzed (see analyze_tables()) so queries use the new indexes. The time per table is reported to metrics.
+    Returns a dictionary of table name to seconds spent indexing it.
+
+    :param str spath: Path to the Sqlite database.
+    :param list tables: Optional table names to limit it to; defaults to every LODES table.
+    :param bool covering: If True, od/rac/wac indexes also carry the total jobs column (see _index_specs()).
+    :param int cache_mb: Page cache to give the sorts, in MB.
+    :param int analysis_limit: Rows ANALYZE samples per index, see analyze_tables().
+    :param LodesDatabase db: Optional shared connections to use instead of opening one on spath.
+    """
+    timings = {}
+    with metrics.stage('index', covering=covering) as m, connect(spath, db) as cnx:
+        with load_pragmas(cnx, cache_mb=cache_mb):
+            for name, file_type, layout, primary_key in _lodes_tables(cnx):
+                if (tables is not None) and (name not in tables):
+                    continue
+                t0 = time.perf_counter()
+                _create_indexes(cnx, name, _wanted_indexes(file_type, name, layout, covering, primary_key), rebuild=True)
+                cnx.commit()
+                timings[name] = time.perf_counter() - t0
+                metrics.record_file('index', name, timings[name])
+        m['files'] = len(timings)
+    analyze_tables(spath, tables=list(timings), analysis_limit=analysis_limit, db=db)
+    return timings
+
+def analyze_tables(spath: str = None, tables: list = None, analysis_limit: int = 1000, db: LodesDatabase = None):
+    """
+    Run ANALYZE on LODES tables so the query planner has statistics to pick indexes with. Without them it can pick
+    the wrong one, e.g. search a consolidated clustered od table's (year, jt, part, h_geocode, w_geocode) primary key
+    for a work geocode lookup rather than its w_geocode index. build_indexes() and clustered loads do this for you;
+    optimize_db() gathers full statistics for a finished database.
+
+    :param str spath: Path to the Sqlite database.
+    :param list tables: Optional table names to limit it to; defaults to every LODES table.
+    :param int analysis_limit: Rows sampled per index (PRAGMA analysis_limit), which keeps it quick on large tables;
+        None reads every row.
+    :param LodesDatabase db: Optional shared connections to use instead of opening one on spath.
+    """
+    t0 = time.perf_counter()
+    with connect(spath, db) as cnx:
+        names = [t[0] for t in _lodes_tables(cnx) if (tables is None) or (t[0] in tables)]
+        previous = cnx.execute("PRAGMA analysis_limit;").fetchone()[0]
+        cnx.execute(f"PRAGMA analysis_limit = {int(analysis_limit or 0)};")
+        try:
+            for name in names:
+                cnx.execute(f"ANALYZE {name};")
+            cnx.commit()
+        finally:
+            cnx.execute(f"PRAGMA analysis_limit = {previous};")
+    metrics.record_file('index', 'analyze', time.perf_counter() - t0, tables=len(names))
+
+#crosswalk columns LODES blocks can be rolled up to, smallest first
+ROLLUP_LEVELS = ['bgrp', 'trct', 'cty', 'zcta', 'cbsa']
+#digits of the block geocode that make up each level's code; zcta and cbsa don't nest in blocks
+_ROLLUP_PREFIX = {'bgrp': 12, 'trct': 11, 'cty': 5}
+
+def _rollup_code(alias: str, geo_col: str, level: str) -> str:
+    """
+    SQL for a block's code at a rollup level, from the crosswalk row joined as alias. Blocks the state's crosswalk
+    doesn't have (the out of state home blocks of od aux files, or blocks missing from the crosswalk) get their code
+    cut from the geocode for block group, tract and county, and their 2 digit state FIPS for zcta and cbsa.
+    """
+    #printf pads integer geocodes (geocode_type='integer') back to 15 digits
+    padded = f"printf('%015d', t.{geo_col})"
+    return f"COALESCE({alias}.{level}, substr({padded}, 1, {_ROLLUP_PREFIX.get(level, 2)}))"
+
+
+def rollup_table_name(table_name: str, level: str) -> str:
+    """
+    Name of a table's rollup, e.g. tx_wac_S000_JT00_2019_trct or tx_wac_cty.
+    """
+    return f"{table_name}_{level}"
+
+def _rollup_sql(table_name: str, file_type: str, level: str, xwalk: str, columns: list) -> str:
+    """
+    CREATE TABLE ... AS SELECT that sums a LODES table's counts to a crosswalk level. Geocode columns keep their names
+    but hold the level's code; year and, for consolidated tables, jt and segment/part are kept as grouping columns.
+    The crosswalk is LEFT JOINed so no rows are lost; blocks it doesn't cover get a fallback code (see _rollup_code()).
+    """
+    keys = [c for c in ['year', 'jt', 'segment', 'part'] if c in columns]
+    counts = [c for c in columns if c not in keys + ['w_geocode', 'h_geocode', 'createdate']]
+    if file_type == 'od':
+        group = [_rollup_code('xh', 'h_geocode', level), _rollup_code('xw', 'w_geocode', level)]
+        geo = [f"{group[0]} AS h_geocode", f"{group[1]} AS w_geocode"]
+        joins = (f"LEFT JOIN {xwalk} xh ON xh.tabblk2020 = t.h_geocode "
+                 f"LEFT JOIN {xwalk} xw ON xw.tabblk2020 = t.w_geocode")
+    else:
+        geo_col = 'h_geocode' if file_type == 'rac' else 'w_geocode'
+        group = [_rollup_code('x', geo_col, level)]
+        geo = [f"{group[0]} AS {geo_col}"]
+        joins = f"LEFT JOIN {xwalk} x ON x.tabblk2020 = t.{geo_col}"
+    select = [f"t.{c} AS {c}" for c in keys] + geo + [f"SUM(t.{c}) AS {c}" for c in counts]
+    return (f"CREATE TABLE {rollup_table_name(table_name, level)} AS SELECT {', '.join(select)} "
+            f"FROM {table_name} t {joins} GROUP BY {', '.join([f't.{c}' for c in keys] + group)};")
+
+def build_rollups(spath: str = None, levels: list = None, tables: list = None, db: LodesDatabase = None) -> dict:
+    """
+    Materialize od/rac/wac totals at block group, tract, county, ZCTA and CBSA level from the state's crosswalk table
+    (e.g. tx_xwalk), so area-level pulls (hint: analysis.generate_query(geography=...)) never read block rows.
+    Each rollup is a table named by rollup_table_name() with the same columns and indexes as its source table;
+    od rollups are flows between areas. Every row is kept: blocks missing from the state's crosswalk, such as the out of
+    state home blocks in od aux files, are rolled up to the block group, tract or county cut from their geocode, or to
+    their 2 digit state FIPS for zcta and cbsa. Existing rollups are rebuilt. The time per table is reported to metrics.
+    Returns a dictionary of rollup table name to seconds spent building it.
+
+    :param str spath: Path to the Sqlite database.
+    :param list levels: Crosswalk levels to build, any of ROLLUP_LEVELS; defaults to all of them.
+    :param list tables: Optional source table names to limit it to; defaults to every od/rac/wac table.
+    :param LodesDatabase db: Optional shared connections to use instead of opening one on spath.
+    """
+    levels = levels or ROLLUP_LEVELS
+    bad = [level for level in levels if level not in ROLLUP_LEVELS]
+    if bad:
+        print(f"Error: {bad} are not rollup levels; choose from {ROLLUP_LEVELS}")
+        return {}
+
+    timings = {}
+    with metrics.stage('rollup', levels=levels) as m, connect(spath, db) as cnx:
+        with load_pragmas(cnx):
+            names = {r[0] for r in cnx.execute("SELECT name FROM sqlite_master WHERE type='table';")}
+            for name, file_type, layout, _ in _lodes_tables(cnx):
+                if (file_type not in ['od','rac','wac']) or ((tables is not None) and (name not in tables)):
+                    continue
+                xwalk = f"{name[:2]}_xwalk"
+                if xwalk not in names:
+                    print(f"{name}: no {xwalk} table to roll up with")
+                    continue
+                columns = [r[1] for r in cnx.execute(f"PRAGMA table_info({name});")]
+                for level in levels:
+                    t0 = time.perf_counter()
+                    rname = rollup_table_name(name, level)
+                    cnx.execute(f"DROP TABLE IF EXISTS {rname};")
+                    cnx.execute(_rollup_sql(name, file_type, level, xwalk, columns))
+                    _create_indexes(cnx, rname, _index_specs(file_type, rname, layout))
+                    cnx.commit()
+                    timings[rname] = time.perf_counter() - t0
+                    metrics.record_file('rollup', rname, timings[rname])
+        m['files'] = len(timings)
+    return timings
+
+def _target(file_path: str, layout: str = 'per_file') -> tuple:
+    """
+    Table a LODES file is loaded into and, for the consolidated layout, the partition values that identify its rows.
+    Per-file: ('tx_wac_S000_JT00_2019', None). Consolidated: ('tx_wac', {'year': 2019, 'jt': 'JT00', 'segment': 'S000'}),
+    with 'part' (main/aux) in place of 'segment' for od. The crosswalk is always its own table.
+    :param str file_path: Path, url or table name of the file.
+    :param str layout: 'per_file' or 'consolidated'.
+    """
+    name = _table_name(file_path)
+    file_type = _file_type(file_path)
+    if (layout != 'consolidated') or (file_type not in ['od','rac','wac']):
+        return name, None
+    bits = name.split("_")
+    partition = {'year': int(bits[4][:4]), 'jt': bits[3]}
+    partition['part' if file_type == 'od' else 'segment'] = bits[2]
+    return f"{bits[0]}_{file_type}", partition
+
+def _clear_target(cnx: sqlite3.Connection, tname: str, partition: dict = None):
+    """
+    Make way for a file's rows: drop its table, or for a consolidated table delete the rows of its partition.
+    """
+    if partition is None:
+        cnx.execute(f"DROP TABLE IF EXISTS {tname};")
+        return
+    exists = cnx.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name=?;", (tname,)).fetchone()[0]
+    if exists:
+        cnx.execute(f"DELETE FROM {tname} WHERE " + " AND ".join(f"{k} = ?" for k in partition), tuple(partition.values()))
+
+def _replaces_rows(cnx: sqlite3.Connection, tname: str, target: str, partition: dict = None) -> bool:
+    """
+    Whether loading a file replaces rows already in the database: its table exists (per-file layout), or its
+    consolidated table exists and the ledger has seen the file before (checking the partition itself could scan the table).
+    """
+    tables = {r[0] for r in cnx.execute("SELECT name FROM sqlite_master WHERE type = 'table';")}
+    if target not in tables:
+        return False
+    if (partition is None) or ('lodes_sources' not in tables):
+        return True
+    return cnx.execute("SELECT count(*) FROM lodes_sources WHERE table_name = ?;", (tname,)).fetchone()[0] > 0
+
+def _staging_table(tname: str) -> str:
+    """
+    Table a file's rows are written to while they replace rows already in the database (see _swap_in()).
+    """
+    return f"staging_{tname}"
+
+def _swap_in(cnx: sqlite3.Connection, staging: str, tname: str, partition: dict = None):
+    """
+    Replace a table, or one partition of a consolidated table, with the rows of a staging table and drop the staging
+    table. Begins a transaction if none is open and doesn't commit, so the caller can commit the swap with the
+    file's indexes and ledger entry and a crash leaves either the old rows or the new ones.
+    """
+    if not cnx.in_transaction:
+        cnx.execute("BEGIN;")
+    _clear_target(cnx, tname, partition)
+    exists = {r[0] for r in cnx.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name IN (?, ?);",
+        (staging, tname))}
+    if staging not in exists:
+        return
+    if tname not in exists:
+        cnx.execute(f'ALTER TABLE "{staging}" RENAME TO "{tname}";')
+        return
+    cols = ", ".join(f'"{r[1]}"' for r in cnx.execute(f'PRAGMA table_info("{staging}");'))
+    cnx.execute(f'INSERT INTO "{tname}" ({cols}) SELECT {cols} FROM "{staging}";')
+    cnx.execute(f'DROP TABLE "{staging}";')
+
+def _with_partition(frame: pd.core.frame.DataFrame, partition: dict = None) -> pd.core.frame.DataFrame:
+    """
+    Add the partition columns (jt, segment/part) a consolidated table needs; year is already a column.
+    """
+    if partition is None:
+        return frame
+    return frame.assign(**{k: v for k, v in partition.items() if k not in frame.columns})
+
+def _keep_base_only(paths: list) -> list:
+    """
+    Keep only the files needed for the slim database: JT00/JT01 od files and JT00/JT01 S000 rac/wac files.
+    :param list paths: Paths or urls of LODES files.
+    """
+    keep = []
+    for q in paths:
+        ft = _file_type(q)
+        if ft == 'xwalk':
+            keep.append(q)
+        elif not any(x in q for x in ["JT00","JT01"]):
+            continue
+        elif (ft in ['rac','wac']) and ("S000" not in q):
+            continue
+        else:
+            keep.append(q)
+    return keep
+
+def _file_hash(file_path: str) -> str:
+    """
+    BLAKE2b hex digest of a file's bytes, read in 1 MB blocks; None if it can't be read.
+    """
+    import hashlib
+
+    h = hashlib.blake2b(digest_size=16)
+    try:
+        with open(file_path, 'rb') as fp:
+            for block in iter(lambda: fp.read(1 << 20), b''):
+                h.update(block)
+    except OSError:
+        return None
+    return h.hexdigest()
+
+def _source_meta(file_path: str) -> dict:
+    """
+    Describe the source a LODES file came from, for the lodes_sources table. If the file sits in a folder made by
+    download_state_lodes_file(), the url, size, ETag and Last-Modified of the archive come from the folder's manifest.json;
+    otherwise the local path and size are used. The local path, its size and mtime, and a hash of the file are always
+    included.
+    :param str file_path: Path to a .csv or .csv.gz file.
+    """
+    import json
+
+    name = re.split(r"[\\/]", file_path)[-1]
+    gz_name = name if name.endswith('.gz') else name + '.gz'
+    sub = os.path.basename(os.path.dirname(file_path))
+    try:
+        stat = os.stat(file_path)
+        local = {'file_size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    except OSError:
+        local = {'file_size': None, 'mtime_ns': None}
+    local.update(path=file_path, hash=_file_hash(file_path))
+    try:
+        with open(os.path.join(os.path.dirname(os.path.dirname(file_path)), "manifest.json"), 'r') as fp:
+            entry = json.load(fp)['files'][f"{sub}/{gz_name}"]
+        return {'source': entry['url'], 'size': entry.get('size'),
+                'etag': entry.get('etag'), 'last_modified': entry.get('last_modified'), **local}
+    except Exception:
+        return {'source': file_path, 'size': os.path.getsize(file_path) if os.path.exists(file_path) else None,
+                'etag': None, 'last_modified': None, **local}
+
+#the load ledger; the first six columns are all databases built before it recorded status had
+_LEDGER_COLUMNS = [('table_name', 'TEXT PRIMARY KEY'), ('source', 'TEXT'), ('size', 'INTEGER'), ('etag', 'TEXT'),
+    ('last_modified', 'TEXT'), ('loaded_at', 'TEXT'), ('path', 'TEXT'), ('hash', 'TEXT'), ('status', 'TEXT'),
+    ('row_count', 'INTEGER'), ('started_at', 'TEXT'), ('seconds', 'REAL'), ('error', 'TEXT'), ('file_size', 'INTEGER'),
+    ('mtime_ns', 'INTEGER')]
+
+def _ensure_ledger(cnx: sqlite3.Connection):
+    """
+    Create the lodes_sources table, or add the columns an older database's table is missing. Not committed.
+    """
+    cols = ", ".join(f"{c} {t}" for c, t in _LEDGER_COLUMNS)
+    cnx.execute(f"CREATE TABLE IF NOT EXISTS lodes_sources ({cols});")
+    have = {r[1] for r in cnx.execute("PRAGMA table_info(lodes_sources);")}
+    for c, t in _LEDGER_COLUMNS:
+        if c not in have:
+            cnx.execute(f"ALTER TABLE lodes_sources ADD COLUMN {c} {t};")
+
+def _record_source(cnx: sqlite3.Connection, tname: str, meta: dict, status: str = 'done', rows: int = None,
+    seconds: float = None):
+    """
+    Record a source file in the lodes_sources ledger: where it came from, its hash and, once it is in, its row count
+    and load time. A file is marked 'loading' (and committed) before its table is touched. The loaders record 'done'
+    in the same transaction as the file's last rows and its indexes, so a load that dies partway leaves the file marked
+    'loading'; the one exception is create_and_insert_fast(method='to_sql'), where pandas commits each chunk and a crash
+    can leave some rows committed under a 'loading' entry, which a resume replaces. Not committed.
+    :param sqlite3.Connection cnx: Open connection to the database.
+    :param str tname: Name of the table that was loaded (the file's own table name for the consolidated layout).
+    :param dict meta: Output of _source_meta() or the same keys from a download.
+    :param str status: 'loading' or 'done'; use _record_failure() for 'failed'.
+    :param int rows: Rows loaded.
+    :param float seconds: Time taken to load them.
+    """
+    _ensure_ledger(cnx)
+    now = time.time()
+    started = now - seconds if seconds is not None else now
+    cnx.execute("""INSERT OR REPLACE INTO lodes_sources (table_name, source, size, etag, last_modified, loaded_at, path,
+        hash, status, row_count, started_at, seconds, error, file_size, mtime_ns)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL, ?, ?);""",
+        (tname, meta.get('source'), meta.get('size'), meta.get('etag'), meta.get('last_modified'),
+         time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now)) if status == 'done' else None,
+         meta.get('path'), meta.get('hash'), status, rows,
+         time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(started)), seconds,
+         meta.get('file_size'), meta.get('mtime_ns')))
+
+def _record_failure(cnx: sqlite3.Connection, tname: str, error: str):
+    """
+    Mark a file that was 'loading' in the lodes_sources ledger as 'failed', with the error. A file already marked
+    failed keeps its first error. Not committed.
+    """
+    _ensure_ledger(cnx)
+    cnx.execute("""UPDATE lodes_sources SET status = 'failed', error = ?, loaded_at = NULL
+        WHERE table_name = ? AND status = 'loading';""", (error, tname))
+
+def get_load_ledger(spath: str = None, db: LodesDatabase = None) -> dict:
+    """
+    Read the whole lodes_sources ledger, including files that failed or never finished loading. Returns a dictionary of
+    the file's table name to a dictionary of source, size, etag, last_modified, loaded_at, path, hash, status
+    ('loading', 'done' or 'failed'; None for files loaded before the ledger recorded status), row_count,
+    started_at, seconds and error. Empty if nothing has been recorded.
+    :param str spath: Path to existing Sqlite database.
+    :param LodesDatabase db: Optional shared connections to use instead of opening one on spath.
+    """
+    with connect(spath, db) as cnx:
+        try:
+            cur = cnx.execute("SELECT * FROM lodes_sources;")
+            cols = [c[0] for c in cur.description]
+            return {r[0]: dict(zip(cols, r)) for r in cur.fetchall()}
+        except sqlite3.OperationalError:
+            return {}
+
+def get_loaded_sources(spath: str = None, db: LodesDatabase = None) -> dict:
+    """
+    Read the lodes_sources table: which source file (url, size, ETag, Last-Modified) each LODES table was loaded from.
+    Only files that finished loading are included (see get_load_ledger() for the rest).
+    Returns a dictionary of table name to a dictionary of those values; empty if nothing has been recorded.
+    :param str spath: Path to existing Sqlite database.
+    :param LodesDatabase db: Optional shared connections to use instead of opening one on spath.
+    """
+    return {t: r for t, r in get_load_ledger(spath, db).items() if r.get('status') in [None, 'done']}
+
+def _already_loaded(paths: list, layout: str, ledger: dict, cnx: sqlite3.Connection) -> set:
+    """
+    The paths the ledger says loaded completely from a file with the same contents, and whose table is still there.
+    A file with the size and mtime the ledger recorded is taken as unchanged without reading it; otherwise it is hashed,
+    and if the contents still match, its new size and mtime are recorded (and committed) so the next resume skips the hash.
+    Files loaded before the ledger kept hashes aren't counted, so they are loaded again once.
+    """
+    tables = {r[0] for r in cnx.execute("SELECT name FROM sqlite_master WHERE type = 'table';")}
+    done = set()
+    for q in paths:
+        tname = _table_name(q)
+        entry = ledger.get(tname)
+        if (entry is None) or (entry.get('status') != 'done') or (entry.get('hash') is None):
+            continue
+        if _target(q, layout)[0] not in tables:
+            continue
+        try:
+            stat = os.stat(q)
+        except OSError:
+            continue
+        if (entry.get('file_size') == stat.st_size) and (entry.get('mtime_ns') == stat.st_mtime_ns):
+            done.add(q)
+        elif entry['hash'] == _file_hash(q):
+            done.add(q)
+            _ensure_ledger(cnx)
+            cnx.execute("UPDATE lodes_sources SET file_size = ?, mtime_ns = ? WHERE table_name = ?;",
+                (stat.st_size, stat.st_mtime_ns, tname))
+    cnx.commit()
+    return done
 
 def get_file_paths(folder_path: str = None)->list:
     """
@@ -21,23 +551,29 @@ def get_file_paths(folder_path: str = None)->list:
     cw = []
     for q in files:
         if q.endswith(".csv"):
-            if 'rac' in q:
+            ft = _file_type(q)
+            if ft == 'rac':
                 racs.append(q)
-            elif 'wac' in q:
+            elif ft == 'wac':
                 wacs.append(q)
-            elif 'xwalk' in q:
+            elif ft == 'xwalk':
                 cw.append(q)
-            elif 'od' in q:
+            elif ft == 'od':
                 ods.append(q)
             
     return [racs,wacs,ods,cw]
 
-def build_db(spath : str = None):
+def build_db(spath : str = None, overwrite : bool = True):
     '''
     Create a new SQLite Database with SpatialLite enabled.
     :param str spath: Path to the location to save the SQLite db. 
+    :param bool overwrite: If True an existing file at spath is deleted first. If False an existing db is kept as it is,
+        e.g. to resume a load or merge more states into it.
     '''
 
+    if os.path.exists(spath) and not overwrite:
+        print(f"keeping existing sqlite db at: {spath}")
+        return
     print("building sqlite db...")
     try:
         #removes existing 
@@ -56,36 +592,466 @@ def build_db(spath : str = None):
     except:
         print(f"could not create sqlite db at: {spath}")
 
-def read_in_data(file_path : str = None) -> pd.core.frame.DataFrame:
+#columns of each LODES 8 file type, per the LODES technical documentation
+_JOB_COLS = (["C000","CA01","CA02","CA03","CE01","CE02","CE03"]
+    + [f"CNS{i:02d}" for i in range(1,21)]
+    + ["CR01","CR02","CR03","CR04","CR05","CR07","CT01","CT02","CD01","CD02","CD03","CD04","CS01","CS02"])
+LODES_COLUMNS = {
+    'od': ["w_geocode","h_geocode","S000","SA01","SA02","SA03","SE01","SE02","SE03","SI01","SI02","SI03","createdate"],
+    'rac': ["h_geocode"] + _JOB_COLS + ["createdate"],
+    'wac': ["w_geocode"] + _JOB_COLS + [f"CFA{i:02d}" for i in range(1,6)] + [f"CFS{i:02d}" for i in range(1,6)] + ["createdate"],
+    'xwalk': ["tabblk2020","st","stusps","stname","cty","ctyname","trct","trctname","bgrp","bgrpname","cbsa","cbsaname",
+        "zcta","zctaname","stplc","stplcname","ctycsub","ctycsubname","stcd118","stcd118name","stsldl","stsldlname",
+        "stsldu","stslduname","stschool","stschoolname","stsecon","stseconname","trib","tribname","tsub","tsubname",
+        "stanrc","stanrcname","necta","nectaname","mil","milname","stwib","stwibname","blklatdd","blklondd","createdate"],
+}
+
+def lodes_schema(file_type: str, geocode_type: str = 'text', layout: str = 'per_file') -> dict:
+    """
+    SQLite schema for a LODES file type, as a dictionary of column name to SQLite type.
+    Job counts and year are INTEGER; block geocodes are fixed-width TEXT by default, or INTEGER with geocode_type='integer'
+    (smaller, but leading zeros are dropped, see analysis.pull_data). Other crosswalk codes stay TEXT to keep their
+    leading zeros, and the crosswalk's block coordinates are REAL.
+    :param str file_type: 'od', 'rac', 'wac' or 'xwalk'.
+    :param str geocode_type: 'text' or 'integer'.
+    :param str layout: 'per_file', or 'consolidated' to add the jt and segment (rac/wac) or part (od) columns.
+    """
+    geo = 'INTEGER' if geocode_type == 'integer' else 'TEXT'
+    schema = {}
+    for c in LODES_COLUMNS.get(file_type, []):
+        if c in ['w_geocode','h_geocode','tabblk2020']:
+            schema[c] = geo
+        elif c == 'createdate':
+            schema[c] = 'TEXT'
+        elif file_type == 'xwalk':
+            schema[c] = 'REAL' if c in ['blklatdd','blklondd'] else 'TEXT'
+        else:
+            schema[c] = 'INTEGER'
+    if file_type in ['od','rac','wac']:
+        schema['year'] = 'INTEGER'
+    if (layout == 'consolidated') and (file_type in ['od','rac','wac']):
+        schema['jt'] = 'TEXT'
+        schema['part' if file_type == 'od' else 'segment'] = 'TEXT'
+    return schema
+
+def _read_dtypes(file_type: str, geocode_type: str = 'text'):
+    """
+    pandas dtypes to parse a LODES file with, from lodes_schema(). Columns not in the schema are read as strings.
+    """
+    from collections import defaultdict
+
+    to_pandas = {'INTEGER': 'Int64', 'REAL': 'Float64', 'TEXT': 'string[pyarrow]'}
+    schema = lodes_schema(file_type, geocode_type)
+    return defaultdict(lambda: "string[pyarrow]", {c: to_pandas[t] for c, t in schema.items() if c != 'year'})
+
+def _chunk_rows(file_type: str, memory_mb: float = 256) -> int:
+    """
+    Rows per chunk that keep one parsed chunk within memory_mb, counting the Python values it becomes when it is bound
+    for executemany (roughly 64 bytes a field all told), so memory use doesn't grow with the size of the file.
     """
-    Read the LODES data into memory, assign it a data year, and return it
+    ncols = len(LODES_COLUMNS.get(file_type, [])) + 1
+    return max(1000, int(memory_mb * 1024 * 1024 / (ncols * 64)))
+
+def read_in_data(file_path : str = None, geocode_type : str = 'text') -> pd.core.frame.DataFrame:
+    """
+    Read the LODES data into memory, assign it a data year, and return it.
+    Columns are parsed with the types from lodes_schema() rather than as strings.
     :param str file_path: Path to the given location of the given file. 
+    :param str geocode_type: 'text' to keep geocodes as fixed-width strings, 'integer' to parse them as integers.
     """
 
     #read in data 
-    df = pd.read_csv(file_path,header=0,dtype="string[pyarrow]", on_bad_lines='skip',encoding = "ISO-8859-1")
+    file_type = _file_type(file_path)
+    df = pd.read_csv(file_path,header=0,dtype=_read_dtypes(file_type, geocode_type), on_bad_lines='skip',encoding = "ISO-8859-1")
     
     #assign year
-    df['year'] = file_path.split("_")[-1][:4]
+    if file_type != 'xwalk':
+        df['year'] = int(_table_name(file_path).split("_")[-1][:4])
 
     return df
 
-def create_and_insert_fast(frame:pd.core.frame.DataFrame,tname:str,index_col:str,index_name:str,spath:str):
+def read_in_chunks(file_path : str = None, chunksize : int = None, fileobj = None, geocode_type : str = 'text',
+    memory_mb : float = 256):
+    """
+    Read LODES data a chunk of rows at a time, assigning each chunk its data year.
+    Yields DataFrames typed like read_in_data(). Files ending in .gz are decompressed as they are read.
+    Only one chunk is held at a time, so memory stays flat however big the file is.
+    :param str file_path: Path to the given location of the given file; also used to get the year.
+    :param int chunksize: Number of rows per chunk; by default as many as fit in memory_mb.
+    :param fileobj: Optional open (binary, already decompressed) file to read instead of file_path, e.g. a network stream.
+    :param str geocode_type: 'text' to keep geocodes as fixed-width strings, 'integer' to parse them as integers.
+    :param float memory_mb: Memory budget for a chunk, in MB, used when chunksize isn't given.
+    """
+
+    file_type = _file_type(file_path)
+    chunksize = chunksize or _chunk_rows(file_type, memory_mb)
+    reader = pd.read_csv(file_path if fileobj is None else fileobj, header=0, dtype=_read_dtypes(file_type, geocode_type),
+        on_bad_lines='skip', encoding = "ISO-8859-1", chunksize=chunksize)
+    with reader:
+        for df in reader:
+            #assign year
+            if file_type != 'xwalk':
+                df['year'] = int(_table_name(file_path).split("_")[-1][:4])
+            yield df
+
+def parquet_path(root: str, file_path: str) -> str:
+    """
+    Where a LODES file goes in the Parquet dataset: a hive-partitioned folder per state, type, year, job type and
+    segment (part for od), e.g. root/state=tx/type=wac/year=2019/jt=JT00/segment=S000/data.parquet.
+    The crosswalk goes in root/state=tx/type=xwalk/data.parquet.
+    :param str root: Folder of the Parquet dataset.
+    :param str file_path: Path, url or table name of the file.
+    """
+    file_type = _file_type(file_path)
+    parts = [f"state={_table_name(file_path)[:2]}", f"type={file_type}"]
+    if file_type != 'xwalk':
+        _, partition = _target(file_path, 'consolidated')
+        parts += [f"{k}={v}" for k, v in partition.items()]
+    return os.path.join(root, *parts, "data.parquet")
+
+class _ParquetFiles:
+    """
+    Parquet files being written a chunk at a time, one per LODES file. Each is written under a temporary name and
+    moved into its partition when finished, so a failed or rerun load never leaves a partial partition behind.
+    Partition columns (year) live in the folder names, not the files.
+    """
+
+    def __init__(self, root: str, compression: str = 'zstd'):
+        self.root = root
+        self.compression = compression
+        self.writers = {}
+
+    def write(self, tname: str, frame: pd.core.frame.DataFrame):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pandas(frame.drop(columns=['year'], errors='ignore'), preserve_index=False)
+        if tname not in self.writers:
+            path = parquet_path(self.root, tname)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.writers[tname] = (pq.ParquetWriter(path + ".tmp", table.schema, compression=self.compression), path)
+        self.writers[tname][0].write_table(table)
+
+    def finish(self, tname: str):
+        writer, path = self.writers.pop(tname, (None, None))
+        if writer is not None:
+            writer.close()
+            os.replace(path + ".tmp", path)
+
+    def abort(self, tname: str):
+        writer, path = self.writers.pop(tname, (None, None))
+        if writer is not None:
+            writer.close()
+            os.remove(path + ".tmp")
+
+    def close(self):
+        for tname in list(self.writers):
+            self.abort(tname)
+
+def _through_parquet(chunks, root: str, file_path: str):
+    """
+    Pass chunks through while writing them to the file's partition of the Parquet dataset; the partition is only
+    replaced once every chunk has gone by.
+    """
+    sink = _ParquetFiles(root)
+    name = _table_name(file_path)
+    try:
+        for chunk in chunks:
+            sink.write(name, chunk)
+            yield chunk
+        sink.finish(name)
+    finally:
+        sink.close()
+
+def write_parquet(frame: pd.core.frame.DataFrame, root: str, file_path: str, compression: str = 'zstd') -> str:
+    """
+    Write one LODES file's rows into its partition of the Parquet dataset (see parquet_path()), replacing what was there.
+    Needs pyarrow. Returns the path written.
+    :param pandas.core.frame.DataFrame frame: The file's rows (hint: output of read_in_data()).
+    :param str root: Folder of the Parquet dataset.
+    :param str file_path: Path of the LODES file the rows came from.
+    :param str compression: Parquet compression codec.
+    """
+    sink = _ParquetFiles(root, compression=compression)
+    name = _table_name(file_path)
+    try:
+        sink.write(name, frame)
+        sink.finish(name)
+    finally:
+        sink.close()
+    return parquet_path(root, name)
+
+def _drain_queue(q, n_sources: int, spath: str, layout: str = 'per_file', indexes: str = 'inline', covering: bool = False,
+    clustered: bool = False, db: LodesDatabase = None, backend: str = 'sqlite', parquet_root: str = None,
+    producers: list = None, poll: float = 1.0) -> dict:
+    """
+    Single writer for the streaming loaders. Takes messages off a queue filled by producer threads or
+    processes and writes them into the database over one connection, so producers never contend for the SQLite lock.
+
+    Messages are tuples:
+        ('start', table_name, file_type[, pid]) - a new file; it is marked 'loading' in lodes_sources. Producer
+                                                  processes add their pid so a crash can be traced to the file.
+        ('rows', table_name, DataFrame) - a chunk of rows for the file
+        ('done', table_name, file_type, meta) - file finished; its indexes are built (indexes='inline' only), the
+                                                 source meta is recorded in lodes_sources, and it is committed
+        ('error', table_name, message) - the producer failed; its partial rows are dropped and the file marked 'failed'
+    Returns a dictionary of table name to rows written (None for failed tables).
+
+    A file whose table (or consolidated partition) is already loaded, e.g. on a refresh, is written to a staging
+    table and swapped in with its 'done' commit (see _swap_in()), so if it fails or the load dies the old rows are kept.
+
+    The queue is polled every poll seconds. When it is empty, producers that died without finishing their file
+    (e.g. killed for running out of memory) are looked for, and their file is dropped and marked failed as if they had
+    sent an 'error'. If every producer is gone the writer stops instead of waiting on files nobody will send.
+
+    :param q: Queue the producers put messages on.
+    :param int n_sources: Number of files being produced; the writer stops after this many 'done'/'error' messages.
+    :param str spath: Path to existing Sqlite database.
+    :param str layout: 'per_file' for one table per file, 'consolidated' for one od/rac/wac table per state.
+    :param str indexes: 'inline' builds each table's indexes as it finishes; anything else leaves them to build_indexes().
+    :param bool covering: Build covering indexes (see _index_specs()).
+    :param bool clustered: Create tables as clustered WITHOUT ROWID tables keyed on geocode (see _primary_key()).
+    :param LodesDatabase db: Optional shared connections to write through instead of opening one on spath.
+    :param str backend: 'sqlite', 'parquet' or 'both' (see load_lodes_into_db()).
+    :param str parquet_root: Folder of the Parquet dataset, for the parquet backends.
+    :param list producers: Optional producer processes (multiprocessing.Process) to watch for crashes.
+    :param float poll: Seconds to wait on an empty queue before checking the producers.
+    """
+    rows = {}
+    started = {}
+    current = {}
+    staged = {}
+    finished = 0
+    t0 = time.perf_counter()
+    sink = _ParquetFiles(parquet_root) if backend in ['parquet','both'] else None
+    with (connect(spath, db) if backend != 'parquet' else nullcontext()) as cnx:
+        if cnx is not None:
+            cnx.execute("PRAGMA max_page_count = 2147483646;")
+        with (load_pragmas(cnx) if cnx is not None else nullcontext()):
+            while finished < n_sources:
+                try:
+                    msg = q.get(timeout=poll)
+                except queue.Empty:
+                    msg = _lost_producer(producers, current)
+                    if msg is None:
+                        if producers and not any(proc.is_alive() for proc in producers):
+                            print(f"every parser process has exited; {n_sources - finished} files were never loaded")
+                            break
+                        continue
+                kind, tname = msg[0], msg[1]
+                if kind == 'start' and len(msg) > 3:
+                    current[msg[3]] = tname
+                elif kind in ['done', 'error']:
+                    current = {pid: t for pid, t in current.items() if t != tname}
+                target, partition = _target(tname, layout)
+                file_type = _file_type(tname)
+                primary_key = _primary_key(file_type, layout) if clustered else None
+                try:
+                    if kind == 'start':
+                        if cnx is not None:
+                            #an old file stays in until the new one is all in
+                            cnx.execute(f'DROP TABLE IF EXISTS "{_staging_table(tname)}";')
+                            if _replaces_rows(cnx, tname, target, partition):
+                                staged[tname] = _staging_table(tname)
+                            else:
+                                _clear_target(cnx, target, partition)
+                            _record_source(cnx, tname, {}, status='loading')
+                            cnx.commit()
+                        rows[tname] = 0
+                        started[tname] = time.perf_counter()
+                    elif kind == 'rows':
+                        if rows.get(tname) is not None:
+                            if cnx is not None:
+                                bulk_insert(cnx, staged.get(tname, target), _with_partition(msg[2], partition),
+                                    primary_key=primary_key)
+                            if sink is not None:
+                                sink.write(tname, msg[2])
+                            rows[tname] += msg[2].shape[0]
+                    elif kind == 'done':
+                        finished += 1
+                        if rows.get(tname) is not None:
+                            if sink is not None:
+                                sink.finish(tname)
+                            if cnx is not None:
+                                if tname in staged:
+                                    #other files' pending rows go first, so a failed swap rolls back only itself
+                                    cnx.commit()
+                                try:
+                                    if tname in staged:
+                                        _swap_in(cnx, staged[tname], target, partition)
+                                    if indexes == 'inline':
+                                        _create_indexes(cnx, target, _wanted_indexes(file_type, target, layout, covering, primary_key))
+                                    meta = msg[3] if (len(msg) > 3) and (msg[3] is not None) else {}
+                                    _record_source(cnx, tname, meta, rows=rows[tname],
+                                        seconds=time.perf_counter() - started[tname])
+                                    cnx.commit()
+                                except Exception:
+                                    if tname in staged:
+                                        cnx.rollback()
+                                    raise
+                                staged.pop(tname, None)
+                            metrics.record_file('load', tname, time.perf_counter() - started[tname], rows=rows[tname])
+                    elif kind == 'error':
+                        finished += 1
+                        metrics.record_file('load', tname, time.perf_counter() - started.get(tname, t0), status='failed',
+                            error=msg[2])
+                        if sink is not None:
+                            sink.abort(tname)
+                        if cnx is not None:
+                            _drop_partial(cnx, staged.pop(tname, None), target, partition)
+                            _record_failure(cnx, tname, msg[2])
+                            cnx.commit()
+                        rows[tname] = None
+                except Exception as e:
+                    #drop whatever part of the file made it in; other files' rows are kept
+                    print(f"{tname}: could not write ({e})")
+                    if sink is not None:
+                        sink.abort(tname)
+                    if cnx is not None:
+                        _drop_partial(cnx, staged.pop(tname, None), target, partition)
+                        _record_failure(cnx, tname, str(e))
+                        cnx.commit()
+                    rows[tname] = None
+
+    if sink is not None:
+        sink.close()
+    return rows
+
+def _drop_partial(cnx: sqlite3.Connection, staging: str, tname: str, partition: dict = None):
+    """
+    Drop the rows of a file that failed partway: its staging table if it was replacing rows, otherwise its own table or partition.
+    """
+    if staging is not None:
+        cnx.execute(f'DROP TABLE IF EXISTS "{staging}";')
+    else:
+        _clear_target(cnx, tname, partition)
+
+def _lost_producer(producers: list, current: dict) -> tuple:
+    """
+    an 'error' message for the file of a producer process that died partway through it, or None if there is none.
+    :param list producers: Producer processes.
+    :param dict current: pid to the table name that producer is working on; the dead one is taken out.
     """
-    Write a pandas DataFrame into a Sqlite table quickly.
+    for proc in producers or []:
+        if (not proc.is_alive()) and (proc.pid in current):
+            return ('error', current.pop(proc.pid), f"parser process exited with code {proc.exitcode}")
+    return None
 
-    :param pandas.core.frame.DataFrame frame: DataFrame containing data you would like to upload.
+@contextmanager
+def load_pragmas(cnx: sqlite3.Connection, cache_mb: int = 512, journal_mode: str = 'TRUNCATE'):
+    """
+    Context manager that sets load-time PRAGMAs (journal_mode, synchronous, cache_size, temp_store) on a connection
+    for bulk writes, commits when done (rolls back on an error) and restores the previous values.
+    fsyncs are skipped but the rollback journal is kept on disk, so a process that dies mid-load leaves the database
+    intact with its last committed files, and a resume (see load_lodes_into_db()) picks up from there. A power loss or
+    OS crash can still corrupt it. 'MEMORY' or 'OFF' are a little faster, but a crash under either can leave the
+    database corrupt and needing a rebuild.
+
+    :param sqlite3.Connection cnx: Open connection to the database.
+    :param int cache_mb: Page cache size in MB while loading.
+    :param str journal_mode: Journal mode while loading: 'TRUNCATE' or 'WAL' survive a crashed process; 'MEMORY' or 'OFF' don't.
+    """
+    settings = {'journal_mode': journal_mode,
+                'synchronous': 'OFF',
+                'cache_size': -cache_mb * 1024,
+                'temp_store': 'MEMORY'}
+    #journal_mode can't change inside a transaction
+    cnx.commit()
+    previous = {}
+    for k, v in settings.items():
+        previous[k] = cnx.execute(f"PRAGMA {k};").fetchone()[0]
+        cnx.execute(f"PRAGMA {k} = {v};")
+    try:
+        yield cnx
+        cnx.commit()
+    except:
+        cnx.rollback()
+        raise
+    finally:
+        for k, v in previous.items():
+            cnx.execute(f"PRAGMA {k} = {v};")
+
+def _sql_type(col: pd.Series) -> str:
+    """
+    SQLite column type for a pandas column.
+    """
+    if pd.api.types.is_bool_dtype(col) or pd.api.types.is_integer_dtype(col):
+        return "INTEGER"
+    elif pd.api.types.is_float_dtype(col):
+        return "REAL"
+    elif pd.api.types.is_object_dtype(col):
+        first = col.dropna()
+        if (len(first) > 0) and isinstance(first.iloc[0], (bytes, bytearray, memoryview)):
+            return "BLOB"
+    return "TEXT"
+
+def _to_rows(frame: pd.core.frame.DataFrame):
+    """
+    Rows of a DataFrame as tuples of plain Python values that sqlite3 can bind, with missing values as None.
+    """
+    cols = [frame[c].astype(object).where(frame[c].notna(), None).tolist() for c in frame.columns]
+    return zip(*cols)
+
+def bulk_insert(cnx: sqlite3.Connection, tname: str, frame: pd.core.frame.DataFrame, batch_size: int = 50000,
+    schema: dict = None, primary_key: list = None) -> int:
+    """
+    Insert a DataFrame into a table with prepared executemany statements, creating the table if it doesn't exist.
+    Column types come from schema where given, otherwise from the frame's dtypes. Does not commit; call it inside
+    one transaction per table. Returns the number of rows inserted.
+
+    :param sqlite3.Connection cnx: Open connection to the database.
+    :param str tname: Name of the table.
+    :param pandas.core.frame.DataFrame frame: Rows to insert.
+    :param int batch_size: Rows per executemany call.
+    :param dict schema: Optional column name to SQLite type (hint: output of lodes_schema()).
+    :param list primary_key: Optional columns to key the table on; it is then created as a clustered WITHOUT ROWID table,
+        so rows are stored in key order and lookups on the key need no separate index (hint: output of _primary_key()).
+    """
+    schema = schema or {}
+    cols = ", ".join(f'"{c}" {schema.get(c, _sql_type(frame[c]))}' for c in frame.columns)
+    if primary_key:
+        cnx.execute(f'CREATE TABLE IF NOT EXISTS "{tname}" ({cols}, PRIMARY KEY ({", ".join(primary_key)})) WITHOUT ROWID;')
+    else:
+        cnx.execute(f'CREATE TABLE IF NOT EXISTS "{tname}" ({cols});')
+    names = ", ".join(f'"{c}"' for c in frame.columns)
+    sql = f'INSERT INTO "{tname}" ({names}) VALUES ({", ".join("?" * frame.shape[1])});'
+    for i in range(0, frame.shape[0], batch_size):
+        cnx.executemany(sql, _to_rows(frame.iloc[i:i+batch_size]))
+    return frame.shape[0]
+
+def create_and_insert_fast(frame:pd.core.frame.DataFrame,tname:str,index_col:str,index_name:str,spath:str,source_meta:dict=None,
+    method:str='bulk',batch_size:int=50000,schema:dict=None,primary_key:list=None,db:LodesDatabase=None) -> bool:
+    """
+    Write a pandas DataFrame, or an iterable of DataFrames read in chunks (hint: output of read_in_chunks()), into a Sqlite
+    table quickly. Chunks are inserted as they come, so a whole file never has to be in memory. Returns True if the table was written.
+    The default 'bulk' method writes the whole table in one transaction with prepared executemany inserts and
+    load-time PRAGMAs; 'to_sql' is the older pandas path, kept for comparison. Rows/s is printed for each table.
+
+    :param pandas.core.frame.DataFrame frame: DataFrame containing data you would like to upload, or an iterable of DataFrames.
     :param str tname: Name to call table in Sqlite database.
     :param str index_col: Column in DataFrame to use as an index.
     :param str index_name: Name to call index in sqlite table.
     :param str spath: Path to existing Sqlite table.
+    :param dict source_meta: Optional description of the source file to record in lodes_sources (hint: output of _source_meta()).
+    :param str method: 'bulk' or 'to_sql'.
+    :param int batch_size: Rows per insert batch.
+    :param dict schema: Optional column name to SQLite type for the bulk method (hint: output of lodes_schema()).
+    :param list primary_key: Optional columns to make a clustered WITHOUT ROWID table on, for the bulk method (see bulk_insert()).
+    :param LodesDatabase db: Optional shared connections to write through instead of opening one on spath.
     """
-    
-    import sqlite3
+    try:
+        with connect(spath, db) as cnx:
+            return _write_table(cnx, frame, tname, index_col, index_name, source_meta, method, batch_size, schema, primary_key)
+    except sqlite3.Error as e:
+        print(f"{tname}: could not connect ({e})")
+        return False
 
-    #connect to sqlite table
+def _write_table(cnx, frame, tname, index_col, index_name, source_meta, method, batch_size, schema, primary_key) -> bool:
+    """
+    create_and_insert_fast() on an open connection; the caller closes it.
+    """
+    #replace the table
     try:
-        cnx = sqlite3.connect(spath)
         cursor = cnx.cursor()
         try:
             cursor.execute(f"DROP TABLE {tname};")
@@ -95,380 +1061,892 @@ def create_and_insert_fast(frame:pd.core.frame.DataFrame,tname:str,index_col:str
         cnx.commit()
         #print("dropped old table...")
     except:
-        print(f"{tname}: could not connect")
-        return
+        print(f"{tname}: could not drop old table")
+        return False
 
-    #write to database in 50k row chunks
+    #write to database; the rows, index and ledger entry are committed together by load_pragmas()
+    #(to_sql commits each chunk itself, so with it a crash can leave rows in with the file still marked 'loading')
+    frames = [frame] if isinstance(frame, pd.DataFrame) else frame
+    rows = 0
+    t0 = time.perf_counter()
     try:
-        #print(f"writing to db...")
-        n = 50000  #chunk row size
-        list_df = [frame[i:i+n] for i in range(0,frame.shape[0],n)]
-        for chunk_frame in list_df:
-            chunk_frame.to_sql(name=tname, con=cnx,if_exists="append", index=False)
-    except:
-        print(f"{tname}: could not write")
-        return
+        with (load_pragmas(cnx) if method != 'to_sql' else nullcontext()):
+            for f in frames:
+                if method == 'to_sql':
+                    n = batch_size  #chunk row size
+                    for i in range(0,f.shape[0],n):
+                        f[i:i+n].to_sql(name=tname, con=cnx,if_exists="append", index=False)
+                    rows += f.shape[0]
+                else:
+                    rows += bulk_insert(cnx, tname, f, batch_size=batch_size, schema=schema, primary_key=primary_key)
+            secs = time.perf_counter() - t0
 
-    #create index
-    try:
-        if (type(index_col) == str) and (type(index_name) == str):
-            crsr = cnx.cursor()
             #drop existing index and remake
-            crsr.execute(f"DROP INDEX IF EXISTS {index_name}")
-            crsr.execute(f"CREATE INDEX {index_name} ON {tname} ({index_col})")
-    except:
-        print(f"{tname}: could not make index")
-        return
+            if (type(index_col) == str) and (type(index_name) == str):
+                cnx.execute(f"DROP INDEX IF EXISTS {index_name}")
+                cnx.execute(f"CREATE INDEX {index_name} ON {tname} ({index_col})")
+
+            #note where the data came from
+            if source_meta is not None:
+                _record_source(cnx, tname, source_meta, rows=rows, seconds=secs)
+        cnx.commit()
+    except Exception as e:
+        print(f"{tname}: could not write ({e})")
+        cnx.rollback()
+        if source_meta is not None:
+            _record_failure(cnx, tname, str(e))
+            cnx.commit()
+        return False
+    metrics.record_file('load', tname, secs, rows=rows, method=method)
+    return True
+
+
+def insert_partition(frame:pd.core.frame.DataFrame,tname:str,partition:dict,spath:str,index_specs:list=None,schema:dict=None,
+    source_name:str=None,source_meta:dict=None,batch_size:int=50000,primary_key:list=None,db:LodesDatabase=None) -> bool:
+    """
+    Write a pandas DataFrame into one partition of a consolidated table, e.g. the 2019 JT00 S000 rows of tx_wac,
+    replacing any rows already there for that partition. The table and its indexes are created if they don't exist.
+    Returns True if the rows were written.
 
+    :param pandas.core.frame.DataFrame frame: DataFrame containing data you would like to upload, or an iterable of DataFrames.
+    :param str tname: Name of the consolidated table, e.g. 'tx_wac'.
+    :param dict partition: Partition column values, e.g. {'year': 2019, 'jt': 'JT00', 'segment': 'S000'} (hint: output of _target()).
+    :param str spath: Path to existing Sqlite table.
+    :param list index_specs: (index name, columns) to create if missing (hint: output of _index_specs()).
+    :param dict schema: Optional column name to SQLite type (hint: output of lodes_schema(..., layout='consolidated')).
+    :param str source_name: Name to record the source under in lodes_sources, normally the file's own table name.
+    :param dict source_meta: Optional description of the source file to record in lodes_sources.
+    :param int batch_size: Rows per insert batch.
+    :param list primary_key: Optional columns to create the table as a clustered WITHOUT ROWID table on (see bulk_insert()).
+    :param LodesDatabase db: Optional shared connections to write through instead of opening one on spath.
+    """
+    frames = [frame] if isinstance(frame, pd.DataFrame) else frame
+    rows = 0
+    t0 = time.perf_counter()
     try:
-        #commit everything and close connection
+        with connect(spath, db) as cnx:
+            cnx.execute("PRAGMA max_page_count = 2147483646;")
+            try:
+                with load_pragmas(cnx):
+                    _clear_target(cnx, tname, partition)
+                    for f in frames:
+                        rows += bulk_insert(cnx, tname, _with_partition(f, partition), batch_size=batch_size,
+                            schema=schema, primary_key=primary_key)
+                    _create_indexes(cnx, tname, index_specs or [])
+                    if source_meta is not None:
+                        _record_source(cnx, source_name or tname, source_meta, rows=rows,
+                            seconds=time.perf_counter() - t0)
+            except Exception as e:
+                if source_meta is not None:
+                    _record_failure(cnx, source_name or tname, str(e))
+                    cnx.commit()
+                raise
+    except Exception as e:
+        print(f"{tname} {partition}: could not write ({e})")
+        return False
+    metrics.record_file('load', source_name or tname, time.perf_counter() - t0, rows=rows, table=tname, **partition)
+    return True
+
+def _load_file(file_path:str, spath:str, layout:str = 'per_file', geocode_type:str = 'text', indexes:str = 'inline',
+    covering:bool = False, clustered:bool = False, db:LodesDatabase = None, backend:str = 'sqlite',
+    parquet_root:str = None, memory_mb:float = 256, chunksize:int = None) -> bool:
+    """
+    Read one LODES csv and load it into its table (per-file layout) or its partition of the state's table (consolidated),
+    and/or its partition of the Parquet dataset. The csv is read and written a chunk at a time within memory_mb.
+    Returns True if it loaded. Indexes are only built here with indexes='inline'. Outside the parquet-only backend the
+    file is tracked in the lodes_sources ledger: 'loading' while it goes in, then 'done' or 'failed'.
+    """
+    args = dict(layout=layout, geocode_type=geocode_type, indexes=indexes, covering=covering, clustered=clustered,
+        db=db, backend=backend, parquet_root=parquet_root, memory_mb=memory_mb, chunksize=chunksize)
+    if backend == 'parquet':
+        return _write_file(file_path, spath, None, **args)
+
+    #mark it before touching the table, so a crash leaves it as not loaded
+    name = _table_name(file_path)
+    meta = _source_meta(file_path)
+    with connect(spath, db) as cnx:
+        _record_source(cnx, name, meta, status='loading')
         cnx.commit()
-        cnx.close()
-        return
-    except:
-        print(f"{tname}: error closing")
-        return
-    
+    try:
+        ok = _write_file(file_path, spath, meta, **args)
+        error = "not loaded"
+    except Exception as e:
+        ok, error = False, str(e)
+    if not ok:
+        with connect(spath, db) as cnx:
+            _record_failure(cnx, name, error)
+            cnx.commit()
+    return ok
+
+def _write_file(file_path:str, spath:str, meta:dict, layout:str = 'per_file', geocode_type:str = 'text',
+    indexes:str = 'inline', covering:bool = False, clustered:bool = False, db:LodesDatabase = None,
+    backend:str = 'sqlite', parquet_root:str = None, memory_mb:float = 256, chunksize:int = None) -> bool:
+    """
+    _load_file() once the file is marked in the ledger; meta is recorded with the rows.
+    """
+    file_type = _file_type(file_path)
+    tname, partition = _target(file_path, layout)
+    primary_key = _primary_key(file_type, layout) if clustered else None
+    specs = _wanted_indexes(file_type, tname, layout, covering, primary_key) if indexes == 'inline' else []
+
+    #read in, a chunk at a time
+    dfm = read_in_chunks(file_path = file_path, chunksize = chunksize, geocode_type = geocode_type, memory_mb = memory_mb)
+
+    #columnar copy, written as the chunks go by
+    if backend in ['parquet','both']:
+        dfm = _through_parquet(dfm, parquet_root, file_path)
+        if backend == 'parquet':
+            for _ in dfm:
+                pass
+            return True
+
+    #upload
+    if partition is not None:
+        return insert_partition(frame=dfm,
+            tname=tname,
+            partition=partition,
+            spath=spath,
+            index_specs=specs,
+            schema=lodes_schema(file_type, geocode_type, layout),
+            source_name=_table_name(file_path),
+            source_meta=meta,
+            primary_key=primary_key,
+            db=db)
+
+    ok = create_and_insert_fast(frame=dfm,
+        tname=tname,
+        index_col=specs[0][1] if specs else None,
+        index_name=specs[0][0] if specs else None,
+        spath=spath,
+        source_meta=meta,
+        schema=lodes_schema(file_type, geocode_type),
+        primary_key=primary_key,
+        db=db)
+
+    #od tables get a second index
+    if ok and (len(specs) > 1):
+        with connect(spath, db) as cnx:
+            _create_indexes(cnx, tname, specs[1:], rebuild=True)
+            cnx.commit()
+    return ok
+
+def _init_spatial(conn: sqlite3.Connection):
+    """
+    Create the Spatialite metadata tables if the database doesn't have them yet (build_db() normally has).
+    """
+    exists = conn.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name='spatial_ref_sys';").fetchone()[0]
+    if not exists:
+        conn.execute('SELECT InitSpatialMetaData(1);')
+        conn.commit()
+
+def _drop_spatial_table(conn: sqlite3.Connection, tname: str):
+    """
+    Drop a table along with its geometry column registration and spatial index, so it can be written again.
+    """
+    for sql in [f"SELECT DropTable(NULL, '{tname}', 1);", f"SELECT DropGeoTable('{tname}');"]:
+        try:
+            conn.execute(sql)
+            break
+        except sqlite3.OperationalError:
+            #DropTable() is Spatialite 5; older versions only have DropGeoTable()
+            continue
+    conn.execute(f"DROP TABLE IF EXISTS {tname};")
 
 def write_spatial_table_into_db(gdf:gpd.geodataframe.GeoDataFrame = '', tname:str = '',geom_col:str = 'geometry',
-    index_col:str = '',index_name:str = '',keep_cols:list = [],spath:str = ''):
+    index_col:str = '',index_name:str = '',keep_cols:list = [],spath:str = '',db:LodesDatabase = None,batch_size:int = 50000):
     '''
     Write spatial dataframe into sqlite db. Designed to use geodataframe, with any given index column. 
-    Default creates a spatial index on the geometry column. Uses shapely to make geometry wkt.
+    Default creates a spatial index on the geometry column. Geometries are encoded to WKB in one vectorized call and
+    parsed straight into the table's Spatialite geometry column as they are inserted, in a single transaction.
 
     :param geopandas.GeoDataFrame gdf: GeoDataFrame you want in the Spatialite table.
-    :param str tname: Name you want for the table in SQLite DB. Passed to create_insert_fast.
+    :param str tname: Name you want for the table in SQLite DB.
     :param str geom_col: Name of the column to use for geometry.
     :param str index_col: Name of the column to use as a non-spatial index column.
     :param str index_name: Name of non-spatial index column.
     :param list keep_cols: Optional parameter of additional columns to retain in the SQLite DB.
     :param str spath: Path to SQLite database.
+    :param LodesDatabase db: Optional shared connections (with spatialite loaded) to use instead of connecting to spath.
+    :param int batch_size: Rows per insert batch.
+
+    Returns the number of features written, or False if the table or its indexes could not be made.
     '''
     
     print(f'processing {tname}')
 
     #slice dataframe into relevant parts
     try:
-        gdf = gdf[[index_col,geom_col] + keep_cols].copy()
+        gdf = gdf[[index_col,geom_col] + keep_cols]
     except:
         print(f"{tname}: error slicing")
-        return
+        return False
     
     #process for upload
     try:
         #convert to EPSG 4326
-        gdf = gdf.to_crs("EPSG:4326")
+        if gdf.crs.to_epsg() != 4326:
+            gdf = gdf.to_crs("EPSG:4326")
 
         #drop na geometries
         gdf = gdf.loc[~gdf[geom_col].isna()]
-    
-        #convert to wkb representation
-        gdf['wkb_geometry'] = gdf.apply(lambda x: shapely.wkb.dumps(x[geom_col],output_dimension=2), axis=1)
-        
-        #drop geometry
-        gdf = gdf.drop(columns=[geom_col])
 
+        #convert to wkb representation, all at once
+        frame = pd.DataFrame(gdf.drop(columns=[geom_col]))
+        frame['wkb_geometry'] = gdf[geom_col].to_wkb(output_dimension=2).values
     except:
         print(f"{tname}: error preparing for upload")
-        return
-        
-    
-    # write data into sqlite database
+        return False
+
+    # write data and geometry into sqlite database in one pass
     try:
         print(f'writing {tname} into database.')
-        create_and_insert_fast(frame=gdf, 
-            tname=tname, 
-            index_col=index_col,
-            index_name=index_name,
-            spath=spath)
-    except:
-        print(f"{tname}: error preparing for upload")
-        return
+        t0 = time.perf_counter()
+        cols = [c for c in frame.columns if c != 'wkb_geometry']
+        with connect(spath, db, spatialite=True) as conn:
+            _init_spatial(conn)
+            with load_pragmas(conn):
+                _drop_spatial_table(conn, tname)
+                conn.execute(f"CREATE TABLE {tname} (" + ", ".join(f'"{c}" {_sql_type(frame[c])}' for c in cols) + ");")
+                if not conn.execute(f"SELECT AddGeometryColumn('{tname}', 'geom', 4326, 'MULTIPOLYGON', 2);").fetchone()[0]:
+                    raise sqlite3.OperationalError("AddGeometryColumn failed")
+                names = ", ".join(f'"{c}"' for c in cols)
+                sql = (f"INSERT INTO {tname} ({names}, geom) "
+                       f"VALUES ({', '.join('?' * len(cols))}, ST_Multi(GeomFromWKB(?, 4326)));")
+                for k in range(0, frame.shape[0], batch_size):
+                    conn.executemany(sql, _to_rows(frame.iloc[k:k+batch_size]))
+        metrics.record_file('geometry', tname, time.perf_counter() - t0, rows=frame.shape[0])
+    except Exception as e:
+        print(f"{tname}: error making geometry ({e})")
+        return False
 
-    # make sqlite spatial
+    #make indexes once the rows are in
     try:
-        #load extensions
-        conn = sqlite3.connect(spath)
-        conn.enable_load_extension(True)
-        conn.execute('SELECT load_extension("mod_spatialite")')
-        conn.execute('SELECT InitSpatialMetaData();')
-        conn.commit()
+        with connect(spath, db, spatialite=True) as conn:
+            conn.execute(f"DROP INDEX IF EXISTS {index_name}")
+            conn.execute(f"CREATE INDEX {index_name} ON {tname}({index_col})")
 
-        #start cursor
-        crsr = conn.cursor()
+            #create spatial index on geometry
+            conn.execute(f"SELECT CreateSpatialIndex('{tname}', 'geom');")
+            conn.commit()
+    except:
+        print(f"{tname}: error making spatial index")
+        return False
+    print(f"processed {tname}")
+    return frame.shape[0]
 
-        #add multipolygon geometry column to original table
-        crsr.execute(fr"SELECT AddGeometryColumn('{tname}', 'geom', 4326, 'MULTIPOLYGON', 2);")
-        conn.commit()
-        
-        # update the yet empty geom column by parsing the well-known-binary objects from 
-        # the geometry column into Spatialite geometry objects
-        
-        crsr.execute(f"UPDATE {tname} SET geom=ST_Multi(GeomFromWKB(wkb_geometry, 4326));")
-        # drop the other geometry column which are not needed anymore 
-        # unfortunately, there is no DROP COLUMN support in sqlite3, 
-        # so a heavy workaround is needed to clean up via a temporary table.
-        # get a list of columns to use as the main columns you want, adding in the new geom column
-        # automatically will exclude wkb_geometry column
-        columns = str(tuple(gdf.columns.tolist() + ['geom'])).replace("(","").replace(")","").replace("'","")
-        
-        #create backup table with relevant data
-        crsr.execute(f"CREATE TABLE {tname}_backup({columns});")
-        crsr.execute(f"INSERT INTO {tname}_backup SELECT * from {tname};")
-        
-        #drop original table
-        crsr.execute(f"DROP TABLE {tname};")
+def load_blocks(geom_w:str = None, layer:str = None, id_col:str = 'GEOID20'):
+    '''
+    Prepares the blocks data to be loaded into the Spatialite
 
-        #create new table with columns and name to match desired table
-        crsr.execute(f"CREATE TABLE {tname}({columns});")
-    
-        #put everything back into original table
-        crsr.execute(f"INSERT INTO {tname} SELECT * FROM {tname}_backup;")
-        crsr.execute(f"DROP TABLE {tname}_backup;")
+    :param str geom_w: Path to the file or GeoDataBase containing the blocks, e.g. an NHGIS gdb or a TIGER/Line tabblock20 shapefile.
+    :param str layer: Layer holding the blocks, e.g. "Blocks_Texas_NHGIS_2020"; not needed for single-layer files.
+    :param str id_col: Column with the 15 digit block GEOID; it is renamed to geocode.
+    '''
+    print(f"loading blocks geometries...")
+    gdf = read_layer(geom_w, layer=layer)
+    gdf = gdf.rename(columns={id_col: 'geocode'})
+    print("Done")
+    return gdf
 
-        conn.commit()
-        crsr.close()
-        conn.close()
-    except:
-        print(f"{tname}: error making geometry")
-        return
+#FIPS codes for the state abbreviations used throughout, e.g. for TIGER/Line file names
+STATE_FIPS = {'al': '01', 'ak': '02', 'az': '04', 'ar': '05', 'ca': '06', 'co': '08', 'ct': '09', 'de': '10', 'dc': '11',
+              'fl': '12', 'ga': '13', 'hi': '15', 'id': '16', 'il': '17', 'in': '18', 'ia': '19', 'ks': '20', 'ky': '21',
+              'la': '22', 'me': '23', 'md': '24', 'ma': '25', 'mi': '26', 'mn': '27', 'ms': '28', 'mo': '29', 'mt': '30',
+              'ne': '31', 'nv': '32', 'nh': '33', 'nj': '34', 'nm': '35', 'ny': '36', 'nc': '37', 'nd': '38', 'oh': '39',
+              'ok': '40', 'or': '41', 'pa': '42', 'ri': '44', 'sc': '45', 'sd': '46', 'tn': '47', 'tx': '48', 'ut': '49',
+              'vt': '50', 'va': '51', 'wa': '53', 'wv': '54', 'wi': '55', 'wy': '56', 'pr': '72'}
+
+def tiger_layer_specs(folder:str = None, states:list = None, year:int = 2020, zcta:bool = True) -> list:
+    '''
+    Layer specs (see load_geometry_layers()) for Census TIGER/Line 2020 block, tract and ZCTA files saved in one folder,
+    as tl_2020_48_tabblock20.zip (or .shp), tl_2020_48_tract.zip and the national tl_2020_us_zcta520.zip.
+    Blocks and tracts from every state go into one table each. Tables and id columns match what the analysis
+    functions query: blocks_2020_geom (geocode), tracts_2020_geom (GEOID) and zcta_2020_geom (GEOID20).
+
+    :param str folder: Folder with the TIGER/Line files.
+    :param list states: Two letter state codes, e.g. ['tx','ok'].
+    :param int year: Vintage in the file and table names; the column names are the 2020 ones.
+    :param bool zcta: Include the national ZCTA layer.
+    '''
+    def find(stem):
+        for ext in ['.shp', '.zip']:
+            loc = os.path.join(folder, stem + ext)
+            if os.path.exists(loc):
+                return loc
+        print(f"Warning: no {stem}.shp or .zip in {folder}")
+        return None
+
+    specs = []
+    for st in states or []:
+        fips = STATE_FIPS[st.lower()]
+        specs.append({'source': find(f"tl_{year}_{fips}_tabblock20"), 'id_col': 'GEOID20', 'index_col': 'geocode',
+                      'keep_cols': ['STATEFP20','COUNTYFP20','TRACTCE20'], 'tname': f"blocks_{year}_geom",
+                      'index_name': 'blocks_index'})
+        specs.append({'source': find(f"tl_{year}_{fips}_tract"), 'id_col': 'GEOID',
+                      'keep_cols': ['STATEFP','COUNTYFP','TRACTCE'], 'tname': f"tracts_{year}_geom",
+                      'index_name': 'tracts_index'})
+    if zcta:
+        specs.append({'source': find(f"tl_{year}_us_zcta520"), 'id_col': 'GEOID20',
+                      'keep_cols': ['ZCTA5CE20','MTFCC20'], 'tname': f"zcta_{year}_geom", 'index_name': 'zcta_index'})
+    return [x for x in specs if x['source'] is not None]
+
+def read_layer(source:str = None, layer:str = None, columns:list = None) -> gpd.geodataframe.GeoDataFrame:
+    '''
+    Read one vector layer. Uses pyogrio's Arrow reader when pyogrio and pyarrow are installed, which skips building
+    Python objects feature by feature; otherwise falls back to geopandas.read_file().
 
-    #make spatial index
+    :param str source: Path to the file, gdb or zip.
+    :param str layer: Layer name; None for single-layer files.
+    :param list columns: Optional attribute columns to read; the rest are skipped.
+    '''
     try:
-        #reconnect 
-        conn = sqlite3.connect(spath)
-        conn.enable_load_extension(True)
-        conn.execute('SELECT load_extension("mod_spatialite")')
+        import pyogrio
+    except ImportError:
+        pyogrio = None
+    if pyogrio is not None:
+        try:
+            return pyogrio.read_dataframe(source, layer=layer, columns=columns, use_arrow=True)
+        except ImportError:
+            #pyogrio without pyarrow
+            return pyogrio.read_dataframe(source, layer=layer, columns=columns)
+    gdf = gpd.read_file(source, layer=layer)
+    if columns is not None:
+        gdf = gdf[[c for c in columns if c in gdf.columns] + [gdf.geometry.name]]
+    return gdf
 
-        #start cursor
-        crsr = conn.cursor()
-         #create index
-        crsr.execute(f"DROP INDEX IF EXISTS {tname}_index")
-        crsr.execute(f"CREATE INDEX {index_name} ON {tname}({index_col})")
-        
-        #create spatial index on geometry
-        crsr.execute(f"SELECT CreateSpatialIndex('{tname}', 'geom');")
-        
-        #commit and close
-        conn.commit()
-        crsr.close()
-        conn.close()
-    except:
-        print(f"{tname}: error making spatial index")
-    print(f"processed {tname}")
+def _prepare_layer(spec:dict) -> gpd.geodataframe.GeoDataFrame:
+    '''
+    read one layer spec, keep its id and keep columns (id renamed to index_col) and reproject to EPSG:4326.
+    '''
+    t0 = time.perf_counter()
+    index_col = spec.get('index_col', spec['id_col'])
+    keep_cols = list(spec.get('keep_cols', []))
+    gdf = read_layer(spec['source'], layer=spec.get('layer'), columns=[spec['id_col']] + keep_cols)
+    gdf = gdf.rename(columns={spec['id_col']: index_col})
+    gdf = gdf.rename_geometry('geometry') if gdf.geometry.name != 'geometry' else gdf
+    gdf = gdf[[index_col] + keep_cols + ['geometry']]
+    if gdf.crs.to_epsg() != 4326:
+        gdf = gdf.to_crs("EPSG:4326")
+    metrics.record_file('read_layer', spec.get('layer') or os.path.basename(spec['source']), time.perf_counter() - t0,
+        rows=gdf.shape[0])
+    return gdf
 
-def load_blocks(geom_w:str = None):
+def load_geometry_layers(spath:str = None, layers:list = None, workers:int = 4, db:LodesDatabase = None) -> dict:
     '''
-    Prepares the blocks data to be loaded into the Spatialite
+    Load reference geometries into the Spatialite db from a list of layer specs. Layers are read and reprojected
+    concurrently; layers that share a target table (e.g. the blocks of several states) are stacked into one table,
+    which is written as soon as all its layers are read while the rest keep reading.
+    Returns a dictionary of table name to features written (None if it failed).
+
+    Each spec is a dictionary with:
+        source - path to the file, gdb or zip
+        layer - layer name, optional for single-layer files
+        id_col - id column in the source
+        index_col - optional name for the id column in the table, defaults to id_col
+        keep_cols - optional list of other columns to keep
+        tname - table to write, e.g. 'blocks_2020_geom'
+        index_name - name of the index on the id column
 
-    :param str geom_w: Path to the location of GeoDataBase containing the blocks. Sourced from NHGIS.
+    :param str spath: Path to the location of Spatialite database.
+    :param list layers: Layer specs (hint: output of tiger_layer_specs()).
+    :param int workers: Number of layers to read at once.
+    :param LodesDatabase db: Optional shared connections to write through instead of connecting to spath.
     '''
-    
-    import geopandas as gpd
-    print(f"loading blocks geometries...")
-    gdf = gpd.read_file(geom_w,layer="Blocks_Texas_NHGIS_2020")
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    if not layers:
+        print("no layers to load (hint: tiger_layer_specs(folder, ['tx']))")
+        return {}
+
+    pending = {}
+    for spec in layers:
+        pending[spec['tname']] = pending.get(spec['tname'], 0) + 1
+    frames = {t: [] for t in pending}
+    written = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(_prepare_layer, spec): spec for spec in layers}
+        for future in as_completed(futures):
+            spec = futures[future]
+            tname = spec['tname']
+            try:
+                gdf = future.result()
+                if frames[tname] is not None:
+                    frames[tname].append(gdf)
+            except Exception as e:
+                print(f"could not read {spec.get('layer') or spec['source']}: {e}")
+                frames[tname] = None
+            pending[tname] -= 1
+            if pending[tname] > 0:
+                continue
+
+            #all of this table's layers are in
+            if frames[tname] is None:
+                written[tname] = None
+                continue
+            gdf = gpd.GeoDataFrame(pd.concat(frames.pop(tname), ignore_index=True), geometry='geometry', crs="EPSG:4326")
+            index_col = spec.get('index_col', spec['id_col'])
+            rows = write_spatial_table_into_db(gdf=gdf,
+                tname=tname,
+                geom_col='geometry',
+                index_col=index_col,
+                index_name=spec['index_name'],
+                keep_cols=list(spec.get('keep_cols', [])),
+                spath=spath,
+                db=db)
+            written[tname] = None if rows is False else rows
+    return written
+
+def _parse_worker(tasks, out_q, chunksize: int = None, geocode_type: str = 'text', memory_mb: float = 256):
+    """
+    Process-pool worker for load_lodes_into_db(workers > 1). Takes csv paths off tasks until it gets None, parses each
+    into typed chunks and puts them on out_q using the _drain_queue() message protocol.
+    """
+    while True:
+        file_path = tasks.get()
+        if file_path is None:
+            return
+        tname = _table_name(file_path)
+        file_type = _file_type(file_path)
+        try:
+            out_q.put(('start', tname, file_type, os.getpid()))
+            for chunk in read_in_chunks(file_path, chunksize=chunksize, geocode_type=geocode_type, memory_mb=memory_mb):
+                out_q.put(('rows', tname, chunk))
+            out_q.put(('done', tname, file_type, _source_meta(file_path)))
+        except Exception as e:
+            out_q.put(('error', tname, str(e)))
+
+def _load_parallel(paths:list, spath:str, workers:int = 4, queue_depth:int = 8, chunksize:int = None,
+    layout:str = 'per_file', geocode_type:str = 'text', indexes:str = 'inline', covering:bool = False,
+    clustered:bool = False, db:LodesDatabase = None, backend:str = 'sqlite', parquet_root:str = None,
+    memory_mb:float = 256) -> dict:
+    """
+    Parse csvs in a pool of processes and write them through one writer connection in this process.
+    memory_mb is shared by every chunk that can be in flight at once: one per worker, the queue, and the writer's.
+    Returns a dictionary of table name to rows written (None for failed files). A worker that crashes (e.g. is killed
+    for running out of memory) fails the file it was on; the other workers carry on with the rest.
+    """
+    import multiprocessing as mp
+
+    ctx = mp.get_context()
+    tasks = ctx.Queue()
+    out_q = ctx.Queue(maxsize=queue_depth)
+    for q in paths:
+        tasks.put(q)
+    for _ in range(workers):
+        tasks.put(None)
+
+    chunk_mb = memory_mb / (workers + queue_depth + 1)
+    procs = [ctx.Process(target=_parse_worker, args=(tasks, out_q, chunksize, geocode_type, chunk_mb), daemon=True)
+             for _ in range(workers)]
+    for proc in procs:
+        proc.start()
     try:
-        gdf['geocode'] = gdf['GEOID20']
+        rows = _drain_queue(out_q, len(paths), spath, layout, indexes=indexes, covering=covering, clustered=clustered,
+            db=db, backend=backend, parquet_root=parquet_root, producers=procs)
     except:
-        print("No column called geocode")
-    gdf.drop(columns=['GEOID20'],inplace=True)
-    print("Done")
-    return gdf
+        #don't leave workers blocked on a full queue
+        for proc in procs:
+            proc.terminate()
+        raise
+    for proc in procs:
+        proc.join()
+    #files no worker got to, because every worker died first
+    for q in paths:
+        rows.setdefault(_table_name(q), None)
+    return rows
 
-def load_lodes_into_db(folder_path:str = None,spath:str = None,base_only:bool=False):
+def load_lodes_into_db(folder_path:str = None,spath:str = None,base_only:bool=False,geocode_type:str='text',layout:str='per_file',
+    workers:int=1,queue_depth:int=8,chunksize:int=None,indexes:str='inline',covering:bool=False,clustered:bool=False,
+    db:LodesDatabase=None,rollups:list=None,backend:str='sqlite',parquet_root:str=None,memory_mb:float=256,
+    resume:bool=True) -> dict:
     '''
-    Reads and then loads all the LODES tabular data into Spatialite db. 
+    Reads and then loads all the LODES tabular data into Spatialite db. Each file is tracked in the lodes_sources ledger
+    (path, size, hash, row count, status and timing; see get_load_ledger()), so a load that dies partway can be rerun:
+    files that already loaded completely from the same bytes are skipped, and failed or unfinished ones are loaded again.
+    Ends by printing what loaded, what was skipped, and what is missing. Returns a dictionary of 'loaded', 'skipped',
+    'failed' (table name to error) and 'missing' (never finished) file table names, and the 'rows' loaded; None for the
+    parquet-only backend, which has no ledger. The load's duration, rows and memory are reported to metrics.
 
     :param str folder_path: Path to the location of unzipped lodes data; output of the unzip_all() functions.
     :param str spath: Path to the location of Spatialite database.
     :param bool base_only: If True, builds the database with only the bare minimum tables for analysis- JT00 and JT01.
+    :param str geocode_type: 'text' stores geocodes as fixed-width TEXT, 'integer' as INTEGER. Counts and year are always INTEGER.
+    :param str layout: 'per_file' makes one table per csv, e.g. tx_wac_S000_JT00_2019. 'consolidated' makes one od, rac and wac
+        table per state (tx_od, tx_rac, tx_wac) with year, jt and segment (rac/wac) or part (od) columns and composite indexes.
+    :param int workers: 1 reads and writes each file in turn. More than 1 parses files in that many processes and feeds the
+        typed chunks through a bounded queue to a single writer connection, so parsing and inserts overlap without
+        SQLite lock contention. On Windows the calling script must be guarded by if __name__ == "__main__".
+    :param int queue_depth: Parsed chunks that can wait for the writer before the workers pause (workers > 1 only).
+    :param int chunksize: Rows per parsed chunk; by default as many as fit the memory budget.
+    :param str indexes: 'inline' indexes each table as it is loaded. 'deferred' loads every file with no indexes and then
+        builds them all in one pass with build_indexes(), which is faster for large loads. 'none' leaves them for you
+        to build later, e.g. after merging databases.
+    :param bool covering: Add the total jobs column (S000/C000) to the geocode indexes so common pulls never read the table.
+    :param bool clustered: Create the tables as WITHOUT ROWID tables keyed on geocode (see _primary_key()), so rows are
+        stored in geocode order and the main geocode lookup needs no separate index. The tables are analyzed once
+        loaded (see analyze_tables()), so lookups on the other geocode still use its index.
+    :param LodesDatabase db: Optional shared connections to write through. Without one, a single connection is opened
+        for the whole load and reused for every file.
+    :param list rollups: Optional crosswalk levels (see ROLLUP_LEVELS, e.g. ['trct','cty']) to materialize the loaded
+        od/rac/wac tables at once they are in, with build_rollups(). Needs the state's crosswalk in the same load or db.
+    :param str backend: 'sqlite' loads the Spatialite db. 'parquet' writes only a hive-partitioned, zstd-compressed Parquet
+        dataset under parquet_root (state=/type=/year=/jt=/segment= folders, part= for od) for columnar queries with
+        DuckDB (hint: analysis.generate_query(parquet_root=...)). 'both' does both from one read. Parquet needs pyarrow.
+    :param str parquet_root: Folder of the Parquet dataset, for the parquet backends.
+    :param float memory_mb: Rough budget in MB for the rows held in memory at once. Files are read and inserted in chunks
+        sized to it, so peak memory stays flat however large the file; with workers > 1 it is split across the chunks in flight.
+    :param bool resume: Skip files the ledger says are already loaded and unchanged. False reloads everything.
     '''
+    if backend not in ['sqlite','parquet','both']:
+        print(f"Error: '{backend}' passed as backend.\nMust pass 'sqlite', 'parquet' or 'both'")
+        return
+    if (backend != 'sqlite') and (parquet_root is None):
+        print("Must pass a parquet_root for the parquet backends.")
+        return
 
     try:
         #get the file paths into 3 bunches
-        racs,wacs,ods,cw = get_file_paths(folder_path=fr"{folder_path}\**\*.*")
+        racs,wacs,ods,cw = get_file_paths(folder_path=os.path.join(folder_path, "**", "*.*"))
         
         if base_only == True:
-            ods = [q for q in ods if any(x in q for x in ["JT00","JT01"])]
-            racs = [q for q in racs if any(x in q for x in ["JT00","JT01"])]
-            racs = [q for q in racs if any(x in q for x in ["S000"])]
-            
-            wacs = [q for q in wacs if any(x in q for x in ["JT00","JT01"])]
-            wacs = [q for q in wacs if any(x in q for x in ["S000"])]
+            ods = _keep_base_only(ods)
+            racs = _keep_base_only(racs)
+            wacs = _keep_base_only(wacs)
     except:
         print("could not find file paths")
-        #return
+        return
 
-    #load in racs
+    own_db = db is None
+    if own_db:
+        db = LodesDatabase(spath, pool_size=1, spatialite=False)
+    paths = racs + wacs + ods + cw
+    summary = None
     try:
-        start = time.strftime("%H:%M:%S")
-        print(f"rac start time: {start}")                
-        counter = len(racs)
-        for i,q in enumerate(racs):
-            if (i % 25 == 0) or (i+1 == counter):
-                print(f"{((i+1)/counter):.1%} complete...")
-            try:
-                #read in
-                table_name = q.split("\\")[-1].replace(".csv","")
-                dfm = read_in_data(file_path = q)
-                #upload
-                create_and_insert_fast(frame=dfm, 
-                    tname=table_name,
-                    index_col="h_geocode",
-                    index_name=f"{table_name}_main_index",
-                    spath=spath) 
-            except:
-                print(f"error on {q}")
-        end = time.strftime("%H:%M:%S")
-        print(f"rac end time: {end}")     
-    except:
-        print("rac upload unsuccessful")
-            
-    #load in wacs
-    try:
-        start = time.strftime("%H:%M:%S")
-        print(f"wac start time: {start}")                
-        counter = len(wacs)
-        for i,q in enumerate(wacs):
-            if (i % 25 == 0) or (i+1 == counter):
-                print(f"{((i+1)/counter):.1%} complete...")
-            try:
-                #read in
-                table_name = q.split("\\")[-1].replace(".csv","")
-                dfm = read_in_data(file_path = q)
-                #upload
-                create_and_insert_fast(frame=dfm, 
-                    tname=table_name,
-                    index_col="w_geocode",
-                    index_name=f"{table_name}_main_index",
-                    spath=spath) 
-            except:
-                print(f"error on {q}")
-
-        end = time.strftime("%H:%M:%S")
-        print(f"wac end time: {end}")   
+        with metrics.stage('load', folder=folder_path, layout=layout, workers=workers, backend=backend) as m:
+            #pick up where an earlier load left off
+            skipped = []
+            if resume and (backend != 'parquet'):
+                ledger = get_load_ledger(db=db)
+                with connect(db=db) as cnx:
+                    done = _already_loaded(paths, layout, ledger, cnx)
+                skipped = [q for q in paths if q in done]
+                racs, wacs, ods, cw = [[q for q in group if q not in done] for group in [racs, wacs, ods, cw]]
+                if skipped:
+                    print(f"skipping {len(skipped)} of {len(paths)} files already loaded")
+                    if indexes != 'none':
+                        _index_skipped(skipped, racs + wacs + ods + cw, layout, covering, db)
 
-    except:
-        print("wac upload unsuccessful")
+            _load_all(racs, wacs, ods, cw, spath, db, layout=layout, geocode_type=geocode_type, workers=workers,
+                queue_depth=queue_depth, chunksize=chunksize, indexes=indexes, covering=covering, clustered=clustered,
+                backend=backend, parquet_root=parquet_root, memory_mb=memory_mb)
+            m['files'] = len(paths) - len(skipped)
+            if backend != 'parquet':
+                summary = _load_summary(paths, skipped, db)
+                m['rows'] = summary['rows']
+                m['failed'] = len(summary['failed']) + len(summary['missing'])
+        if rollups and (backend != 'parquet'):
+            loaded = sorted({_target(q, layout)[0] for q in paths if _file_type(q) != 'xwalk'})
+            build_rollups(spath, levels=rollups, tables=loaded, db=db)
+    finally:
+        if own_db:
+            db.close()
+    return summary
 
-    #load in od 
-    try:
-        start = time.strftime("%H:%M:%S")
-        print(f"od start time: {start}")                
-        counter = len(ods)
-        for i,q in enumerate(ods):
-            if (i % 25 == 0) or (i+1 == counter):
-                print(f"{((i+1)/counter):.1%} complete...")
+def _index_skipped(skipped:list, pending:list, layout:str, covering:bool, db:LodesDatabase):
+    """
+    Make sure the tables of files skipped on a resume have their indexes; an earlier run may have died before its
+    deferred index pass. Tables this run loads into are left to it, and indexes already there are kept.
+    """
+    tables = {_target(q, layout)[0] for q in skipped} - {_target(q, layout)[0] for q in pending}
+    with connect(db=db) as cnx:
+        for name, file_type, table_layout, primary_key in _lodes_tables(cnx):
+            if name in tables:
+                _create_indexes(cnx, name, _wanted_indexes(file_type, name, table_layout, covering, primary_key))
+        cnx.commit()
+
+def _load_summary(paths:list, skipped:list, db:LodesDatabase) -> dict:
+    """
+    Sort a load's files into loaded, skipped, failed and missing from the ledger, and print it.
+    """
+    ledger = get_load_ledger(db=db)
+    passed = {_table_name(q) for q in skipped}
+    summary = {'loaded': [], 'skipped': [], 'failed': {}, 'missing': [], 'rows': 0}
+    for q in paths:
+        name = _table_name(q)
+        status = (ledger.get(name) or {}).get('status')
+        if name in passed:
+            summary['skipped'].append(name)
+        elif status == 'done':
+            summary['loaded'].append(name)
+            summary['rows'] += ledger[name].get('row_count') or 0
+        elif status == 'failed':
+            summary['failed'][name] = ledger[name].get('error')
+        else:
+            summary['missing'].append(name)
+    print(f"loaded {len(summary['loaded'])}, skipped {len(summary['skipped'])} already loaded, "
+          f"failed {len(summary['failed'])}, missing {len(summary['missing'])} of {len(paths)} files")
+    for name, error in summary['failed'].items():
+        print(f"  failed: {name} ({error})")
+    for name in summary['missing']:
+        print(f"  missing: {name}")
+    if summary['failed'] or summary['missing']:
+        print("rerun to load them; files already in are skipped")
+    return summary
+
+def _load_all(racs:list, wacs:list, ods:list, cw:list, spath:str, db:LodesDatabase, layout:str = 'per_file',
+    geocode_type:str = 'text', workers:int = 1, queue_depth:int = 8, chunksize:int = None, indexes:str = 'inline',
+    covering:bool = False, clustered:bool = False, backend:str = 'sqlite', parquet_root:str = None, memory_mb:float = 256):
+    """
+    load_lodes_into_db() once the file lists and connections are sorted out.
+    """
+    if backend == 'parquet':
+        indexes = 'none'
+
+    #consolidated tables already in the db keep their indexes; drop them so the load doesn't maintain them row by row
+    targets = sorted({_target(q, layout)[0] for q in racs + wacs + ods + cw})
+    if (indexes != 'inline') and (backend != 'parquet'):
+        drop_indexes(spath, tables=targets, db=db)
+
+    #parse across processes with one writer
+    if workers > 1:
+        paths = racs + wacs + ods + cw
+        print(f"loading {len(paths)} files with {workers} parse workers")
+        try:
+            rows = _load_parallel(paths, spath, workers=workers, queue_depth=queue_depth, chunksize=chunksize,
+                layout=layout, geocode_type=geocode_type, indexes=indexes, covering=covering, clustered=clustered, db=db,
+                backend=backend, parquet_root=parquet_root, memory_mb=memory_mb)
+            for t, r in rows.items():
+                if r is None:
+                    print(f"error on {t}")
+        except Exception as e:
+            print(f"parallel load unsuccessful: {e}")
+        if indexes == 'deferred':
+            build_indexes(spath, tables=targets, covering=covering, db=db)
+        elif clustered and (indexes == 'inline') and (backend != 'parquet'):
+            analyze_tables(spath, tables=targets, db=db)
+        return
+
+    #load in racs, wacs, od and cw
+    for label, paths in [('rac', racs), ('wac', wacs), ('od', ods), ('cw', cw)]:
+        try:
+            counter = len(paths)
+            for i,q in enumerate(paths):
+                metrics.progress('load', i+1, counter, file_type=label)
+                try:
+                    if not _load_file(q, spath, layout=layout, geocode_type=geocode_type, indexes=indexes,
+                        covering=covering, clustered=clustered, db=db, backend=backend, parquet_root=parquet_root,
+                        memory_mb=memory_mb, chunksize=chunksize):
+                        print(f"error on {q}")
+                except:
+                    print(f"error on {q}")
+        except:
+            print(f"{label} upload unsuccessful")
+
+    if indexes == 'deferred':
+        build_indexes(spath, tables=targets, covering=covering, db=db)
+    elif clustered and (indexes == 'inline') and (backend != 'parquet'):
+        analyze_tables(spath, tables=targets, db=db)
+
+def _build_state_db(folder_path:str, spath:str, overwrite:bool, options:dict) -> dict:
+    """
+    Process-pool task for build_state_dbs(): load one state's folder into its own database.
+    """
+    if overwrite and os.path.exists(spath):
+        os.remove(spath)
+    return load_lodes_into_db(folder_path=folder_path, spath=spath, **options)
+
+def build_state_dbs(folders:dict = None, part_dir:str = None, workers:int = None, overwrite:bool = False,
+    memory_mb:float = 1024, **options) -> dict:
+    '''
+    Load each state's LODES files into its own database file in part_dir (e.g. parts/tx.db), one process per state,
+    for merge_databases() to combine. The part databases get no indexes, since the merge builds them once at the end.
+    On Windows the calling script must be guarded by if __name__ == "__main__".
+    Returns a dictionary of state to (part database path, load summary); the summary is None if the state's load failed.
+
+    :param dict folders: State code to its folder of unzipped LODES files (hint: output of download_states()).
+    :param str part_dir: Folder to write the part databases to; made if it doesn't exist.
+    :param int workers: States to load at once; defaults to one per state, up to the number of CPUs.
+    :param bool overwrite: Start each part database from scratch. False resumes loads into any part databases already there.
+    :param float memory_mb: Rough memory budget in MB for the whole build, split between the processes.
+    :param options: Passed on to load_lodes_into_db(), e.g. base_only, layout, geocode_type, clustered, resume.
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+
+    os.makedirs(part_dir, exist_ok=True)
+    workers = workers or min(len(folders), os.cpu_count() or 1)
+    options = {**options, 'indexes': 'none', 'workers': 1, 'rollups': None, 'backend': 'sqlite',
+               'memory_mb': memory_mb / max(1, workers)}
+    parts = {st: os.path.join(part_dir, f"{st}.db") for st in folders}
+
+    out = {}
+    with metrics.stage('state_builds', states=list(folders), workers=workers) as m, \
+            ProcessPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {st: pool.submit(_build_state_db, folders[st], parts[st], overwrite, options) for st in folders}
+        for st, future in futures.items():
             try:
-                #read in
-                table_name = q.split("\\")[-1].replace(".csv","")
-                dfm = read_in_data(file_path = q)
-                #upload
-                create_and_insert_fast(frame=dfm, 
-                    tname=table_name,
-                    index_col="h_geocode",
-                    index_name=f"{table_name}_od_hgeocode_index",
-                    spath=spath) 
-                cnx = sqlite3.connect(spath)
-                crsr = cnx.cursor()
-
-                #add second index
-                crsr.execute(f"DROP INDEX IF EXISTS {table_name}_od_wgeocode_index")
-                crsr.execute(f"CREATE INDEX {table_name}_od_wgeocode_index ON {table_name} (w_geocode)")
-            except:
-                print(f"error on {q}")
-
-        end = time.strftime("%H:%M:%S")
-        print(f"od end time: {end}")  
-    except:
-        print("od upload unsuccessful")  
+                out[st] = (parts[st], future.result())
+            except Exception as e:
+                print(f"{st}: build unsuccessful ({e})")
+                out[st] = (parts[st], None)
+        m['files'] = sum(len(summary['loaded']) for _, summary in out.values() if summary is not None)
+        m['rows'] = sum(summary['rows'] for _, summary in out.values() if summary is not None)
+    return out
 
-    #load in cw 
-    try:
-        start = time.strftime("%H:%M:%S")
-        print(f"cw start time: {start}")                
-        counter = len(cw)
-        for i,q in enumerate(cw):
-            if (i % 25 == 0) or (i+1 == counter):
-                print(f"{((i+1)/counter):.1%} complete...")
+def merge_databases(spath:str = None, parts:list = None, indexes:bool = True, covering:bool = False,
+    db:LodesDatabase = None) -> dict:
+    '''
+    Combine LODES databases (hint: output of build_state_dbs()) into spath without re-reading any csv. Each part is
+    ATTACHed in turn and its LODES tables copied with one INSERT ... SELECT apiece, keeping their schema (clustered tables
+    stay clustered); a table already in spath is replaced. Copying into a fresh table with no indexes lets SQLite move
+    the pages across as they are. The parts' lodes_sources ledgers are merged too. Indexes are built once at the end.
+    Returns a dictionary of table name to rows copied.
+
+    :param str spath: Path to the database to merge into (hint: make it with build_db()).
+    :param list parts: Paths to the databases to merge in.
+    :param bool indexes: Build the merged tables' indexes afterwards with build_indexes(). False leaves them for you.
+    :param bool covering: Build covering indexes (see _index_specs()).
+    :param LodesDatabase db: Optional shared connections to use instead of opening one on spath.
+    '''
+    merged = {}
+    with metrics.stage('merge', parts=len(parts)) as m, connect(spath, db) as cnx:
+        cnx.execute("PRAGMA max_page_count = 2147483646;")
+        _ensure_ledger(cnx)
+        cnx.commit()
+        ledger_cols = [c for c, _ in _LEDGER_COLUMNS]
+        for part in parts:
+            if not os.path.exists(part):
+                print(f"no database at {part}; skipping it")
+                continue
+            t0 = time.perf_counter()
+            cnx.execute("ATTACH DATABASE ? AS part;", (part,))
             try:
-                #read in
-                table_name = q.split("\\")[-1].replace(".csv","")
-                dfm = read_in_data(file_path = q)
-                #upload
-                create_and_insert_fast(frame=dfm, 
-                    tname=table_name,
-                    index_col="tabblk2020",
-                    index_name=f"{table_name}_tabblk2020_index",
-                    spath=spath) 
-                cnx = sqlite3.connect(spath)
-                crsr = cnx.cursor()
-            except:
-                print(f"error on {q}")
-
-        end = time.strftime("%H:%M:%S")
-        print(f"cw end time: {end}")  
-    except:
-        print("cw upload unsuccessful")  
+                sqls = dict(cnx.execute("SELECT name, sql FROM part.sqlite_master WHERE type='table';").fetchall())
+                with load_pragmas(cnx):
+                    for name, _, _, _ in _lodes_tables(cnx, schema='part'):
+                        cnx.execute(f'DROP TABLE IF EXISTS main."{name}";')
+                        cnx.execute(sqls[name])
+                        merged[name] = cnx.execute(f'INSERT INTO main."{name}" SELECT * FROM part."{name}";').rowcount
+                    if 'lodes_sources' in sqls:
+                        have = {r[1] for r in cnx.execute("PRAGMA part.table_info(lodes_sources);")}
+                        cols = ", ".join(c for c in ledger_cols if c in have)
+                        cnx.execute(f"INSERT OR REPLACE INTO main.lodes_sources ({cols}) SELECT {cols} FROM part.lodes_sources;")
+            except Exception as e:
+                print(f"{part}: could not merge ({e})")
+            finally:
+                cnx.execute("DETACH DATABASE part;")
+            metrics.record_file('merge', part, time.perf_counter() - t0, bytes=os.path.getsize(part))
+        m['files'] = len(merged)
+        m['rows'] = sum(merged.values())
+
+    if indexes and merged:
+        build_indexes(spath, tables=list(merged), covering=covering, db=db)
+    return merged
 
-    print("done loading all in")
+def build_regional_db(spath:str = None, folders:dict = None, part_dir:str = None, workers:int = None,
+    overwrite:bool = True, keep_parts:bool = False, covering:bool = False, rollups:list = None, **options) -> dict:
+    '''
+    Build a multi-state LODES database: each state is loaded into its own part database in parallel processes
+    (build_state_dbs()), then the parts are merged into spath (merge_databases()) and indexed once. Much faster than
+    loading the states one after another into one file. On Windows the calling script must be guarded by
+    if __name__ == "__main__". Returns a dictionary of state to its load summary (see load_lodes_into_db()).
 
-def load_geometries_into_db(spath : str = None):
+    :param str spath: Path to the location of the Spatialite database.
+    :param dict folders: State code to its folder of unzipped LODES files (hint: output of download_states()).
+    :param str part_dir: Folder for the part databases; defaults to a _parts folder next to spath.
+    :param int workers: States to load at once.
+    :param bool overwrite: Start spath and the parts from scratch. False keeps spath and resumes into kept parts.
+    :param bool keep_parts: Keep the part databases after merging, e.g. to rerun a merge or resume later.
+    :param bool covering: Build covering indexes (see _index_specs()).
+    :param list rollups: Optional crosswalk levels to materialize once merged (see build_rollups()).
+    :param options: Passed on to load_lodes_into_db(), e.g. base_only, layout, geocode_type, clustered, memory_mb.
     '''
-    Reads and then loads into the database a series of geometry files for reference. 
-    Largely custom; check paths and files. Original geometry data is from NHGIS. 
+    part_dir = part_dir or f"{os.path.splitext(spath)[0]}_parts"
+    build_db(spath, overwrite=overwrite)
+    built = build_state_dbs(folders, part_dir, workers=workers, overwrite=overwrite, **options)
+    merged = merge_databases(spath, [p for p, summary in built.values() if summary is not None], covering=covering)
+    if rollups and merged:
+        build_rollups(spath, levels=rollups, tables=[t for t in merged if _file_type(t) != 'xwalk'])
+
+    if not keep_parts:
+        for part, _ in built.values():
+            if os.path.exists(part):
+                os.remove(part)
+        if not os.listdir(part_dir):
+            os.rmdir(part_dir)
+    return {st: summary for st, (_, summary) in built.items()}
+
+def load_geometries_into_db(spath : str = None, layers : list = None, workers : int = 4, db : LodesDatabase = None):
+    '''
+    Reads and then loads into the database a series of geometry files for reference.
+    Blocks, tracts and ZCTAs for any states come from layer specs, e.g. tiger_layer_specs(folder, ['tx','ok']).
+    Returns a dictionary of table name to features written (see load_geometry_layers()), empty if no layers were passed.
 
     :param str spath: Path to the location of Spatialite database.
+    :param list layers: Layer specs, see load_geometry_layers().
+    :param int workers: Number of layers to read at once.
+    :param LodesDatabase db: Optional shared connections to write through instead of connecting to spath.
     '''
+    if not layers:
+        print("no layers to load (hint: tiger_layer_specs(folder, ['tx']))")
+        return {}
+    with metrics.stage('geometry', layers=len(layers)) as m:
+        written = load_geometry_layers(spath=spath, layers=layers, workers=workers, db=db)
+        m['files'] = len([t for t, n in written.items() if n is not None])
+        m['rows'] = sum(n for n in written.values() if n)
+    return written
 
-    
-    start = time.strftime("%H:%M:%S")
-    print(f"load blocks start time: {start}")  
-    b_gdf = load_blocks(r"C:\Users\cmg0003\Desktop\BackgroundLayers.gdb")
-    b_gdf = b_gdf.to_crs("EPSG:4326")
-
-    start = time.strftime("%H:%M:%S")
-    print(f"load tracts start time: {start}")  
-    t_gdf = gpd.read_file(r"C:\Users\cmg0003\Desktop\BackgroundLayers.gdb",layer="Tracts_State_NHGIS_Projected_2020")
-    t_gdf = t_gdf.to_crs("EPSG:4326")
-
-    start = time.strftime("%H:%M:%S")
-    print(f"load zcta start time: {start}")  
-    z_gdf = gpd.read_file(r"C:\Users\cmg0003\Desktop\BackgroundLayers.gdb",layer="ZCTA_State_NHGIS_Projected_2020")
-    z_gdf = z_gdf.to_crs("EPSG:4326")
-
-    start = time.strftime("%H:%M:%S")
-    print(f"write blocks start time: {start}")  
-
-    write_spatial_table_into_db(gdf = b_gdf, 
-        tname = "blocks_2020_geom", 
-        geom_col = 'geometry',
-        index_col="geocode",
-        index_name="blocks_index", 
-        keep_cols=['GISJOIN','STATEFP20','COUNTYFP20','TRACTCE20'],
-        spath=spath)
-
-    start = time.strftime("%H:%M:%S")
-    print(f"write tract start time: {start}")  
-    write_spatial_table_into_db(gdf = t_gdf, 
-        tname = "tracts_2020_geom", 
-        geom_col = 'geometry',
-        index_col="GEOID",
-        index_name="tracts_index", 
-        keep_cols=['STATEFP','COUNTYFP','TRACTCE'],
-        spath=spath)
-        
-    start = time.strftime("%H:%M:%S")
-    print(f"write zcta start time: {start}")  
-    write_spatial_table_into_db(gdf = z_gdf, 
-        tname = "zcta_2020_geom", 
-        geom_col = 'geometry',
-        index_col ="GEOID20",
-        index_name ="zcta_index", 
-        keep_cols=['ZCTA5CE20','MTFCC20','GISJOIN'],
-        spath=spath)
-
-    end = time.strftime("%H:%M:%S")
-    print(f"full geom load in end time: {end}")   
-    print("done loading up geometries")
+def optimize_db(spath:str = None, out_path:str = None, page_size:int = 32768, analysis_limit:int = None,
+    read_only:bool = False) -> str:
+    '''
+    Finalize a LODES database for reading, once every load (load_lodes_into_db(), load_geometries_into_db(), rollups)
+    is done. ANALYZE gathers the statistics the query planner uses to pick indexes, then VACUUM INTO writes a compacted
+    copy with every table and index stored contiguously, no free pages, and a larger page size, which suits the long
+    index range scans LODES queries do. Optionally the result is made read-only on disk, so it can safely be opened
+    with analysis.connect_to_od(read_only=True) or LodesDatabase(read_only=True, immutable=True).
+    Returns the path of the optimized database.
+
+    :param str spath: Path to the database to optimize. Close other connections to it first.
+    :param str out_path: Where to write the optimized copy. Defaults to replacing spath with it.
+    :param int page_size: Page size of the optimized copy in bytes, a power of two from 512 to 65536.
+    :param int analysis_limit: Optional rows ANALYZE samples per index (PRAGMA analysis_limit), to bound its time on very
+        large tables; by default it reads everything.
+    :param bool read_only: Remove write permission from the optimized file.
+    '''
+    if (page_size < 512) or (page_size > 65536) or (page_size & (page_size - 1)):
+        print(f"Error: page_size must be a power of two from 512 to 65536, not {page_size}")
+        return
+    if not os.path.exists(spath):
+        print(f"no database at {spath}")
+        return
+    target = out_path or f"{spath}.optimizing"
+    if os.path.exists(target):
+        os.remove(target)
+
+    before = os.path.getsize(spath)
+    with metrics.stage('optimize', page_size=page_size) as m:
+        with connect(spath) as cnx:
+            t0 = time.perf_counter()
+            if analysis_limit:
+                cnx.execute(f"PRAGMA analysis_limit = {int(analysis_limit)};")
+            cnx.execute("ANALYZE;")
+            cnx.commit()
+            metrics.record_file('optimize', 'analyze', time.perf_counter() - t0)
+
+            #VACUUM INTO builds the copy with the page size asked for on the source connection
+            t0 = time.perf_counter()
+            cnx.execute(f"PRAGMA page_size = {int(page_size)};")
+            cnx.execute("VACUUM INTO ?;", (target,))
+            metrics.record_file('optimize', 'vacuum', time.perf_counter() - t0, bytes=before)
+        with connect(target) as cnx:
+            #readers of an immutable file never look for a wal, so keep the copy in rollback journal mode
+            cnx.execute("PRAGMA journal_mode = DELETE;")
 
+        if out_path is None:
+            os.replace(target, spath)
+            target = spath
+        if read_only:
+            os.chmod(target, 0o444)
+        m['bytes'] = os.path.getsize(target)
+        m['bytes_before'] = before
+    print(f"optimized {spath} ({before / 1e6:.1f} MB) into {target} ({os.path.getsize(target) / 1e6:.1f} MB)")
+    return target
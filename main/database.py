@@ -0,0 +1,152 @@
+'''
+A shared set of configured connections to a LODES database, for the loader and analysis functions.
+'''
+
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from urllib.request import pathname2url
+
+def read_only_uri(spath: str, immutable: bool = False) -> str:
+    '''
+    SQLite URI that opens spath read-only (mode=ro); immutable=1 also tells SQLite the file can't change, so it skips
+    locking and change detection altogether. Only use immutable on a finished database nothing writes to
+    (hint: build_database.optimize_db(read_only=True)). Connect with sqlite3.connect(uri, uri=True).
+    '''
+    uri = f"file:{pathname2url(os.path.abspath(spath))}?mode=ro"
+    return uri + "&immutable=1" if immutable else uri
+
+class LodesDatabase:
+    '''
+    Owns a small pool of connections to one LODES database. Each connection is opened once, gets mod_spatialite
+    loaded once and its PRAGMAs set, and is handed out by connection() and taken back afterwards, so repeated
+    queries and loads skip the cost of connecting and loading the extension. Use it as a context manager, or call
+    close() when done. Functions in build_database and analysis take it as db=.
+
+        with LodesDatabase(spath, read_only=True) as db:
+            df = pull_data(query, db=db)
+
+    :param str spath: Path to the database.
+    :param bool read_only: Open reader connections (mode=ro, PRAGMA query_only) that can't change the database.
+    :param bool immutable: With read_only, open the file as immutable: no locking or change checks at all. Only for a
+        finished database nothing writes to while it is open (hint: build_database.optimize_db()).
+    :param int pool_size: Most connections open at once; connection() waits for one to be free past this.
+    :param bool spatialite: Load mod_spatialite into each connection. If it can't be loaded a warning is printed
+        once and the connections work without it.
+    :param int mmap_mb: Memory-mapped I/O size for reads, in MB (PRAGMA mmap_size).
+    :param int cache_mb: Page cache per connection, in MB (PRAGMA cache_size).
+    :param float timeout: Seconds a connection waits on another writer's lock before giving up.
+    '''
+
+    def __init__(self, spath: str, read_only: bool = False, pool_size: int = 4, spatialite: bool = True,
+                 mmap_mb: int = 1024, cache_mb: int = 64, timeout: float = 60, immutable: bool = False):
+        if read_only and not os.path.exists(spath):
+            raise FileNotFoundError(f"No SQLite db at {spath}")
+        self.spath = spath
+        self.read_only = read_only
+        self.immutable = read_only and immutable
+        self.spatialite = spatialite
+        self.mmap_mb = mmap_mb
+        self.cache_mb = cache_mb
+        self.timeout = timeout
+        self.closed = False
+        self._idle = queue.LifoQueue()
+        self._open_cnxs = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max(1, pool_size))
+        self._has_spatialite = None
+
+    def _open(self) -> sqlite3.Connection:
+        '''
+        open and configure one connection.
+        '''
+        #connections are only ever used by one thread at a time, but not always the one that opened them
+        if self.read_only:
+            cnx = sqlite3.connect(read_only_uri(self.spath, self.immutable), uri=True, timeout=self.timeout,
+                                  check_same_thread=False)
+        else:
+            cnx = sqlite3.connect(self.spath, timeout=self.timeout, check_same_thread=False)
+        if self.spatialite and (self._has_spatialite is not False):
+            try:
+                cnx.enable_load_extension(True)
+                cnx.execute('SELECT load_extension("mod_spatialite")')
+                cnx.enable_load_extension(False)
+                self._has_spatialite = True
+            except Exception as e:
+                if self._has_spatialite is None:
+                    print(f"Warning: could not load mod_spatialite ({e}); spatial queries will fail")
+                self._has_spatialite = False
+        cnx.execute(f"PRAGMA mmap_size = {self.mmap_mb * 1024 * 1024};")
+        cnx.execute(f"PRAGMA cache_size = {-self.cache_mb * 1024};")
+        if self.read_only:
+            cnx.execute("PRAGMA query_only = ON;")
+        return cnx
+
+    @contextmanager
+    def connection(self):
+        '''
+        Borrow a connection for the length of a with block. Anything left uncommitted is rolled back when it is returned.
+        '''
+        if self.closed:
+            raise sqlite3.ProgrammingError("LodesDatabase is closed")
+        self._slots.acquire()
+        try:
+            try:
+                cnx = self._idle.get_nowait()
+            except queue.Empty:
+                cnx = self._open()
+                with self._lock:
+                    self._open_cnxs.append(cnx)
+            try:
+                yield cnx
+            finally:
+                if cnx.in_transaction:
+                    cnx.rollback()
+                self._idle.put(cnx)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        '''
+        Close every connection in the pool.
+        '''
+        self.closed = True
+        with self._lock:
+            for cnx in self._open_cnxs:
+                cnx.close()
+            self._open_cnxs = []
+        self._idle = queue.LifoQueue()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def __repr__(self):
+        mode = 'immutable' if self.immutable else 'read-only' if self.read_only else 'read-write'
+        return f"LodesDatabase({self.spath!r}, {mode}, {len(self._open_cnxs)} open)"
+
+@contextmanager
+def connect(spath: str = None, db: LodesDatabase = None, spatialite: bool = False):
+    '''
+    Connection for a with block: borrowed from db when one is passed, otherwise opened on spath and closed afterwards.
+    :param str spath: Path to the database; ignored when db is passed.
+    :param LodesDatabase db: Optional shared connections to borrow from.
+    :param bool spatialite: Load mod_spatialite into a connection opened on spath.
+    '''
+    if db is not None:
+        with db.connection() as cnx:
+            yield cnx
+        return
+    cnx = sqlite3.connect(spath)
+    try:
+        if spatialite:
+            cnx.enable_load_extension(True)
+            cnx.execute('SELECT load_extension("mod_spatialite")')
+        yield cnx
+    finally:
+        cnx.close()
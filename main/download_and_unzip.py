@@ -4,74 +4,179 @@ These functions download relevant lodes files.
 
 from bs4 import BeautifulSoup
 import requests
-import pickle
 import os
 import time 
 import gzip
 import glob
+import threading
+import metrics
+
+LODES_URL = r"https://lehd.ces.census.gov/data/lodes/LODES8/"
+
+def _crawl_directory(session: requests.Session,
+                     url: str,
+                     entry: dict = None,
+                     suffix: str = '.gz',
+                     timeout: float = 60) -> dict:
+    '''
+    list the links on one LODES directory page that end with suffix.
+    if a cached entry is passed, the request is conditional and a 304 keeps the cached links.
+    returns a catalog entry (url, links, etag, last_modified, checked).
+    '''
+    headers = {}
+    if entry is not None:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    reqs = session.get(url, headers=headers, timeout=timeout)
+    if (reqs.status_code == 304) and (entry is not None):
+        return dict(entry, checked=time.time())
+    reqs.raise_for_status()
+
+    soup = BeautifulSoup(reqs.text, 'html.parser')
+    links = []
+    for link in soup.find_all('a'):
+        href = link.get('href')
+        if (href is not None) and href.endswith(suffix):
+            links.append(href)
+    return {'url': url,
+            'links': links,
+            'etag': reqs.headers.get('ETag'),
+            'last_modified': reqs.headers.get('Last-Modified'),
+            'checked': time.time()}
+
+def _update_catalog(catalog: dict,
+                    ttl: float,
+                    workers: int = 8,
+                    session: requests.Session = None,
+                    base_url: str = LODES_URL) -> dict:
+    '''
+    re-crawl the directories of a catalog that are older than ttl seconds, in parallel.
+    directories that are still fresh are left alone; stale ones are revalidated with conditional requests.
+    '''
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    now = time.time()
+    def stale(entry):
+        return (entry is None) or (ttl is None) or (now - entry.get('checked', 0) > ttl)
+
+    own_session = session is None
+    if own_session:
+        session = make_session(workers=workers)
+    try:
+        #the top level directory lists the states
+        root = catalog['directories'].get('')
+        if stale(root):
+            root = _crawl_directory(session, base_url, root, suffix='/')
+            root['links'] = [q for q in root['links'] if q.rstrip('/').isalpha() and len(q.rstrip('/')) < 3]
+            catalog['directories'][''] = root
+
+        #go to each states od, rac, and wac page
+        todo = []
+        for q in root['links']:
+            st = q.rstrip('/')
+            for z in ['od','rac','wac']:
+                key = f"{st}/{z}"
+                if stale(catalog['directories'].get(key)):
+                    todo.append(key)
+
+        print(f"getting {len(todo)} directories of potential files...")
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = {pool.submit(_crawl_directory, session, base_url + key + '/', catalog['directories'].get(key)): key
+                       for key in todo}
+            for fut in as_completed(futures):
+                key = futures[fut]
+                try:
+                    catalog['directories'][key] = fut.result()
+                except Exception as e:
+                    print(f"could not get {key}: {e}")
+    finally:
+        if own_session:
+            session.close()
+
+    catalog['base_url'] = base_url
+    return catalog
+
+def _catalog_to_state_dict(catalog: dict) -> dict:
+    '''
+    turn a catalog into the {state: {'od': [...], 'rac': [...], 'wac': [...], 'cw': [...]}} dictionary of urls.
+    '''
+    base_url = catalog.get('base_url', LODES_URL)
+    f_st = {}
+    for q in catalog['directories'].get('', {}).get('links', []):
+        st = q.rstrip('/')
+        w_d = {}
+        for z in ['od','rac','wac']:
+            entry = catalog['directories'].get(f"{st}/{z}")
+            if entry is not None:
+                w_d[z] = [f"{base_url}{st}/{z}/{f}" for f in entry['links']]
+        #add in crosswalk
+        w_d['cw'] = [f"{base_url}{st}/{st}_xwalk.csv.gz"]
+        f_st[st] = w_d
+    return f_st
+
+def _read_catalog(file_path: str) -> dict:
+    import json
+
+    with open(file_path, 'r') as fp:
+        return json.load(fp)
+
+def _write_catalog(file_path: str, catalog: dict):
+    import json
+
+    with open(file_path + ".tmp", 'w') as fp:
+        json.dump(catalog, fp, indent=1, sort_keys=True)
+    os.replace(file_path + ".tmp", file_path)
 
 def get_all_possible_files(
         save: bool = False, 
         savepath : str = '',
-        savename : str = '') -> dict:
+        savename : str = '',
+        ttl : float = 7 * 24 * 3600,
+        workers : int = 8,
+        session : requests.Session = None,
+        base_url : str = LODES_URL) -> dict:
     
     '''
     This function creates a dictionary of all possible files in the LODES 8 directory, plus the crosswalk file.
-    :param bool save: If true, this will save the dictionary as a Pickle file in a given directory.
+    The state directories are crawled in parallel. When saving, the result is kept as a JSON catalog that
+    records when each directory was checked along with its ETag/Last-Modified; if the catalog already
+    exists, only directories older than ttl are re-crawled, using conditional requests.
+    :param bool save: If true, this will save the catalog as a JSON file in a given directory.
     :param str savepath: Path to save output file 
-    :param str savename: Name to save output pickle file
+    :param str savename: Name to save output JSON file
+    :param float ttl: Age in seconds after which a saved directory listing is checked again.
+    :param int workers: Number of directory pages to request at once.
+    :param requests.Session session: Optional session to reuse (hint: output of make_session()).
+    :param str base_url: Root of the LODES directory listing.
    '''
-    url = r"https://lehd.ces.census.gov/data/lodes/LODES8/"
-    reqs = requests.get(url)
-    soup = BeautifulSoup(reqs.text, 'html.parser')
+    catalog_path = os.path.join(savepath, f"{savename}.json")
 
-    #get all state level URLs
-    urls = []
-    for link in soup.find_all('a'):
+    #start from the saved catalog if there is one
+    catalog = {'directories': {}}
+    if (save == True) and os.path.exists(catalog_path):
         try:
-            if len(link.get('href')) < 4:
-                urls.append(r"https://lehd.ces.census.gov/data/lodes/LODES8/" + link.get('href'))
-        except:
-            continue
+            catalog = _read_catalog(catalog_path)
+            if catalog.get('base_url', base_url) != base_url:
+                catalog = {'directories': {}}
+        except Exception as e:
+            print(f"could not read existing catalog, crawling from scratch: {e}")
 
-    #make a dictionary with all the relevant zip files for each state
-    f_st = {}
-    print("getting each state's potential files...")
-    for q in urls:
-        st = q.split("/")[-2]
-        if len(st) < 3:
-            #print(f'{st}...')
-            w_d = {}
-            #go to each states od, rac, and wac page
-            for z in ['od','rac','wac']:
-                try:
-                    l = q + z
-                    reqs = requests.get(l)
-                    soup = BeautifulSoup(reqs.text, 'html.parser')
-                    t_urls = []
-                    for link in soup.find_all('a'):
-                        try:
-                            fl = f"{l}/" + link.get('href')
-                            if fl.endswith('.gz'):
-                                t_urls.append(fl)
-                        except:
-                            continue
-                    w_d[z] = t_urls
-                except:
-                    continue
-            #add in crosswalk
-            w_d['cw'] = [q + f"{st}_xwalk.csv.gz"]
-            f_st[st] = w_d
+    with metrics.stage('catalog', base_url=base_url) as m:
+        catalog = _update_catalog(catalog, ttl=ttl, workers=workers, session=session, base_url=base_url)
+        f_st = _catalog_to_state_dict(catalog)
+        m['files'] = sum(len(urls) for d in f_st.values() for urls in d.values())
     print(f'done')
     
-    #optional save dictionary step
+    #optional save catalog step
     if save == True:
         try:
-            print("saving the dictionary to a pickle file...")
-            with open(os.path.join(savepath,f"{savename}.pkl"),'wb') as fp:
-                pickle.dump(f_st, fp)
-                print('dictionary saved successfully to file...')
-                print(f'saved at: {os.path.join(savepath,f"{savename}.pkl")}')
+            print("saving the catalog to a json file...")
+            _write_catalog(catalog_path, catalog)
+            print('catalog saved successfully to file...')
+            print(f'saved at: {catalog_path}')
         except Exception as e:
             print(e)
             
@@ -79,134 +184,616 @@ def get_all_possible_files(
     return f_st
 
 def load_existing_state_dict(
-        file_path : str) -> dict:
+        file_path : str,
+        ttl : float = None,
+        workers : int = 8) -> dict:
     '''
     read in an existing LODES file directory dictionary, which is the output of the get_all_possible_files() function
-    :param str file_path: file where you have the dictionary as a pickle (hint: output of get_all_possible_files())
+    :param str file_path: file where you have the catalog as JSON, or an older pickled dictionary (hint: output of get_all_possible_files())
+    :param float ttl: If given, directories in a JSON catalog older than this many seconds are revalidated and the catalog is saved back. If None, the catalog is used as-is.
+    :param int workers: Number of directory pages to request at once when revalidating.
     '''
 
     import pickle
 
     print(f"loading dict at: {file_path}")
     try:
+        if file_path.endswith('.json'):
+            catalog = _read_catalog(file_path)
+            if ttl is not None:
+                catalog = _update_catalog(catalog, ttl=ttl, workers=workers, base_url=catalog.get('base_url', LODES_URL))
+                _write_catalog(file_path, catalog)
+            return _catalog_to_state_dict(catalog)
         with open(file_path, 'rb') as handle:
             b = pickle.load(handle)
         return b 
     except:
         print("could not load state dict ooooops")
 
+def parse_lodes_filename(zurl: str) -> dict:
+    '''
+    split a LODES file name or url into its parts. e.g. tx_od_main_JT00_2019.csv.gz gives
+    {'state': 'tx', 'type': 'od', 'part': 'main', 'segment': None, 'job_type': 'JT00', 'year': 2019, ...}.
+    rac/wac files have a segment (S000, SA01...) and no part; the crosswalk has type 'cw' and nothing else.
+    returns None if the name isn't a LODES file.
+    :param str zurl: file name, path or url
+    '''
+    name = zurl.replace("\\", "/").split("/")[-1]
+    stem = name.split(".")[0]
+    bits = stem.split("_")
+    entry = {'url': zurl, 'name': name, 'state': bits[0], 'type': None,
+             'part': None, 'segment': None, 'job_type': None, 'year': None}
+    try:
+        if (len(bits) == 2) and (bits[1] == 'xwalk'):
+            entry['type'] = 'cw'
+        elif (len(bits) == 5) and (bits[1] == 'od'):
+            entry.update(type='od', part=bits[2], job_type=bits[3], year=int(bits[4]))
+        elif (len(bits) == 5) and (bits[1] in ['rac','wac']):
+            entry.update(type=bits[1], segment=bits[2], job_type=bits[3], year=int(bits[4]))
+        else:
+            return None
+    except ValueError:
+        return None
+    return entry
+
+def catalog_entries(links_dict: dict, st: str) -> list:
+    '''
+    turn one state's links (hint: output of get_all_possible_files()) into a list of parsed entries.
+    :param dict links_dict: dictionary with links
+    :param str st: two letter state code
+    '''
+    entries = []
+    for s in ['od','rac','wac','cw']:
+        for zurl in links_dict.get(st, {}).get(s, []):
+            entry = parse_lodes_filename(zurl)
+            if entry is not None:
+                entries.append(entry)
+    return entries
+
+def filter_entries(entries: list,
+                   years: list = None,
+                   job_types: list = None,
+                   segments: list = None,
+                   parts: list = None,
+                   types: list = None) -> list:
+    '''
+    keep only the catalog entries that match every filter given. a filter left as None keeps everything.
+    filters only apply to files that have that attribute: segments don't drop od files, parts don't drop
+    rac/wac files, and the crosswalk is kept unless types leaves out 'cw'.
+    e.g. job_types=['JT00','JT01'], segments=['S000'] matches load_lodes_into_db(base_only=True).
+    :param list entries: output of catalog_entries()
+    :param list years: years to keep, e.g. [2019, 2020]
+    :param list job_types: JT codes to keep, e.g. ['JT00']
+    :param list segments: rac/wac segments to keep, e.g. ['S000','SA01']
+    :param list parts: od parts to keep, 'main' and/or 'aux'
+    :param list types: file types to keep, any of 'od','rac','wac','cw'
+    '''
+    def matches(value, allowed):
+        return (allowed is None) or (value is None) or (value in allowed)
+
+    years = None if years is None else [int(y) for y in years]
+    keep = []
+    for e in entries:
+        if (types is not None) and (e['type'] not in types):
+            continue
+        if matches(e['year'], years) and matches(e['job_type'], job_types) and matches(e['segment'], segments) and matches(e['part'], parts):
+            keep.append(e)
+    return keep
+
+def make_session(workers: int = 8,
+                 retries: int = 3,
+                 backoff: float = 0.5) -> requests.Session:
+    '''
+    Build a requests session that keeps a pool of connections open to the Census server.
+    Server errors (5xx) are retried with exponential backoff.
+    :param int workers: number of download threads that will share the session; sizes the connection pool
+    :param int retries: number of times to retry a request that fails with a 5xx status
+    :param float backoff: backoff factor in seconds; waits are backoff, 2*backoff, 4*backoff...
+    '''
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    #connection errors and timeouts are retried per file by _download_one
+    retry = Retry(total=retries,
+                  connect=0,
+                  read=0,
+                  backoff_factor=backoff,
+                  status_forcelist=[500, 502, 503, 504],
+                  allowed_methods=["HEAD", "GET"],
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def load_manifest(state_fold: str) -> dict:
+    '''
+    read the download manifest for a state folder (output of download_state_lodes_file()).
+    the manifest maps each file, relative to the state folder, to the url, size, ETag and Last-Modified
+    it had when it was downloaded. returns an empty manifest if there isn't one yet.
+    :param str state_fold: folder with the state's data
+    '''
+    import json
+
+    mpath = os.path.join(state_fold, "manifest.json")
+    try:
+        with open(mpath, 'r') as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return {'files': {}}
+    except Exception as e:
+        print(f"could not read manifest at {mpath}, starting a new one: {e}")
+        return {'files': {}}
+
+def _save_manifest(state_fold: str, manifest: dict):
+    '''
+    write the manifest through a temp file so a crash never leaves it half written.
+    '''
+    import json
+
+    mpath = os.path.join(state_fold, "manifest.json")
+    with open(mpath + ".tmp", 'w') as fp:
+        json.dump(manifest, fp, indent=1, sort_keys=True)
+    os.replace(mpath + ".tmp", mpath)
+
+def _read_part_meta(part: str) -> dict:
+    '''
+    validators (ETag/Last-Modified) of the response a .part file was started from.
+    '''
+    import json
+
+    try:
+        with open(part + ".json", 'r') as fp:
+            return json.load(fp)
+    except Exception:
+        return {}
+
+class _RateLimiter:
+    '''
+    token bucket shared by all download threads so their combined rate stays under a ceiling.
+    '''
+    def __init__(self, max_bytes_per_sec: float):
+        self.rate = float(max_bytes_per_sec)
+        self.allowance = self.rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n: int):
+        '''
+        take n bytes from the bucket, sleeping until the rate allows them.
+        '''
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+            self.last = now
+            self.allowance -= n
+            wait = -self.allowance / self.rate if self.allowance < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+def _download_one(session: requests.Session,
+                  zurl: str,
+                  save_location: str,
+                  timeout: float = 120,
+                  retries: int = 3,
+                  backoff: float = 0.5,
+                  entry: dict = None,
+                  chunk_size: int = 1 << 20,
+                  limiter: _RateLimiter = None) -> dict:
+    '''
+    stream a single file to disk through a .part file that is renamed into place once complete.
+    if the file is already on disk and matches its manifest entry, a conditional request is sent
+    and a 304 skips it. an existing .part file is resumed with a Range request, guarded by If-Range
+    so a file that changed on the server is restarted instead of spliced.
+    timeouts and dropped connections are retried with backoff, resuming from what was written;
+    5xx statuses are retried by the session itself (see make_session()).
+    if a limiter is passed, every chunk is drawn from it to respect a shared bandwidth ceiling.
+    errors writing the file (e.g. a full disk) are retried the same way and, like network failures, come back in 'error'.
+    returns a dictionary describing the result (url, path, bytes, seconds, skipped, size, etag, last_modified, error,
+    and the worker thread that ran it).
+    '''
+    import json
+
+    result = {'url': zurl, 'path': save_location, 'bytes': 0, 'seconds': 0.0, 'skipped': False,
+              'size': None, 'etag': None, 'last_modified': None, 'error': None,
+              'worker': threading.current_thread().name}
+    part = save_location + ".part"
+    t0 = time.perf_counter()
+    for attempt in range(retries + 1):
+        try:
+            headers = {}
+            offset = 0
+            meta = _read_part_meta(part)
+            if (entry is not None) and os.path.exists(save_location) and (os.path.getsize(save_location) == entry.get('size')):
+                #only ask for the file if it changed since we got it
+                if entry.get('etag'):
+                    headers['If-None-Match'] = entry['etag']
+                if entry.get('last_modified'):
+                    headers['If-Modified-Since'] = entry['last_modified']
+            elif os.path.exists(part) and (meta.get('etag') or meta.get('last_modified')):
+                #pick up where the last attempt stopped
+                offset = os.path.getsize(part)
+                headers['Range'] = f"bytes={offset}-"
+                headers['If-Range'] = meta.get('etag') or meta.get('last_modified')
+
+            with session.get(zurl, headers=headers, timeout=timeout, stream=True) as response:
+                if response.status_code == 304:
+                    result.update(skipped=True, error=None, size=entry.get('size'),
+                                  etag=entry.get('etag'), last_modified=entry.get('last_modified'))
+                    break
+                if response.status_code == 416:
+                    #range no longer valid; throw away the partial file and start over
+                    for f in [part, part + ".json"]:
+                        if os.path.exists(f):
+                            os.remove(f)
+                    raise requests.exceptions.RequestException("HTTP 416, restarting download")
+                if response.status_code == 206:
+                    mode = 'ab'
+                    etag, last_modified = meta.get('etag'), meta.get('last_modified')
+                elif response.status_code == 200:
+                    offset = 0
+                    mode = 'wb'
+                    etag = response.headers.get('ETag')
+                    last_modified = response.headers.get('Last-Modified')
+                    with open(part + ".json", 'w') as fp:
+                        json.dump({'etag': etag, 'last_modified': last_modified}, fp)
+                else:
+                    #5xx responses have already been retried by the session
+                    result['error'] = f"HTTP {response.status_code}"
+                    break
+
+                expected = response.headers.get('Content-Length')
+                written = 0
+                with open(part, mode) as file:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        if limiter is not None:
+                            limiter.consume(len(chunk))
+                        file.write(chunk)
+                        written += len(chunk)
+                result['bytes'] += written
+                if (expected is not None) and (written != int(expected)):
+                    raise requests.exceptions.ChunkedEncodingError(f"got {written} of {expected} bytes")
+
+            os.replace(part, save_location)
+            if os.path.exists(part + ".json"):
+                os.remove(part + ".json")
+            result.update(error=None, size=os.path.getsize(save_location), etag=etag, last_modified=last_modified)
+            break
+        except requests.exceptions.RequestException as e:
+            result['error'] = str(e)
+        except OSError as e:
+            #e.g. a full disk or no permission to write; report it like a network failure instead of raising
+            result['error'] = f"{type(e).__name__}: {e}"
+        if attempt < retries:
+            time.sleep(backoff * (2 ** attempt))
+    result['seconds'] = time.perf_counter() - t0
+    return result
+
+def _probe_size(session: requests.Session, zurl: str, timeout: float = 60) -> int:
+    '''
+    size of a remote file from a HEAD request; 0 if the server doesn't say.
+    '''
+    try:
+        response = session.head(zurl, timeout=timeout, allow_redirects=True)
+        return int(response.headers.get('Content-Length', 0))
+    except Exception:
+        return 0
+
+def download_states(save_loc: str,
+                    states: list,
+                    links_dict: dict,
+                    workers: int = 8,
+                    max_bytes_per_sec: float = None,
+                    session: requests.Session = None,
+                    retries: int = 3,
+                    backoff: float = 0.5,
+                    timeout: float = 120,
+                    revalidate: bool = True,
+                    years: list = None,
+                    job_types: list = None,
+                    segments: list = None,
+                    parts: list = None,
+                    types: list = None,
+                    outcomes: dict = None) -> dict:
+    '''
+    download the lodes files for several states through one shared work queue.
+    every state's files go into a single queue ordered largest file first, so the last files to finish are
+    small ones; workers caps how many downloads run at once across all states, and max_bytes_per_sec caps
+    their combined bandwidth. each state gets its own folder, manifest.json and failed_downloads.txt as
+    in download_state_lodes_file(), and progress is reported per state.
+    returns a dictionary of state code to the state's folder.
+    :param str save_loc: path to a folder where you'll save output files
+    :param list states: two letter state codes to download, e.g. ['tx','ok','la']
+    :param dict links_dict: dictionary you want with links (hint: output of get_all_possible_files())
+    :param int workers: number of files to download at once across all states
+    :param float max_bytes_per_sec: optional ceiling on the combined download rate, in bytes per second
+    :param requests.Session session: optional session to reuse (hint: output of make_session())
+    :param int retries: number of retries per file for 5xx errors, timeouts and dropped connections
+    :param float backoff: backoff factor in seconds between retries
+    :param float timeout: seconds to wait on the server before a request counts as timed out
+    :param bool revalidate: If true, files already in the manifest are checked against the server with a conditional request. If false, they are skipped without asking.
+    :param list years: only download these years, e.g. [2019, 2020]
+    :param list job_types: only download these JT codes, e.g. ['JT00','JT01']
+    :param list segments: only download these rac/wac segments, e.g. ['S000']
+    :param list parts: only download these od parts, 'main' and/or 'aux'
+    :param list types: only download these file types, any of 'od','rac','wac','cw'
+    :param dict outcomes: optional dictionary filled in with each file's url and what happened to it: 'downloaded',
+        'unchanged' or 'failed'. A failed file may still have an older copy on disk.
+    '''
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    if outcomes is None:
+        outcomes = {}
+    own_session = session is None
+    if own_session:
+        session = make_session(workers=workers, retries=retries, backoff=backoff)
+
+    folds = {}
+    manifests = {}
+    progress = {}
+    jobs = []
+    for st in states:
+        if st not in links_dict:
+            print(f"error with state code {st}; not in dict")
+            continue
+
+        #narrow the state's files down to the ones asked for
+        entries = filter_entries(catalog_entries(links_dict, st), years=years, job_types=job_types,
+                                 segments=segments, parts=parts, types=types)
+
+        #make overarching folder and a subfolder for each od/rac/wac
+        fold = os.path.join(save_loc,st)
+        for s in ['od','rac','wac','cw']:
+            fold2 = os.path.join(fold,s)
+            if not os.path.exists(fold2):
+                os.makedirs(fold2)
+        folds[st] = fold
+
+        #queue up every file for the state that we don't already have
+        manifests[st] = load_manifest(fold)
+        progress[st] = {'total': 0, 'done': 0, 'downloaded': 0, 'unchanged': 0, 'bytes': 0, 'failed': []}
+        for s in ['od','rac','wac','cw']:
+            urls = [e['url'] for e in entries if e['type'] == s]
+            print(f"{st} + {s}: {len(urls)} files")
+            for zurl in urls:
+                key = f"{s}/{zurl.split('/')[-1]}"
+                loc = os.path.join(fold, s, zurl.split("/")[-1])
+                entry = manifests[st]['files'].get(key)
+                if (entry is not None) and (entry.get('url') != zurl):
+                    entry = None
+                if (entry is not None) and (not revalidate) and os.path.exists(loc) and (os.path.getsize(loc) == entry.get('size')):
+                    progress[st]['unchanged'] += 1
+                    outcomes[zurl] = 'unchanged'
+                    continue
+                jobs.append({'st': st, 'key': key, 'url': zurl, 'loc': loc, 'entry': entry,
+                             'size': entry.get('size') if entry is not None else None})
+                progress[st]['total'] += 1
+        if progress[st]['unchanged']:
+            print(f"{st}: skipping {progress[st]['unchanged']} files already in the manifest")
+
+    #loop through and download all files
+    limiter = _RateLimiter(max_bytes_per_sec) if max_bytes_per_sec else None
+    counter = len(jobs)
+    try:
+        with metrics.stage('download', states=list(folds), files=counter) as m, \
+                ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            #largest files first, so the tail of the queue is short; ask the server for sizes we don't know
+            unknown = [j for j in jobs if j['size'] is None]
+            if unknown:
+                print(f"checking the size of {len(unknown)} files...")
+                for j, size in zip(unknown, pool.map(lambda j: _probe_size(session, j['url'], timeout), unknown)):
+                    j['size'] = size
+            jobs.sort(key=lambda j: j['size'], reverse=True)
+
+            futures = {pool.submit(_download_one, session, j['url'], j['loc'], timeout, retries, backoff,
+                                   j['entry'], 1 << 20, limiter): j for j in jobs}
+            results = []
+            for fut in as_completed(futures):
+                j = futures[fut]
+                res = fut.result()
+                results.append(res)
+                st = j['st']
+                p = progress[st]
+                p['done'] += 1
+                name = res['url'].split("/")[-1]
+                if (res['error'] is None) and res['skipped']:
+                    p['unchanged'] += 1
+                    outcomes[res['url']] = 'unchanged'
+                    metrics.record_file('download', name, res['seconds'], state=st, status='unchanged')
+                elif res['error'] is None:
+                    manifests[st]['files'][j['key']] = {'url': res['url'],
+                                                        'size': res['size'],
+                                                        'etag': res['etag'],
+                                                        'last_modified': res['last_modified'],
+                                                        'downloaded': time.strftime("%Y-%m-%d %H:%M:%S")}
+                    _save_manifest(folds[st], manifests[st])
+                    p['downloaded'] += 1
+                    p['bytes'] += res['bytes']
+                    outcomes[res['url']] = 'downloaded'
+                    metrics.record_file('download', name, res['seconds'], state=st, bytes=res['bytes'])
+                else:
+                    p['failed'].append(res)
+                    outcomes[res['url']] = 'failed'
+                    metrics.record_file('download', name, res['seconds'], state=st, status='failed', error=res['error'])
+                metrics.progress('download', p['done'], p['total'], every=1, state=st)
+            metrics.record_workers('download', results)
+            m['bytes'] = sum(p['bytes'] for p in progress.values())
+            m['failed'] = sum(len(p['failed']) for p in progress.values())
+    finally:
+        if own_session:
+            session.close()
+
+    print("done downloading!")
+    for st, p in progress.items():
+        print(f"{st}: {p['downloaded']} downloaded, {p['unchanged']} unchanged, {len(p['failed'])} failed, {p['bytes'] / 1e6:.1f} MB")
+
+        #keep a record of anything that didn't make it
+        failed_path = os.path.join(folds[st], "failed_downloads.txt")
+        if (not p['failed']) and os.path.exists(failed_path):
+            os.remove(failed_path)
+        if p['failed']:
+            print(f"{len(p['failed'])} {st} files failed to download:")
+            with open(failed_path, 'w') as fp:
+                for res in p['failed']:
+                    print(f"  {res['url']} ({res['error']})")
+                    fp.write(f"{res['url']}\t{res['error']}\n")
+    return folds
+
 def download_state_lodes_file(save_loc: str, 
                               st: str,
-                              links_dict: dict) -> str:
+                              links_dict: dict,
+                              workers: int = 8,
+                              session: requests.Session = None,
+                              retries: int = 3,
+                              backoff: float = 0.5,
+                              timeout: float = 120,
+                              revalidate: bool = True,
+                              years: list = None,
+                              job_types: list = None,
+                              segments: list = None,
+                              parts: list = None,
+                              types: list = None,
+                              max_bytes_per_sec: float = None) -> str:
     '''
     download a single state's full lodes file to a specific folder.
+    files are fetched concurrently over one pooled session and streamed to disk; anything that still
+    fails after retrying is listed at the end and written to failed_downloads.txt in the state folder.
+    a manifest.json in the state folder records the size, ETag and Last-Modified of every file, so
+    re-running only fetches files that are missing or changed on the server, and resumes partial files.
+    to download several states through one queue, use download_states().
     returns a string with a path to a folder.
     :param str save_loc: path to a folder where you'll save output files
     :param str state: two letter state code for the state you want to download
     :param dict links_dict: dictionary you want with links (hint: output of get_all_possible_files())
+    :param int workers: number of files to download at once; 1 downloads serially
+    :param requests.Session session: optional session to reuse (hint: output of make_session())
+    :param int retries: number of retries per file for 5xx errors, timeouts and dropped connections
+    :param float backoff: backoff factor in seconds between retries
+    :param float timeout: seconds to wait on the server before a request counts as timed out
+    :param bool revalidate: If true, files already in the manifest are checked against the server with a conditional request. If false, they are skipped without asking.
+    :param list years: only download these years, e.g. [2019, 2020]
+    :param list job_types: only download these JT codes, e.g. ['JT00','JT01']
+    :param list segments: only download these rac/wac segments, e.g. ['S000']
+    :param list parts: only download these od parts, 'main' and/or 'aux'
+    :param list types: only download these file types, any of 'od','rac','wac','cw'
+    :param float max_bytes_per_sec: optional ceiling on the download rate, in bytes per second
     '''
-    
-    #prepare folders for output
+    folds = download_states(save_loc=save_loc, states=[st], links_dict=links_dict, workers=workers,
+                            max_bytes_per_sec=max_bytes_per_sec, session=session, retries=retries,
+                            backoff=backoff, timeout=timeout, revalidate=revalidate, years=years,
+                            job_types=job_types, segments=segments, parts=parts, types=types)
+    return folds.get(st)
+
+def _gz_is_up_to_date(gz_file_path: str, output_file_path: str) -> bool:
+    '''
+    check if an unzipped file is newer than its archive and has the size recorded in the gzip trailer.
+    '''
+    import struct
+
     try:
-        links = links_dict[st]
-    except:
-        print("error with state code; not in dict")
+        if os.path.getmtime(output_file_path) < os.path.getmtime(gz_file_path):
+            return False
+        #last 4 bytes of a gzip file are the uncompressed size mod 2**32
+        with open(gz_file_path, 'rb') as fp:
+            fp.seek(-4, os.SEEK_END)
+            isize = struct.unpack('<I', fp.read(4))[0]
+        return os.path.getsize(output_file_path) % 2**32 == isize
+    except OSError:
+        return False
 
-    #make overarching folder
-    fold = os.path.join(save_loc,st)
-    if not os.path.exists(fold):
-        os.makedirs(fold)
+def _gunzip_one(gz_file_path: str,
+                output_file_path: str,
+                chunk_size: int = 1 << 20) -> dict:
+    '''
+    decompress one .gz file in fixed size chunks so memory stays flat no matter how big the file is.
+    writes through a temp file so an interrupted run never leaves a truncated csv behind.
+    returns a dictionary describing the result (path, bytes, seconds, pid, error).
+    '''
+    import shutil
 
-    #make a subfolder for each od/rac/wac
-    for s in ['od','rac','wac','cw']:
-        fold2 = os.path.join(fold,s)
-        if not os.path.exists(fold2):
-            os.makedirs(fold2)
-    
-    #loop through and download all files
-    start = time.strftime("%H:%M:%S")
-    print(f"start time: {start}")
-    for s in ['od','rac','wac','cw']:
-        print(f"{st} + {s}...")
-        try:
-            urls = links[s]
-            
-            counter = len(urls)
-            print(f"downloading {counter} {s} files")
-            for i,zurl in enumerate(urls):
-
-                #print update every 25 files
-                if (i % 50 == 0) or (i+1 == counter):
-                    print(f"{((i+1)/counter):.1%} complete...")
-                
-                #make the output path
-                save_location = os.path.join(f"{fold}\\{s}",zurl.split("/")[-1])
-                # Make an HTTP GET request to download the .zip file
-                response = requests.get(zurl)
-                if response.status_code == 200:
-                    # Open the file in binary write mode and save the content
-                    with open(save_location, 'wb') as file:
-                        file.write(response.content)
-                else:
-                    print(f"failed to download")
-        except:
-            continue
-    print("done downloading!")
-    end = time.strftime("%H:%M:%S")
-    print(f"end time: {end}")
-    return fold
+    result = {'path': gz_file_path, 'bytes': 0, 'seconds': 0.0, 'pid': os.getpid(), 'error': None}
+    t0 = time.perf_counter()
+    try:
+        # Open the .gz file for reading and the output file for writing
+        with gzip.open(gz_file_path, 'rb') as gz_file, open(output_file_path + ".tmp", 'wb') as out_file:
+            # copy the contents across a chunk at a time to decompress
+            shutil.copyfileobj(gz_file, out_file, chunk_size)
+        os.replace(output_file_path + ".tmp", output_file_path)
+        result['bytes'] = os.path.getsize(output_file_path)
+    except Exception as e:
+        result['error'] = str(e)
+        if os.path.exists(output_file_path + ".tmp"):
+            os.remove(output_file_path + ".tmp")
+    result['seconds'] = time.perf_counter() - t0
+    return result
+
+def _report_unzip(res: dict):
+    '''
+    report one unzipped file (output of _gunzip_one()) to the metrics sinks.
+    '''
+    name = os.path.basename(res['path'])
+    if res['error'] is not None:
+        metrics.record_file('unzip', name, res['seconds'], worker=res['pid'], status='failed', error=res['error'])
+    else:
+        metrics.record_file('unzip', name, res['seconds'], worker=res['pid'], bytes=res['bytes'])
 
-def unzip_state_lodes_file(state_fold : str = None) -> str:
+def unzip_state_lodes_file(state_fold : str = None,
+                           workers : int = 1,
+                           chunk_size : int = 1 << 20,
+                           force : bool = False) -> str:
     '''
-    unzip a state's lodes data, using the parent folder location with the data
+    unzip a state's lodes data, using the parent folder location with the data.
+    files are decompressed in chunks, so memory use doesn't grow with file size, and files whose
+    csv is already newer than the archive with the right size are skipped.
+    returns the state folder.
 
     :param str state_fold: folder with all the data; this is the output of the download state lodes file
+    :param int workers: number of processes to decompress with. 1 decompresses in this process; more than 1 needs the calling script to be guarded by if __name__ == "__main__" on Windows.
+    :param int chunk_size: bytes to decompress at a time
+    :param bool force: If true, unzip everything even if it looks up to date.
     '''
-    
+    from concurrent.futures import ProcessPoolExecutor, as_completed
 
     # Define the path to the subfolder containing the .gz files
-    paths = [q for q in glob.glob(state_fold+"\\**",recursive=True) if q.endswith(('rac','wac','od','cw'))]
-
-    start = time.strftime("%H:%M:%S")
-    print(f"start time: {start}")
-
+    paths = [q for q in glob.glob(os.path.join(state_fold, "**"), recursive=True)
+             if os.path.isdir(q) and os.path.basename(os.path.normpath(q)) in ('rac','wac','od','cw')]
 
+    #collect every archive that needs unzipping
+    jobs = []
+    skipped = 0
     for sub_path in paths:
-        try:
-            # Get a list of all files in the subfolder
-            file_list = os.listdir(sub_path)
-
-            counter = len(file_list)
-            ty = sub_path.split('\\')[-1]
-            print(f"unzipping {counter} {ty} files")
-
-            # Iterate through the files in the subfolder
-            for i, filename in enumerate(file_list):
-                
-                if (i % 50 == 0) or (i+1 == counter):
-                    print(f"{((i+1)/counter):.1%} complete...")
-
-                # Check if the file has a .gz extension
-                if filename.endswith('.gz'):
-                    # Construct the full path to the .gz file
-                    gz_file_path = os.path.join(sub_path, filename)
-
-                    # Remove the .gz extension to get the output filename
-                    output_filename = filename[:-3]
-
-                    # Construct the full path to the output file
-                    output_file_path = os.path.join(sub_path, output_filename)
-
-                    try:
-                        # Open the .gz file for reading and the output file for writing
-                        with gzip.open(gz_file_path, 'rb') as gz_file, open(output_file_path, 'wb') as out_file:
-                            # Read and write the contents to decompress
-                            out_file.write(gz_file.read())
-                    except Exception as e:
-                        print(f"error unzipping {filename}: {str(e)}")
-        except:
-            continue
-    end = time.strftime("%H:%M:%S")
-    print(f"start time: {end}")
-
+        file_list = [f for f in os.listdir(sub_path) if f.endswith('.gz')]
+        ty = os.path.basename(os.path.normpath(sub_path))
+        print(f"found {len(file_list)} {ty} files")
+        for filename in file_list:
+            gz_file_path = os.path.join(sub_path, filename)
+            # Remove the .gz extension to get the output filename
+            output_file_path = os.path.join(sub_path, filename[:-3])
+            if (not force) and _gz_is_up_to_date(gz_file_path, output_file_path):
+                skipped += 1
+                continue
+            jobs.append((gz_file_path, output_file_path))
+    if skipped:
+        print(f"skipping {skipped} files that are already unzipped")
 
+    counter = len(jobs)
+    print(f"unzipping {counter} files")
+    with metrics.stage('unzip', state_fold=state_fold, workers=workers, skipped=skipped) as m:
+        results = []
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(_gunzip_one, gz, out, chunk_size) for gz, out in jobs]
+                for fut in as_completed(futures):
+                    results.append(fut.result())
+                    _report_unzip(results[-1])
+        else:
+            for gz, out in jobs:
+                results.append(_gunzip_one(gz, out, chunk_size))
+                _report_unzip(results[-1])
+        metrics.record_workers('unzip', results, worker_key='pid')
+        ok = [res for res in results if res['error'] is None]
+        m['files'] = len(ok)
+        m['bytes'] = sum(res['bytes'] for res in ok)
+        m['failed'] = len(results) - len(ok)
+    return state_fold
@@ -0,0 +1,251 @@
+'''
+Structured metrics for the LODES pipeline. Stages (download, unzip, load, index, queries...) and the files or tables
+inside them report events with their duration, bytes, rows, throughput and peak memory, instead of printing timestamps.
+Events are dictionaries handed to every registered sink: by default a ConsoleSink prints them as short progress lines,
+and a JsonLinesSink writes them one JSON object per line for charting throughput across builds.
+
+    import metrics
+    metrics.add_sink(metrics.JsonLinesSink("build_metrics.jsonl"))
+
+Setting the LODES_METRICS environment variable to a file path adds a JsonLinesSink for it at import, so production
+builds can be instrumented without changing the scripts. A sink is any callable taking the event dictionary.
+
+Every event has 'ts' (epoch seconds), 'event' and 'pid'. The event types are:
+    stage_start - stage, plus whatever the stage was started with
+    stage - stage, status ('ok' or 'error'), seconds, files/bytes/rows and mb_per_s/rows_per_s when known,
+            peak_rss_mb (this process) and peak_child_rss_mb (largest finished child process), error
+    file - stage, name, seconds, and bytes/rows with their rates when known, e.g. one downloaded archive or loaded table
+    progress - stage, done, total
+    worker - stage, worker, files, seconds spent working, and bytes/rows with their rates, one per worker at a stage's end
+    query - kind (e.g. 'pull_data'), seconds, rows and rows/s, sql_bytes; not printed by the ConsoleSink
+'''
+
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+def peak_rss_mb(children: bool = False) -> float:
+    '''
+    peak resident memory of this process (or of its largest finished child process) in MB; None where it can't be read.
+    '''
+    try:
+        import resource
+    except ImportError:
+        #windows has no resource module; psutil knows the peak working set
+        if children:
+            return None
+        try:
+            import psutil
+            info = psutil.Process().memory_info()
+            return round(getattr(info, 'peak_wset', info.rss) / 1e6, 1)
+        except Exception:
+            return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    #bytes on macOS, KB everywhere else
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return round(usage * scale / 1e6, 1) if usage else None
+
+def _rates(fields: dict, seconds: float) -> dict:
+    '''
+    drop empty fields and add rows/s and MB/s for the ones that have counts.
+    '''
+    out = {k: v for k, v in fields.items() if v is not None}
+    secs = max(seconds, 1e-9)
+    if out.get('rows') is not None:
+        out['rows_per_s'] = round(out['rows'] / secs, 1)
+    if out.get('bytes') is not None:
+        out['mb_per_s'] = round(out['bytes'] / 1e6 / secs, 3)
+    return out
+
+class ConsoleSink:
+    '''
+    print events as short human readable progress lines.
+    :param stream: file-like to print to; defaults to sys.stdout at the time of each event
+    :param bool files: print an event for every file/table as well as for stages
+    '''
+    def __init__(self, stream=None, files: bool = True):
+        self.stream = stream
+        self.files = files
+
+    @staticmethod
+    def _sizes(event: dict) -> str:
+        bits = []
+        if event.get('files') is not None:
+            bits.append(f"{event['files']} files")
+        if event.get('rows') is not None:
+            bits.append(f"{event['rows']} rows ({event.get('rows_per_s', 0):.0f} rows/s)")
+        if event.get('bytes') is not None:
+            bits.append(f"{event['bytes'] / 1e6:.1f} MB ({event.get('mb_per_s', 0):.2f} MB/s)")
+        return ", ".join(bits)
+
+    def format(self, event: dict) -> str:
+        '''
+        the line printed for an event, or None to print nothing.
+        '''
+        kind = event['event']
+        clock = time.strftime("%H:%M:%S", time.localtime(event['ts']))
+        if kind == 'stage_start':
+            return f"{clock} {event['stage']} started"
+        if kind == 'stage':
+            line = f"{clock} {event['stage']} {'done' if event['status'] == 'ok' else 'failed'} in {event['seconds']:.1f}s"
+            sizes = self._sizes(event)
+            if sizes:
+                line += f": {sizes}"
+            if event.get('peak_rss_mb') is not None:
+                line += f", peak {event['peak_rss_mb']:.0f} MB"
+            if event.get('error'):
+                line += f" ({event['error']})"
+            return line
+        if kind == 'file':
+            if not self.files:
+                return None
+            bits = [event['status']] if event.get('status') not in [None, 'ok'] else []
+            bits += [self._sizes(event)] if self._sizes(event) else []
+            line = f"{event['stage']} {event['name']}: {' '.join(bits + [''])}in {event['seconds']:.2f}s"
+            if event.get('error'):
+                line += f" ({event['error']})"
+            return line
+        if kind == 'worker':
+            return f"{event['stage']} worker {event['worker']}: {self._sizes(event)} in {event['seconds']:.1f}s"
+        if kind == 'progress':
+            total = max(event['total'], 1)
+            what = event.get('file_type') or event.get('state')
+            what = f" {what}" if what else ''
+            return f"{event['stage']}{what}: {event['done']}/{event['total']}, {event['done'] / total:.1%} complete..."
+        return None
+
+    def __call__(self, event: dict):
+        line = self.format(event)
+        if line is not None:
+            print(line, file=self.stream or sys.stdout)
+
+class JsonLinesSink:
+    '''
+    append events to a file as JSON lines. safe to share between threads.
+    :param path: file path to append to, or an open text file-like object
+    '''
+    def __init__(self, path):
+        self._own = isinstance(path, (str, os.PathLike))
+        self._fp = open(path, 'a', buffering=1) if self._own else path
+        self._lock = threading.Lock()
+
+    def __call__(self, event: dict):
+        line = json.dumps(event, default=str)
+        with self._lock:
+            self._fp.write(line + "\n")
+            self._fp.flush()
+
+    def close(self):
+        if self._own:
+            self._fp.close()
+
+class MemorySink(list):
+    '''
+    keep events in a list, e.g. to inspect a run from a notebook.
+    '''
+    def __call__(self, event: dict):
+        self.append(event)
+
+_sinks = [ConsoleSink()]
+_sinks_lock = threading.Lock()
+
+def set_sinks(*sinks):
+    '''
+    replace every sink; with no arguments, events are dropped.
+    '''
+    with _sinks_lock:
+        _sinks[:] = list(sinks)
+
+def add_sink(sink):
+    '''
+    send events to another sink as well.
+    '''
+    with _sinks_lock:
+        _sinks.append(sink)
+    return sink
+
+def remove_sink(sink):
+    with _sinks_lock:
+        if sink in _sinks:
+            _sinks.remove(sink)
+
+def emit(event: str, **fields) -> dict:
+    '''
+    send one event to every sink. a sink that fails is skipped; metrics never stop a build.
+    '''
+    record = {'ts': round(time.time(), 3), 'event': event, 'pid': os.getpid(), **fields}
+    with _sinks_lock:
+        sinks = list(_sinks)
+    for sink in sinks:
+        try:
+            sink(record)
+        except Exception:
+            pass
+    return record
+
+@contextmanager
+def stage(name: str, **fields):
+    '''
+    time a stage of the pipeline. yields a dictionary to fill in with what the stage handled ('files', 'bytes', 'rows',
+    or anything else worth keeping); a stage_start event is sent on entry and a stage event with the duration, rates
+    and peak memory on exit, with status 'error' if the block raised.
+
+        with metrics.stage('unzip', state='tx') as m:
+            ...
+            m['bytes'] = total
+    '''
+    m = dict(fields)
+    emit('stage_start', stage=name, **fields)
+    t0 = time.perf_counter()
+    status, error = 'ok', None
+    try:
+        yield m
+    except BaseException as e:
+        status, error = 'error', str(e) or type(e).__name__
+        raise
+    finally:
+        secs = time.perf_counter() - t0
+        emit('stage', stage=name, status=status, seconds=round(secs, 3), **_rates(m, secs),
+             peak_rss_mb=peak_rss_mb(), peak_child_rss_mb=peak_rss_mb(children=True), error=error)
+
+def record_file(stage: str, name: str, seconds: float, **fields) -> dict:
+    '''
+    report one file or table handled within a stage, e.g. record_file('load', 'tx_od_main_JT00_2019', 3.2, rows=10000).
+    '''
+    return emit('file', stage=stage, name=name, seconds=round(seconds, 4), **_rates(fields, seconds))
+
+def record_query(kind: str, seconds: float, rows: int = None, **fields) -> dict:
+    '''
+    report one query run by the analysis functions, e.g. record_query('pull_data', 0.04, rows=812, sql_bytes=2400).
+    '''
+    return emit('query', kind=kind, seconds=round(seconds, 5), **_rates(dict(fields, rows=rows), seconds))
+
+def record_workers(stage: str, results: list, worker_key: str = 'worker'):
+    '''
+    report each worker's throughput over a stage from its per-file results, dictionaries with the worker's id under
+    worker_key, 'seconds', 'bytes' and 'error'. failed files are left out.
+    '''
+    per_worker = {}
+    for res in results:
+        if res.get('error') is not None:
+            continue
+        w = per_worker.setdefault(res[worker_key], {'files': 0, 'bytes': 0, 'seconds': 0.0})
+        w['files'] += 1
+        w['bytes'] += res.get('bytes') or 0
+        w['seconds'] += res['seconds']
+    for worker, w in per_worker.items():
+        secs = w.pop('seconds')
+        emit('worker', stage=stage, worker=worker, seconds=round(secs, 3), **_rates(w, secs))
+
+def progress(stage: str, done: int, total: int, every: int = 25, **fields):
+    '''
+    report progress through a stage's files every so many files, and at the end.
+    '''
+    if (done % every == 1) or (every == 1) or (done == total):
+        emit('progress', stage=stage, done=done, total=total, **fields)
+
+if os.environ.get('LODES_METRICS'):
+    add_sink(JsonLinesSink(os.environ['LODES_METRICS']))
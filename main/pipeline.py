@@ -0,0 +1,306 @@
+'''
+These functions stream LODES files straight into the database, without writing decompressed csvs to disk.
+'''
+
+import os
+import gzip
+import glob
+import queue
+import threading
+import requests
+
+import metrics
+from download_and_unzip import make_session, parse_lodes_filename, filter_entries, catalog_entries, download_states
+from database import LodesDatabase
+from build_database import (read_in_chunks, get_loaded_sources, build_indexes, analyze_tables, drop_indexes, build_rollups,
+                            _drain_queue, _file_type, _table_name, _target, _keep_base_only, _source_meta)
+
+def state_sources(st: str = None,
+                  links_dict: dict = None,
+                  state_fold: str = None,
+                  base_only: bool = False,
+                  years: list = None,
+                  job_types: list = None,
+                  segments: list = None,
+                  parts: list = None,
+                  types: list = None) -> list:
+    '''
+    List the files to stream for a state, either as urls from the catalog or as .gz files already on disk.
+    :param str st: two letter state code; needed with links_dict
+    :param dict links_dict: dictionary with links (hint: output of get_all_possible_files())
+    :param str state_fold: folder with downloaded .gz files (hint: output of download_state_lodes_file()); used instead of links_dict
+    :param bool base_only: If True, only the files for the slim database- JT00 and JT01, S000 for rac/wac.
+    :param list years, job_types, segments, parts, types: optional filters, see download_and_unzip.filter_entries()
+    '''
+    if state_fold is not None:
+        sources = sorted(glob.glob(os.path.join(state_fold, "**", "*.csv.gz"), recursive=True))
+    elif (links_dict is not None) and (st is not None):
+        links = links_dict[st]
+        sources = [zurl for s in ['od','rac','wac','cw'] for zurl in links.get(s, [])]
+    else:
+        print("Must pass a state folder, or a state code and links dict.")
+        return []
+
+    sources = [q for q in sources if _file_type(q) is not None]
+    entries = [e for e in map(parse_lodes_filename, sources) if e is not None]
+    sources = [e['url'] for e in filter_entries(entries, years=years, job_types=job_types,
+                                                segments=segments, parts=parts, types=types)]
+    if base_only == True:
+        sources = _keep_base_only(sources)
+    return sources
+
+def _produce(source: str,
+             q: queue.Queue,
+             session: requests.Session,
+             chunksize: int,
+             timeout: float,
+             stop: threading.Event,
+             geocode_type: str = 'text',
+             memory_mb: float = 256):
+    '''
+    open one archive (url or .gz path), decompress and parse it as it arrives, and put its chunks on the queue.
+    '''
+    tname = _table_name(source)
+    file_type = _file_type(source)
+    try:
+        q.put(('start', tname, file_type))
+        if source.startswith(('http://', 'https://')):
+            with session.get(source, stream=True, timeout=timeout) as response:
+                response.raise_for_status()
+                length = response.headers.get('Content-Length')
+                meta = {'source': source,
+                        'size': int(length) if length is not None else None,
+                        'etag': response.headers.get('ETag'),
+                        'last_modified': response.headers.get('Last-Modified')}
+                #undo any transport encoding; the body itself is still the .gz file
+                response.raw.decode_content = True
+                with gzip.GzipFile(fileobj=response.raw) as fh:
+                    for chunk in read_in_chunks(source, chunksize=chunksize, fileobj=fh, geocode_type=geocode_type,
+                                            memory_mb=memory_mb):
+                        if stop.is_set():
+                            return
+                        q.put(('rows', tname, chunk))
+        else:
+            meta = _source_meta(source)
+            with gzip.open(source, 'rb') as fh:
+                for chunk in read_in_chunks(source, chunksize=chunksize, fileobj=fh, geocode_type=geocode_type,
+                                            memory_mb=memory_mb):
+                    if stop.is_set():
+                        return
+                    q.put(('rows', tname, chunk))
+        q.put(('done', tname, file_type, meta))
+    except Exception as e:
+        q.put(('error', tname, str(e)))
+
+def stream_lodes_into_db(sources: list = None,
+                         spath: str = None,
+                         workers: int = 4,
+                         queue_depth: int = 8,
+                         chunksize: int = None,
+                         session: requests.Session = None,
+                         timeout: float = 120,
+                         geocode_type: str = 'text',
+                         layout: str = 'per_file',
+                         indexes: str = 'inline',
+                         covering: bool = False,
+                         clustered: bool = False,
+                         db: LodesDatabase = None,
+                         memory_mb: float = 256) -> dict:
+    '''
+    Stream LODES archives into the Spatialite db with no decompressed csv ever written.
+    Worker threads download (or read) and gunzip each archive and parse it in chunks, while a single
+    writer inserts the chunks as they arrive; the network, decompression and database writes overlap.
+    Tables and indexes match the ones load_lodes_into_db() makes for the same layout.
+    Returns a dictionary of table name to rows loaded (None for files that failed).
+
+    :param list sources: urls and/or .gz paths (hint: output of state_sources())
+    :param str spath: Path to the location of Spatialite database (hint: create it with build_db()).
+    :param int workers: Number of files to download and parse at once.
+    :param int queue_depth: Number of parsed chunks that can wait for the writer before the workers pause.
+    :param int chunksize: Number of rows per chunk; by default as many as fit the memory budget.
+    :param requests.Session session: Optional session to reuse (hint: output of make_session()).
+    :param float timeout: Seconds to wait on the server before a request counts as timed out.
+    :param str geocode_type: 'text' stores geocodes as fixed-width TEXT, 'integer' as INTEGER. Counts and year are always INTEGER.
+    :param str layout: 'per_file' or 'consolidated', as in build_database.load_lodes_into_db().
+    :param str indexes: 'inline', 'deferred' or 'none', as in build_database.load_lodes_into_db().
+    :param bool covering: Build covering indexes, as in build_database.load_lodes_into_db().
+    :param bool clustered: Create clustered WITHOUT ROWID tables, as in build_database.load_lodes_into_db().
+    :param LodesDatabase db: Optional shared connections to write through instead of opening one on spath.
+    :param float memory_mb: Rough budget in MB for parsed rows in memory, split across the chunks in flight.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    if not sources:
+        print("no sources to load")
+        return {}
+
+    print(f"streaming {len(sources)} files into {spath}")
+    with metrics.stage('stream', sources=len(sources), layout=layout, workers=workers) as m:
+        own_session = session is None
+        if own_session:
+            session = make_session(workers=workers)
+
+        targets = sorted({_target(source, layout)[0] for source in sources})
+        if indexes != 'inline':
+            drop_indexes(spath, tables=targets, db=db)
+
+        q = queue.Queue(maxsize=queue_depth)
+        stop = threading.Event()
+        rows = {}
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+                chunk_mb = memory_mb / (max(1, workers) + queue_depth + 1)
+                futures = [pool.submit(_produce, source, q, session, chunksize, timeout, stop, geocode_type, chunk_mb)
+                           for source in sources]
+                try:
+                    rows = _drain_queue(q, len(sources), spath, layout, indexes=indexes, covering=covering, clustered=clustered,
+                                        db=db)
+                except Exception as e:
+                    #let the workers finish instead of blocking on a full queue
+                    print(f"could not write to {spath}: {e}")
+                    stop.set()
+                    while not all(f.done() for f in futures):
+                        try:
+                            q.get(timeout=0.1)
+                        except queue.Empty:
+                            pass
+        finally:
+            if own_session:
+                session.close()
+
+        if indexes == 'deferred':
+            build_indexes(spath, tables=targets, covering=covering, db=db)
+        elif clustered and (indexes == 'inline'):
+            analyze_tables(spath, tables=targets, db=db)
+
+        failed = [t for t, r in rows.items() if r is None]
+        if failed:
+            print(f"{len(failed)} files failed to load: {failed}")
+        m['files'] = len(rows) - len(failed)
+        m['rows'] = sum(r for r in rows.values() if r)
+    return rows
+
+def _remote_changed(session: requests.Session, held: dict, timeout: float = 60) -> bool:
+    '''
+    check a loaded table's recorded source against the server with a HEAD request.
+    '''
+    try:
+        response = session.head(held['source'], timeout=timeout, allow_redirects=True)
+        if response.status_code != 200:
+            return True
+    except Exception:
+        return True
+    if held.get('etag') and response.headers.get('ETag'):
+        return held['etag'] != response.headers.get('ETag')
+    if held.get('last_modified') and response.headers.get('Last-Modified'):
+        return held['last_modified'] != response.headers.get('Last-Modified')
+    length = response.headers.get('Content-Length')
+    return (held.get('size') is None) or (length is None) or (int(length) != held['size'])
+
+def refresh_lodes_db(spath: str,
+                     save_loc: str,
+                     st: str,
+                     links_dict: dict,
+                     base_only: bool = False,
+                     workers: int = 8,
+                     session: requests.Session = None,
+                     years: list = None,
+                     job_types: list = None,
+                     segments: list = None,
+                     parts: list = None,
+                     types: list = None,
+                     geocode_type: str = 'text',
+                     layout: str = 'per_file',
+                     covering: bool = False,
+                     clustered: bool = False,
+                     db: LodesDatabase = None,
+                     rollups: list = None) -> dict:
+    '''
+    Bring an existing LODES database up to date with the catalog, e.g. after Census publishes a new year or revises files.
+    The state's files in the catalog are diffed against the lodes_sources table: files with no table yet are new, and
+    files whose table was loaded from a version the server no longer has (ETag/Last-Modified/size, checked with HEAD
+    requests) are changed. Only those are downloaded into save_loc and streamed into the database, replacing just the
+    affected tables; every other table is left untouched. Tables loaded before sources were recorded, or loaded from
+    csvs without a download manifest, can't be checked: the former are reloaded as new, the latter as changed.
+    Returns a dictionary with lists of the 'new', 'changed', 'unchanged' and 'failed' table names, plus 'missing' for
+    tables recorded in the database that are no longer in the catalog.
+
+    :param str spath: Path to the location of Spatialite database.
+    :param str save_loc: path to a folder where downloaded archives are kept (hint: same as for download_state_lodes_file())
+    :param str st: two letter state code
+    :param dict links_dict: current catalog (hint: output of get_all_possible_files())
+    :param bool base_only: If True, only the files for the slim database- JT00 and JT01, S000 for rac/wac.
+    :param int workers: Number of requests and downloads to run at once.
+    :param requests.Session session: Optional session to reuse (hint: output of make_session()).
+    :param list years, job_types, segments, parts, types: optional filters, see download_and_unzip.filter_entries()
+    :param str geocode_type: how geocodes were stored when the database was built, 'text' or 'integer'.
+    :param str layout: layout the database was built with, 'per_file' or 'consolidated'.
+    :param bool covering: whether the database was built with covering indexes.
+    :param bool clustered: whether the database was built with clustered WITHOUT ROWID tables.
+    :param LodesDatabase db: Optional shared connections to use instead of opening them on spath.
+    :param list rollups: crosswalk levels the database has rollups for (see build_database.build_rollups()); they are
+        rebuilt for the tables that were reloaded.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    with metrics.stage('refresh', state=st) as m:
+        #what the catalog has now
+        entries = filter_entries(catalog_entries(links_dict, st), years=years, job_types=job_types,
+                                 segments=segments, parts=parts, types=types)
+        if base_only == True:
+            keep = set(_keep_base_only([e['url'] for e in entries]))
+            entries = [e for e in entries if e['url'] in keep]
+        by_table = {_table_name(e['url']): e for e in entries}
+
+        #what the database holds
+        held = get_loaded_sources(spath, db=db)
+        own_session = session is None
+        if own_session:
+            session = make_session(workers=workers)
+        try:
+            new = [t for t in by_table if t not in held]
+            known = [t for t in by_table if t in held]
+            print(f"{len(new)} new files, checking {len(known)} loaded files for changes...")
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+                flags = list(pool.map(lambda t: (held[t]['source'] != by_table[t]['url']) or _remote_changed(session, held[t]), known))
+            changed = [t for t, f in zip(known, flags) if f]
+            unchanged = [t for t, f in zip(known, flags) if not f]
+            missing = [t for t in held if (t not in by_table) and t.startswith(f"{st}_")]
+            print(f"{len(changed)} changed, {len(unchanged)} unchanged, {len(missing)} no longer in the catalog")
+
+            todo = new + changed
+            rows = {}
+            if todo:
+                #download just those files, then stream them in from disk
+                sub_links = {st: {}}
+                for t in todo:
+                    e = by_table[t]
+                    sub_links[st].setdefault(e['type'], []).append(e['url'])
+                outcomes = {}
+                folds = download_states(save_loc=save_loc, states=[st], links_dict=sub_links, workers=workers,
+                                        session=session, outcomes=outcomes)
+                fold = folds.get(st)
+                #a file that failed to download may have a stale copy on disk from an earlier run; leave it out
+                sources = []
+                for t in todo:
+                    e = by_table[t]
+                    if outcomes.get(e['url']) in ['downloaded', 'unchanged']:
+                        sources.append(os.path.join(fold, e['type'], e['name']))
+                rows = stream_lodes_into_db(sources=sources, spath=spath, workers=workers, session=session,
+                                            geocode_type=geocode_type, layout=layout, covering=covering, clustered=clustered,
+                                            db=db)
+        finally:
+            if own_session:
+                session.close()
+
+        failed = [t for t in todo if rows.get(t) is None]
+        reloaded = sorted({_target(t, layout)[0] for t in todo if (t not in failed) and (_file_type(t) in ['od','rac','wac'])})
+        if rollups and reloaded:
+            build_rollups(spath, levels=rollups, tables=reloaded, db=db)
+        m['files'] = len(todo) - len(failed)
+        m['failed'] = len(failed)
+    return {'new': [t for t in new if t not in failed],
+            'changed': [t for t in changed if t not in failed],
+            'unchanged': unchanged,
+            'failed': failed,
+            'missing': missing}